@@ -6,4 +6,9 @@ python manage.py migrate
 python manage.py collectstatic --no-input
 
 # serve using uwsgi with nginx
-uwsgi --socket :8005 --module orchards.wsgi --chmod-socket=660 --processes=3 --uid=aero --gid=aero --logto=/var/log/uwsgi/aero.log --master 
\ No newline at end of file
+# the uwsgi master also runs the queued missing trees jobs as aero, restarts them if they stop and sends them SIGTERM 
+# on shutdown. As aero, like the web workers, so the orchard store and the drawings stay writable by both.
+# UWSGI_PROCESSES is exported for the settings, they split the cores of the host between the processes
+export UWSGI_PROCESSES="${UWSGI_PROCESSES:-3}"
+uwsgi --socket :8005 --module orchards.wsgi --chmod-socket=660 --processes="$UWSGI_PROCESSES" --uid=aero --gid=aero --logto=/var/log/uwsgi/aero.log --master \
+    --attach-daemon2 "cmd=python manage.py run_jobs,uid=aero,gid=aero,stopsignal=15" 
\ No newline at end of file
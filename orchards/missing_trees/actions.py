@@ -1,129 +1,200 @@
-import plotly.express as px
-import plotly.graph_objects as go
-import requests, json
+import numpy as np
 
 from math import floor
 
-from shapely.geometry import Point
+from django.core.exceptions import ValidationError
 
-from utils.helper import add_distance, get_value, is_inside_polygon
-from missing_trees.conditions import verify_if_point_exists
+from utils import metrics
+from utils.helper import add_distance, points_inside_polygon
+from missing_trees.conditions import ToleranceIndex
+from missing_trees.lattice import find_missing_trees_lattice
+from missing_trees.merge import as_missing_trees, merge_points
+from missing_trees.planar import find_missing_trees_planar
 
 
-def draw(orchard_id, trees, lat_trees, lon_trees):
+def estimate_spacing(nearest):
     '''
-    Draws and plots points on basic map for visual representation
+    Assumes equal space between each tree by using the shortest distance of the first tree, 
+    floored to the meter, see detect_missing_points
 
     Parameters:
-      - list: list of tree ids - trees
-      - list: list of latitude values - lat_trees
-      - list: list of longitude values - lon_trees
+      - nearest: float - distance from the first tree to its nearest neighbour in kilometers
 
     Returns:
-      none
+      float: space between trees in kilometers - mean
+
+    Raises:
+      ValidationError: when the trees are too close to each other to estimate it
     '''
-    
-    try:
+    mean = floor(nearest * 1000)/1000.0
+
+    if mean == 0:
+        raise ValidationError('Trees are too close to each other to estimate the space between them')
+
+    return mean
+
 
-        URL = f'{get_value("BASE_ENDPOINT")}orchards/{orchard_id}'
-        API_TOKEN = get_value("API_TOKEN")
+def generate_candidates(trees, mean, start=0, stop=None):
+    '''
+    Builds every potentially missing point around every tree in one pass
+
+    For each tree, the neighbour furthest away decides how many steps of (mean) fit
+    between them. Each step is offset to the left and to the right of the tree, so the
+    candidates are ordered by (tree, step, left/right) the same way the original nested
+    loops visited them.
 
-        headers = {'Content-Type':'application/json', 'Authorization': f'{API_TOKEN}'}
-        response = requests.get(URL, timeout=5, headers=headers)
+    Parameters:
+      - trees: Trees - trees with their neighbours, see setup_dataframe
+      - mean: float - assumed space between trees in kilometers
+      - start: int - first row of the trees to use, default=0
+      - stop: int - row after the last tree to use, default=None uses all trees
+
+    Returns:
+      array: row of the tree (parent) each candidate belongs to - parents
+      array: latitude values - lat_candidates
+      array: longitude values - lon_candidates
+    '''
+    distances = trees.distances[start:stop]
 
-        data = json.loads(response.content)
+    # the nearest neighbour (index 0) is ignored, only trees further away can have gaps in between
+    if distances.shape[1] < 2:
+        empty = np.empty(0)
+        return empty.astype(int), empty, empty
 
-        lon_polygon = []
-        lat_polygon = []
+    # based on the assumption that each tree is equally spaced,
+    # track potentially missing trees between parent and
+    # trees 2 times the distance away or more from parent
+    missing_points = (np.round(distances[:, 1:], 3) // mean).max(axis=1)
+    steps_per_tree = np.maximum(missing_points - 1, 0).astype(int)
 
-        polygon = data['polygon'].split(' ')
-        lis = []
+    parents = np.repeat(np.arange(len(steps_per_tree)), steps_per_tree)
+    first_step = np.repeat(np.cumsum(steps_per_tree) - steps_per_tree, steps_per_tree)
+    steps = np.arange(len(parents)) - first_step + 1
 
-        for points in polygon:
-            lon_polygon.append(float(points.split(',')[0]))
-            lat_polygon.append(float(points.split(',')[1]))
+    parents += start
 
-            lis.append((float(points.split(',')[0]), float(points.split(',')[1])))
+    lat = trees.lat[parents]
+    lon = trees.lng[parents]
 
-        figure_line = px.line_geo(lon=lon_polygon, lat=lat_polygon)
-        figure_scatter = px.scatter_geo(lat=lat_trees,lon=lon_trees, hover_name=trees)
+    # add (mean * space between missing_point) to the left and to the right of parent
+    lat_left, lon_left = add_distance(direction=2, dist_in_km=mean*steps, lat=lat, lon=lon)
+    lat_right, lon_right = add_distance(direction=4, dist_in_km=mean*steps, lat=lat, lon=lon)
 
-        figure = go.Figure(data=figure_scatter.data + figure_line.data)
-        figure.update_layout(title = 'World map', title_x=0.5)
-        figure.show()
+    # interleave left and right points
+    return (
+        np.repeat(parents, 2),
+        np.column_stack((lat_left, lat_right)).ravel(),
+        np.column_stack((lon_left, lon_right)).ravel(),
+    )
 
-    except Exception as e:
-        # fail silently
-        print(e)
 
+def detect_missing_points(trees, trees_polygon, chunk_size=None):
+    '''
+    Generates and filters potentially missing points, chunk_size trees at a time
 
-def find_missing_trees(trees_dictionary, trees_polygon, dataframe):
+    Parameters:
+      - trees: Trees - trees with their neighbours, see setup_dataframe
+      - trees_polygon: Polygon - bounds of the trees
+      - chunk_size: int - number of trees (parents) per chunk, default=None uses all trees at once
+
+    Yields:
+      array: row of the tree (parent) each missing point in the chunk was found next to
+      array: latitude values of missing points in the chunk
+      array: longitude values of missing points in the chunk
+    '''
+    # assume equal space between each tree by using shortest distance positioned at index 0 | make this value the mean
+    mean = estimate_spacing(trees.distances[0][0])
+
+    with metrics.stage('tolerance_index'):
+        tolerance_index = ToleranceIndex(trees)
+
+    chunk_size = chunk_size or len(trees)
+
+    for start in range(0, len(trees), chunk_size):
+
+        with metrics.stage('candidates'):
+            parents, lat_candidates, lon_candidates = generate_candidates(trees, mean, start, start + chunk_size)
+
+        metrics.count('candidates', len(parents))
+
+        # check if the points are potentially missing next to their parents
+        with metrics.stage('verify'):
+            missing_candidates = ~tolerance_index.exists(parents, lat_candidates, lon_candidates)
+
+        parents = parents[missing_candidates]
+        lat_candidates, lon_candidates = lat_candidates[missing_candidates], lon_candidates[missing_candidates]
+
+        # check if the retuned points are within the bounds
+        with metrics.stage('containment'):
+            inside = points_inside_polygon(trees_polygon, lon_candidates, lat_candidates, tolerance=0.00002)
+
+        yield parents[inside], lat_candidates[inside], lon_candidates[inside]
+
+
+def find_missing_trees(trees, trees_polygon):
     '''
     Finds potentially missing trees
 
     Parameters:
-      - trees_dictionary: dict - dictionary of points
-      - trees_polygon: list - list of tuples with points, i.e (lon, lat)
-      - dataframe: Dataframe - pandas
+      - trees: Trees - trees with their neighbours, see setup_dataframe
+      - trees_polygon: Polygon - bounds of the trees
 
     Returns:
-      list: potentially missing trees - [{'lat': lat1, 'lng': lat22}]
+      list: potentially missing trees, with the number of trees that found them, see merge_points
+        - [{'lat': lat1, 'lng': lat22, 'support': 1}]
     '''
-    missing = {}
-    
-    try:
-      trees_dictionary = json.loads(trees_dictionary)
-    except:
-      pass
-    
-    # assume equal space between each tree by using shortest distance positioned at index 0 | make this value the mean
-    mean = floor(dataframe['nearest_distances'][0][0] * 1000)/1000.0
+    parents, lat_missing, lon_missing = (
+        np.concatenate(values) for values in zip(*detect_missing_points(trees, trees_polygon))
+    )
 
-    # iterate through all trees using nearest distance list
-    for idx_nearest, nearest_distance in enumerate(dataframe['nearest_distances']):
-        
-        # iterate through list of nearest_distances around a tree/parent
-        for idx_distance, distance in enumerate(nearest_distance):
+    return as_missing_trees(*merge_points(parents, lat_missing, lon_missing))
 
-            # ignore parent
-            if idx_distance != 0:
 
-                # based on the assumption that each tree is equally spaced,
-                # track potentially missing trees between parent and
-                # trees 2 times the distance away or more from parent
-                missing_points = round(distance, 3)//mean
-                
-                # if the space between is greater than the mean
-                if missing_points > 1:
+def unique_missing_points(trees_polygon, parents, lat_missing, lon_missing):
+    '''
+    Keeps the missing points inside the bounds of the trees and merges them like find_missing_trees,
+    for points verified apart and put back in the order of their parents, see tiles and delta
 
-                    # check to see if tree does not already exist at all the missings points before tracking the coordinate
-                    for missing_point in range(1, int(missing_points)):
+    Parameters:
+      - trees_polygon: Polygon - bounds of the trees
+      - parents: array - rows of the parents of the verified points
+      - lat_missing: array - latitude values of the verified points
+      - lon_missing: array - longitude values of the verified points
 
-                        # add (mean * space between missing_point) to the left of parent
-                        lat_left_direction, lon_left_direction = add_distance(direction=2, dist_in_km=mean*missing_point, lat=dataframe['lat'][idx_nearest], lon=dataframe['lon'][idx_nearest])
-                        
-                        left_direction_point = Point(lon_left_direction, lat_left_direction)
+    Returns:
+      list: potentially missing trees - [{'lat': lat1, 'lng': lat22, 'support': 1}]
+    '''
+    with metrics.stage('containment'):
+        inside = points_inside_polygon(trees_polygon, lon_missing, lat_missing, tolerance=0.00002)
+
+    return as_missing_trees(*merge_points(parents[inside], lat_missing[inside], lon_missing[inside]))
 
-                        # check if the retuned point is within the bounds before continuing 
-                        if is_inside_polygon(trees_polygon, left_direction_point) or left_direction_point.distance(trees_polygon) <= 0.00002:
 
-                            # check if point is potentially missing on the left of parent
-                            if not verify_if_point_exists(trees_dictionary, dataframe['id'][idx_nearest], [lat_left_direction, lon_left_direction], dataframe['nearest_neighbours'][idx_nearest]) :
+# detection engines selectable per request, all take the values returned by setup_dataframe
+ENGINES = {
+    'offset': find_missing_trees,
+    'lattice': find_missing_trees_lattice,
+    'planar': find_missing_trees_planar,
+}
 
-                                missing['{},{}'.format(round(lat_left_direction, 5), round(lon_left_direction, 5))] = {'lat': lat_left_direction, 'lng':lon_left_direction}
+DEFAULT_ENGINE = 'offset'
 
-                        # add (mean * space between missing_point) to the right of tree at hand
-                        lat_right_direction, lon_right_direction = add_distance(direction=4, dist_in_km=mean*missing_point, lat=dataframe['lat'][idx_nearest], lon=dataframe['lon'][idx_nearest])
-                        
-                        right_direction_point = Point(lon_right_direction, lat_right_direction)
+# engines using the neighbours found by setup_dataframe, the others project the trees and search their own
+NEIGHBOUR_ENGINES = ('offset',)
 
-                        # check if the retuned point is within the bounds before continuing 
-                        if is_inside_polygon(trees_polygon, right_direction_point) or right_direction_point.distance(trees_polygon) <= 0.00002:
 
-                            # check if point is potentially missing on the right of parent
-                            if not verify_if_point_exists(trees_dictionary, dataframe['id'][idx_nearest], [lat_right_direction, lon_right_direction], dataframe['nearest_neighbours'][idx_nearest]):
+def get_engine(name=None):
+    '''
+    Parameters:
+      - name: str - engine name, default=None returns the default engine
 
-                                missing['{},{}'.format(round(lat_right_direction, 5), round(lon_right_direction, 5))] = {'lat': lat_right_direction, 'lng': lon_right_direction}
-                    
-    
-    return list(missing.values())
\ No newline at end of file
+    Returns:
+      function: detection engine, see ENGINES
+
+    Raises:
+      ValidationError: when the engine does not exist
+    '''
+    try:
+        return ENGINES[name or DEFAULT_ENGINE]
+    except KeyError:
+        raise ValidationError('Unknown engine {}, choose one of {}'.format(name, ', '.join(ENGINES)))
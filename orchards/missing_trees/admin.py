@@ -1,3 +1,19 @@
 from django.contrib import admin
 
-# Register your models here.
+from missing_trees.models import MissingTreesJob, MissingTreesResult
+
+
+@admin.register(MissingTreesResult)
+class MissingTreesResultAdmin(admin.ModelAdmin):
+    list_display = ('orchard_id', 'survey_hash', 'engine', 'version', 'tree_count', 'created')
+    list_filter = ('engine', 'created')
+    search_fields = ('orchard_id', 'survey_hash')
+    readonly_fields = ('created',)
+
+
+@admin.register(MissingTreesJob)
+class MissingTreesJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'orchard_id', 'engine', 'status', 'attempts', 'created', 'updated')
+    list_filter = ('status', 'engine')
+    search_fields = ('orchard_id',)
+    readonly_fields = ('created', 'updated')
@@ -1,81 +1,116 @@
-from utils.helper import all_range, binary_search, get_direction
+import numpy as np
 
+from utils.helper import get_direction
 
-def verify_if_point_exists(trees_dictionary: dict, parent_id: int, point: list, nearest_neighbours: list):
+
+# tolerance used when looking for an existing tree, in units of the 5th decimal place, i.e 0.00005
+TOLERANCE = 5
+
+
+class ToleranceIndex:
     '''
-    Verifies whether point exists within a list of neighbours before declaring it as missing. 
-    
-    Because we are working with latitude and longitude values, 
-    a special case is used with an offset tolerance of 5 decimal places, i.e 0.00005
-    - rounds off the value to 5 decimal places
-    - creates a latitude list ranging between (lat-0.00005, lat+0.00005) 
-    - creates a longitude list ranging between (lon-0.00005, lon+0.00005) 
-    - search for lat and lon through created ranges
-
-    Parameters:
-      - trees_dictionary: dict - dictionary of points
-      - parent_id: int - id of the original point (parent)
-      - point: list - potentially missing (lat, lon)
-      - search_list: list of neighbour ids belonging to the original point
-
-    Returns:
-      bool: true if point is found else false meaning its missing
+    Spatial index over the trees of an orchard, built once and queried for all
+    potentially missing points at the same time. 
+
+    Verifies whether a point exists within the neighbours to the left or right of its parent, 
+    with a tolerance of 0.00005 in latitude and longitude. Coordinates are rounded to 5 decimal 
+    places and kept as integers so the (lat-0.00005, lat+0.00005) and (lon-0.00005, lon+0.00005) 
+    ranges become a square radius query on a KD-tree.
+
+    The original search listed the values of each range in steps of 0.00001, which includes 
+    (value+0.00006) whenever floating point keeps it below the stop value, so the upper bound of 
+    every tree is tracked separately to keep its accept/reject decisions, see tests.verify_if_point_exists
     '''
 
-    parent_id = str(parent_id)
-    
-    assume_left_and_right_exists_count = 0
-    result = True
+    def __init__(self, trees):
+        '''
+        Parameters:
+          - trees: Trees - trees with their neighbours, see setup_dataframe
+        '''
+        lat = trees.lat
+        lon = trees.lng
+
+        # trees are looked up by id, like trees_dictionary, so a repeated id resolves to its last tree
+        self.rows = trees.rows(trees.ids)
+        self.size = len(trees)
 
-    for neighbour in nearest_neighbours:
+        self.lat_min, self.lat_max = self._tolerance_range(lat)
+        self.lon_min, self.lon_max = self._tolerance_range(lon)
 
-        neighbour = str(neighbour)
+        from sklearn.neighbors import KDTree
 
-        # Because we are assuming the points are in a grid, 
-        # check if neighbour is to the left or right of parent
-        direction = get_direction(
-            trees_dictionary[parent_id]['lat'], trees_dictionary[parent_id]['lng'],
-            trees_dictionary[neighbour]['lat'], trees_dictionary[neighbour]['lng']
+        self.kd_tree = KDTree(
+            np.column_stack((self.lat_min + TOLERANCE, self.lon_min + TOLERANCE)).astype(float),
+            metric='chebyshev'
         )
-        
-        # Special case - to left of parent point - direction == 270
-        # Special case - to right of parent point - direction == 90
-        
-        if (direction//1 == 270) or (direction//1 == 90):
 
-            assume_left_and_right_exists_count += 1
+        # only neighbours to the left or right of parent are searched
+        neighbour_rows = trees.rows(trees.ids[trees.neighbours]).reshape(self.size, -1)
+        parent_rows = np.repeat(self.rows, neighbour_rows.shape[1]).reshape(neighbour_rows.shape)
 
-            # add/subtract tolerance value to neighbour latitude value to get min and max 
-            lat_min_range = round(trees_dictionary[neighbour]['lat'], 5) - 0.00005
-            lat_max_range = round(trees_dictionary[neighbour]['lat'], 5) + 0.00005
+        direction = get_direction(lat[parent_rows], lon[parent_rows], lat[neighbour_rows], lon[neighbour_rows])
+        left_or_right = (direction//1 == 270) | (direction//1 == 90)
+
+        self.has_left_or_right = left_or_right.any(axis=1)
+        self.left_or_right_pairs = np.unique(
+            np.repeat(np.arange(self.size), neighbour_rows.shape[1])[left_or_right.ravel()] * self.size
+            + neighbour_rows.ravel()[left_or_right.ravel()]
+        )
 
-            # create neighbour latitude range list
-            # this range helps check for trees that are not equally spaced
-            lat_list = all_range(start=lat_min_range, stop=lat_max_range+0.00001, step=0.00001, round_by=5)
+    @staticmethod
+    def _tolerance_range(values):
+        '''
+        Rounds values to 5 decimal places and returns the inclusive (min, max) range 
+        the original search would list for each value, as integers
+        '''
+        rounded = np.round(values, 5)
+        start = rounded - 0.00005
+        stop = rounded + 0.00005 + 0.00001
 
-            # search for potentially missing latitude in range list
-            approx_lat = binary_search(round(point[0], 5) , lat_list)
+        value = np.rint(rounded * 100000).astype(np.int64)
+        extra = (np.round(start + 11 * 0.00001, 5) < stop).astype(np.int64)
 
-            if approx_lat:
-                # add/subtract toletance value to neighbour longitude to get min and max 
-                lon_min_range = round(trees_dictionary[neighbour]['lng'], 5) - 0.00005
-                lon_max_range = round(trees_dictionary[neighbour]['lng'], 5) + 0.00005
+        return value - TOLERANCE, value + TOLERANCE + extra
 
-                # create neighbour longitude range list
-                # this range helps check for trees that are not equally spaced
-                lon_list = all_range(start=lon_min_range, stop=lon_max_range+0.00001, step=0.00001, round_by=5)
+    def exists(self, parents, lat, lon):
+        '''
+        Verifies whether points exist within the neighbours of their parents before declaring them as missing.
 
-                # search for potentially missing longitude in range list
-                approx_lng = binary_search(round(point[1], 5), lon_list)
+        Parameters:
+          - parents: array - row of the original point (parent) each point belongs to
+          - lat: array - potentially missing latitude values
+          - lon: array - potentially missing longitude values
 
-                if approx_lng: 
-                    # point already exists == not missing
-                    return True
+        Returns:
+          array: true for points that are found else false meaning they are missing
+        '''
+        parents = np.asarray(parents, dtype=np.int64)
+        found = ~self.has_left_or_right[parents]
+
+        if len(parents) == 0:
+            return found
+
+        lat = np.rint(np.round(lat, 5) * 100000).astype(np.int64)
+        lon = np.rint(np.round(lon, 5) * 100000).astype(np.int64)
+
+        # every tree within tolerance of each point, the upper bound can be one unit more
+        matches = self.kd_tree.query_radius(np.column_stack((lat, lon)).astype(float), r=TOLERANCE + 1)
+        counts = np.fromiter((len(match) for match in matches), dtype=np.int64, count=len(matches))
+
+        if counts.sum() == 0:
+            return found
+
+        points = np.repeat(np.arange(len(parents)), counts)
+        trees = np.concatenate(matches).astype(np.int64)
+
+        within = (
+            (lat[points] >= self.lat_min[trees]) & (lat[points] <= self.lat_max[trees]) &
+            (lon[points] >= self.lon_min[trees]) & (lon[points] <= self.lon_max[trees])
+        )
+        points, trees = points[within], trees[within]
 
-            # point does not exist == (potentially) missing
-            result = False
-    
-    if assume_left_and_right_exists_count > 1 and assume_left_and_right_exists_count < 2:
-        result = False
+        # a tree only counts when it is a neighbour to the left or right of the parent
+        neighbour = np.isin(parents[points] * self.size + trees, self.left_or_right_pairs)
+        found[points[neighbour]] = True
 
-    return result
+        return found
@@ -0,0 +1,371 @@
+from math import asin, cos, pi, sin
+
+import numpy as np
+
+from django.conf import settings
+
+from missing_trees.actions import estimate_spacing, generate_candidates, unique_missing_points
+from missing_trees.conditions import ToleranceIndex
+from missing_trees.setup import NEIGHBOURS, nearest_neighbours, query_neighbours, survey_hash
+from missing_trees.store import load_candidates, load_latest, load_trees, save_candidates, save_latest, save_trees
+from missing_trees.tiles import detect_tiled
+from utils import metrics
+from utils.helper import CellGrid, EARTH_RADIUS_IN_KM
+
+
+def match_surveys(previous, trees):
+    '''
+    Matches the trees of two surveys of an orchard by id. A tree that moved counts as removed and added.
+
+    Neighbours at the same distance are ordered by row, see setup._break_ties, so the trees kept
+    must be in the same order in both surveys for their neighbours to be reused
+
+    Parameters:
+      - previous: Trees - trees of the survey processed before
+      - trees: Trees - trees of the new survey
+
+    Returns:
+      array: row in trees of every tree of previous, -1 when it was removed or moved - moved_to
+      None when the surveys cannot be matched, ids are repeated or trees were reordered
+    '''
+    if len(np.unique(previous.ids)) != len(previous) or len(np.unique(trees.ids)) != len(trees):
+        return None
+
+    _, previous_rows, rows = np.intersect1d(previous.ids, trees.ids, assume_unique=True, return_indices=True)
+
+    same = (previous.lat[previous_rows] == trees.lat[rows]) & (previous.lng[previous_rows] == trees.lng[rows])
+    previous_rows, rows = previous_rows[same], rows[same]
+
+    order = np.argsort(previous_rows)
+    if (np.diff(rows[order]) <= 0).any():
+        return None
+
+    moved_to = np.full(len(previous), -1, dtype=np.int64)
+    moved_to[previous_rows] = rows
+
+    return moved_to
+
+
+def near_trees(lat_lng_rad, rows, radius):
+    '''
+    Rows of the trees in the grid cells around the trees at rows, with cells radius kilometers across.
+    Every tree within radius of the trees at rows is included, a tree left out is further than radius from all of them
+
+    Parameters:
+      - lat_lng_rad: array - (trees, 2) coordinates of all the trees in radians
+      - rows: array - rows of the trees to search around
+      - radius: float - in kilometers
+
+    Returns:
+      array: rows of the trees in ascending order
+    '''
+    cell_lat = radius / EARTH_RADIUS_IN_KM
+
+    # longitude cells are at least radius across at the latitude furthest from the equator
+    widest = min(float(np.abs(lat_lng_rad[:, 0]).max()), pi / 2)
+    cell_lng = 2 * asin(min(sin(min(cell_lat, pi) / 2) / max(cos(widest), 1e-12), 1))
+
+    grid = CellGrid(
+        np.floor(lat_lng_rad[:, 0] / cell_lat).astype(np.int64), np.floor(lat_lng_rad[:, 1] / cell_lng).astype(np.int64)
+    )
+
+    near, _ = grid.points_in(np.unique((grid.keys[rows][:, None] + grid.around()).ravel()))
+
+    return np.sort(near)
+
+
+def affected_trees(previous, trees, moved_to):
+    '''
+    Trees of the new survey whose k nearest neighbours may have changed: trees added or moved, trees
+    that lost a neighbour, and trees with an added tree as close as their furthest neighbour
+
+    Returns:
+      array: true for the affected trees
+    '''
+    kept = np.flatnonzero(moved_to >= 0)
+
+    affected = np.ones(len(trees), dtype=bool)
+    affected[moved_to[kept]] = False
+
+    lost = (moved_to[previous.neighbours[kept]] < 0).any(axis=1)
+    affected[moved_to[kept[lost]]] = True
+
+    added = np.flatnonzero(affected)
+
+    if len(added) and len(kept):
+        from sklearn.neighbors import BallTree
+
+        lat_lng_rad = np.deg2rad(np.column_stack((trees.lat, trees.lng)))
+        furthest = np.empty(len(trees))
+        furthest[moved_to[kept]] = previous.distances[kept, -1]
+
+        # only trees near the added ones, or with neighbours further away than the cells, can have an added neighbour
+        radius = 2 * float(np.median(previous.distances[:, -1]))
+        near = np.union1d(near_trees(lat_lng_rad, added, radius), np.flatnonzero(furthest >= radius))
+        near = near[~affected[near]]
+
+        nearest, _ = BallTree(lat_lng_rad[added], metric='haversine').query(lat_lng_rad[near], k=1)
+
+        # a tree added at the same distance as the furthest neighbour can take its place as well
+        closer = nearest[:, 0] * EARTH_RADIUS_IN_KM <= furthest[near] * (1 + 1e-9)
+        affected[near[closer]] = True
+
+    return affected
+
+
+def search_near(trees, rows, k, radius):
+    '''
+    Finds the nearest neighbours of some trees, searching only the trees within radius kilometers of any
+    of them. A tree whose furthest neighbour is not strictly closer than radius could have a neighbour
+    further out, it is searched again with twice the radius
+
+    Returns:
+      array: rows of the nearest neighbours of the trees at rows, nearest first - neighbours
+      array: distances to those neighbours in kilometers - distances
+    '''
+    lat_lng_rad = np.deg2rad(np.column_stack((trees.lat, trees.lng)))
+
+    neighbours = np.empty((len(rows), k - 1), dtype=np.int64)
+    distances = np.empty((len(rows), k - 1))
+
+    pending = np.arange(len(rows))
+
+    while len(pending):
+        near = near_trees(lat_lng_rad, rows[pending], radius)
+
+        if len(near) < k:
+            radius *= 2
+            continue
+
+        # near keeps the order of the orchard, so ties are broken the same way as over all the trees
+        near_neighbours, near_distances = query_neighbours(trees.take(near), k, np.searchsorted(near, rows[pending]))
+
+        if len(near) == len(trees):
+            safe = np.ones(len(pending), dtype=bool)
+        else:
+            safe = near_distances[:, -1] < radius * (1 - 1e-9)
+
+        neighbours[pending[safe]] = near[near_neighbours[safe]]
+        distances[pending[safe]] = near_distances[safe]
+
+        pending = pending[~safe]
+        radius *= 2
+
+    return neighbours, distances
+
+
+def verify_points(trees, mean, rows=None):
+    '''
+    Generates the potentially missing points next to the trees at rows and keeps the ones not found
+    next to their parent, before the containment of find_missing_trees.
+
+    Only the parents and their neighbours take part in the verification, so its cost follows the
+    number of rows and not the size of the orchard
+
+    Parameters:
+      - trees: Trees - trees with their neighbours, see setup_dataframe
+      - mean: float - assumed space between trees in kilometers
+      - rows: array - rows of the parents, default=None all the trees
+
+    Returns:
+      array: rows of the parents of the verified points, in the order of find_missing_trees
+      array: latitude values of the verified points
+      array: longitude values of the verified points
+    '''
+    if rows is None:
+        subset, parents_trees = None, trees
+    else:
+        subset = np.unique(np.concatenate((rows, trees.neighbours[rows].ravel())))
+        positions = np.searchsorted(subset, rows)
+
+        # the neighbours of the parents are searched, other trees only need to be found
+        neighbours = np.repeat(np.arange(len(subset))[:, None], trees.neighbours.shape[1], axis=1)
+        distances = np.zeros((len(subset), trees.distances.shape[1]))
+
+        neighbours[positions] = np.searchsorted(subset, trees.neighbours[rows])
+        distances[positions] = trees.distances[rows]
+
+        parents_trees = trees.take(subset).with_neighbours(neighbours, distances)
+
+    with metrics.stage('tolerance_index'):
+        tolerance_index = ToleranceIndex(parents_trees)
+
+    with metrics.stage('candidates'):
+        parents, lat, lon = generate_candidates(parents_trees, mean)
+
+    metrics.count('candidates', len(parents))
+
+    with metrics.stage('verify'):
+        missing = ~tolerance_index.exists(parents, lat, lon)
+
+    parents = parents[missing] if subset is None else subset[parents[missing]]
+
+    return parents, lat[missing], lon[missing]
+
+
+def consistent(previous, candidates):
+    '''
+    Checks that the neighbours and the points of a stored survey refer to its own trees, a damaged
+    or partly written entry is detected again instead
+
+    Returns:
+      bool: true when every neighbour and parent is a row of previous
+    '''
+    parents, lat, lng = candidates
+
+    if not len(parents) == len(lat) == len(lng):
+        return False
+
+    return all(
+        len(rows) == 0 or (rows.min() >= 0 and rows.max() < len(previous)) for rows in (previous.neighbours, parents)
+    )
+
+
+def update_survey(previous, candidates, trees):
+    '''
+    Brings the neighbours and the verified points of the previous survey up to date with trees.
+
+    Only the neighbours of the affected trees are searched again, see affected_trees, and only
+    their points are verified again. The points of the other trees are reused, unless the space
+    between trees changed
+
+    Parameters:
+      - previous: Trees - trees of the survey processed before, with their neighbours
+      - candidates: tuple - (parents, lat, lng) verified points of the previous survey
+      - trees: Trees - trees of the new survey
+
+    Returns:
+      tuple: the same as detect_survey, None when more than DELTA_MAX_CHANGES of the trees changed
+    '''
+    k = min(NEIGHBOURS, len(trees))
+
+    if len(trees) < 2 or previous.neighbours.shape[1] != k - 1 or not consistent(previous, candidates):
+        return None
+
+    with metrics.stage('delta_match'):
+        moved_to = match_surveys(previous, trees)
+
+        if moved_to is None:
+            return None
+
+        kept = np.flatnonzero(moved_to >= 0)
+        changes = len(previous) + len(trees) - 2 * len(kept)
+
+        metrics.count('changed_trees', changes)
+
+        if changes > settings.DELTA_MAX_CHANGES * len(trees):
+            return None
+
+        affected = affected_trees(previous, trees, moved_to)
+
+    rows = np.flatnonzero(affected)
+    unaffected = kept[~affected[moved_to[kept]]]
+
+    metrics.count('affected_trees', len(rows))
+
+    neighbours = np.empty((len(trees), k - 1), dtype=np.int64)
+    distances = np.empty((len(trees), k - 1))
+
+    neighbours[moved_to[unaffected]] = moved_to[previous.neighbours[unaffected]]
+    distances[moved_to[unaffected]] = previous.distances[unaffected]
+
+    with metrics.stage('delta_neighbours'):
+        if len(rows):
+            radius = 2 * float(np.median(previous.distances[:, -1]))
+            neighbours[rows], distances[rows] = search_near(trees, rows, k, radius)
+
+    trees = trees.with_neighbours(neighbours, distances)
+    mean = estimate_spacing(distances[0][0])
+
+    if mean != estimate_spacing(previous.distances[0][0]):
+        # every point is a number of spaces away from its parent
+        return (trees,) + verify_points(trees, mean)
+
+    parents, lat, lng = candidates
+    parents = moved_to[parents]
+
+    reused = parents >= 0
+    reused[reused] = ~affected[parents[reused]]
+
+    found_parents, found_lat, found_lng = verify_points(trees, mean, rows)
+
+    parents = np.concatenate((parents[reused], found_parents))
+    order = np.argsort(parents, kind='stable')
+
+    return (
+        trees,
+        parents[order], np.concatenate((lat[reused], found_lat))[order], np.concatenate((lng[reused], found_lng))[order]
+    )
+
+
+def detect_survey(trees, executor=None):
+    '''
+    Runs the neighbour search and the offset detection on a whole survey, in tiles on the executor
+    for large orchards, see pipeline.use_tiles
+
+    Returns:
+      Trees: trees with their neighbours and distances
+      array: rows of the parents of the verified points, in the order of find_missing_trees
+      array: latitude values of the verified points
+      array: longitude values of the verified points
+    '''
+    unique = len(np.unique(trees.ids)) == len(trees)
+
+    if unique and settings.TILE_MIN_TREES is not None and len(trees) >= max(settings.TILE_MIN_TREES, 2):
+        return detect_tiled(trees, executor)
+
+    stored = load_trees(survey_hash(trees))
+    trees = stored if stored is not None else nearest_neighbours(trees)
+
+    return (trees,) + verify_points(trees, estimate_spacing(trees.distances[0][0]))
+
+
+def find_missing_trees_delta(orchard_id, trees, trees_polygon, executor=None, save=True):
+    '''
+    Same points as find_missing_trees, recomputed from the survey of the orchard processed last on
+    this host, so the cost follows the number of trees added, removed or moved.
+
+    The neighbours and the verified points of every survey are kept in the orchard store, the new survey
+    is matched against the last one by tree id, see update_survey. The whole survey is detected again
+    when there is no previous survey or too much of it changed
+
+    Parameters:
+      - orchard_id: int - orchard the survey belongs to
+      - trees: Trees - trees returned by fetch_trees
+      - trees_polygon: Polygon - bounds of the trees
+      - executor: Executor - pool running the tiles of large orchards, see detect_survey
+      - save: bool - store the survey as the last one of the orchard, default=true
+
+    Returns:
+      list: potentially missing trees - [{'lat': lat1, 'lng': lat22, 'support': 1}]
+    '''
+    digest = survey_hash(trees)
+    detected = None
+
+    with metrics.stage('store_load'):
+        candidates = load_candidates(digest)
+
+    if candidates is None:
+        with metrics.stage('store_load'):
+            latest = load_latest(orchard_id)
+            previous = None if latest is None else load_trees(latest)
+            previous_candidates = None if previous is None else load_candidates(latest)
+
+        if previous_candidates is not None:
+            detected = update_survey(previous, previous_candidates, trees)
+
+        if detected is None:
+            detected = detect_survey(trees, executor)
+
+        trees, parents, lat, lng = detected
+        candidates = parents, lat, lng
+
+        if save:
+            with metrics.stage('store_save'):
+                save_trees(digest, trees)
+                save_candidates(digest, *candidates)
+
+    if save:
+        save_latest(orchard_id, digest)
+
+    return unique_missing_points(trees_polygon, *candidates)
@@ -0,0 +1,147 @@
+import importlib.util
+import os
+import re
+import uuid
+
+import numpy as np
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+from missing_trees.store import prune
+from utils import client
+from utils.cache import TTLCache
+from utils.helper import get_value
+
+
+FORMATS = ('html', 'png')
+
+# names of the drawings, {orchard_id}-{survey hash}.{format}
+NAME = re.compile(r'^\d+-[0-9a-f]{64}\.(html|png)$')
+
+# orchard boundaries per orchard, they only change when the orchard is redrawn in the api
+polygon_cache = TTLCache(
+    ttl=settings.POLYGON_CACHE_TTL,
+    max_entries=settings.SURVEY_CACHE_MAX_ENTRIES,
+    alias=settings.SURVEY_CACHE_ALIAS,
+    prefix='polygon:',
+)
+
+
+def orchard_polygon(orchard_id):
+    '''
+    Fetches the boundary of an orchard, once per POLYGON_CACHE_TTL seconds
+
+    Parameters:
+      - orchard_id: int - orchard id
+
+    Returns:
+      list: longitude values of the boundary
+      list: latitude values of the boundary
+    '''
+    polygon = polygon_cache.get(orchard_id)
+
+    if polygon is None:
+        URL = f'{get_value("BASE_ENDPOINT")}orchards/{orchard_id}'
+        data = client.get_json(URL, headers=client.api_headers(get_value("API_TOKEN")))
+
+        points = [point.split(',') for point in data['polygon'].split(' ')]
+        polygon = [float(point[0]) for point in points], [float(point[1]) for point in points]
+
+        polygon_cache.set(orchard_id, polygon)
+
+    return polygon
+
+
+def downsample(trees, max_points):
+    '''
+    Evenly spaced rows of the trees, so large orchards are drawn with at most max_points markers
+
+    Returns:
+      array: rows of the trees to draw
+    '''
+    if len(trees) <= max_points:
+        return np.arange(len(trees))
+
+    return np.unique(np.linspace(0, len(trees) - 1, max_points).round().astype(np.int64))
+
+
+def drawing_path(name):
+    '''
+    Returns:
+      str: path of a rendered drawing, None when the name is not a drawing name
+    '''
+    if settings.DRAW_DIR is None or not NAME.match(name):
+        return None
+
+    return os.path.join(settings.DRAW_DIR, name)
+
+
+def draw(orchard_id, trees, digest, format='html'):
+    '''
+    Renders the trees and the boundary of an orchard to a static file in DRAW_DIR, without a display.
+
+    A drawing is rendered once per survey, later calls return the file already rendered. At most
+    DRAW_MAX_POINTS trees are drawn, see downsample
+
+    Parameters:
+      - orchard_id: int - orchard the trees belong to
+      - trees: Trees - ids and coordinates of the trees
+      - digest: str - survey hash, see setup.survey_hash
+      - format: str - html or png, png requires the kaleido package
+
+    Returns:
+      str: name of the drawing, see drawing_path
+    '''
+    if format not in FORMATS:
+        raise ValidationError(f'draw must be one of {", ".join(FORMATS)}')
+
+    if settings.DRAW_DIR is None:
+        raise ValidationError('Drawing is disabled')
+
+    if format == 'png' and importlib.util.find_spec('kaleido') is None:
+        raise ValidationError('png drawings require the kaleido package')
+
+    name = f'{int(orchard_id)}-{digest}.{format}'
+    path = drawing_path(name)
+
+    if os.path.isfile(path):
+        return name
+
+    # plotly is heavy and only needed here, workers that never draw do not load it
+    import plotly.graph_objects as go
+
+    lon_polygon, lat_polygon = orchard_polygon(orchard_id)
+    rows = downsample(trees, settings.DRAW_MAX_POINTS)
+
+    title = f'Orchard {orchard_id}'
+    if len(rows) < len(trees):
+        title += f' - {len(rows)} of {len(trees)} trees'
+
+    figure = go.Figure(data=[
+        go.Scattergeo(lon=trees.lng[rows], lat=trees.lat[rows], hovertext=trees.ids[rows], mode='markers', name='trees'),
+        go.Scattergeo(lon=lon_polygon, lat=lat_polygon, mode='lines', name='boundary'),
+    ])
+    figure.update_geos(fitbounds='locations')
+    figure.update_layout(title=title, title_x=0.5)
+
+    os.makedirs(settings.DRAW_DIR, exist_ok=True)
+
+    # rendered next to the drawing and renamed into place, so a drawing being written is never served
+    temporary = os.path.join(settings.DRAW_DIR, f'.{name}.{uuid.uuid4().hex}')
+
+    try:
+        if format == 'html':
+            figure.write_html(temporary, include_plotlyjs='cdn')
+        else:
+            figure.write_image(temporary, format='png')
+
+        os.replace(temporary, path)
+
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+    prune(settings.DRAW_DIR, settings.DRAW_MAX_ENTRIES)
+
+    return name
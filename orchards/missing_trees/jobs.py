@@ -0,0 +1,239 @@
+import logging
+import threading
+
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from missing_trees.actions import DEFAULT_ENGINE, get_engine
+from missing_trees.models import MissingTreesJob
+from missing_trees.pipeline import (
+    _reset_process_pool, compute_missing_trees, get_process_pool, get_stored_result, store_result, use_tiles
+)
+from missing_trees.setup import fetch_trees, survey_hash
+
+
+logger = logging.getLogger(__name__)
+
+
+def submit_job(orchard_id, engine=DEFAULT_ENGINE):
+    '''
+    Queues the missing trees computation of an orchard. An orchard already queued or running
+    with the same engine is not queued twice
+
+    Parameters:
+      - orchard_id: int - orchard to compute
+      - engine: str - detection engine, see actions.ENGINES
+
+    Returns:
+      MissingTreesJob: queued job, or the job already queued or running
+      bool: true if a new job was queued
+    '''
+    get_engine(engine)
+
+    active = Q(status__in=[MissingTreesJob.QUEUED, MissingTreesJob.RUNNING])
+
+    job = MissingTreesJob.objects.filter(active, orchard_id=orchard_id, engine=engine).first()
+    if job is not None:
+        return job, False
+
+    try:
+        with transaction.atomic():
+            job = MissingTreesJob.objects.create(orchard_id=orchard_id, engine=engine, available_at=timezone.now())
+    except IntegrityError:
+        # queued by another request in the meantime
+        return MissingTreesJob.objects.get(active, orchard_id=orchard_id, engine=engine), False
+
+    return job, True
+
+
+def claim_job():
+    '''
+    Takes the next job off the queue. Rows are locked with SKIP LOCKED so workers never claim
+    the same job, and a running job whose lease ended (its worker stopped renewing it) is claimed again
+
+    Returns:
+      MissingTreesJob: running job, None when the queue is empty
+    '''
+    while True:
+        now = timezone.now()
+
+        with transaction.atomic():
+            job = MissingTreesJob.objects.select_for_update(skip_locked=True).filter(
+                Q(status=MissingTreesJob.QUEUED, available_at__lte=now) |
+                Q(status=MissingTreesJob.RUNNING, leased_until__lt=now)
+            ).order_by('available_at').first()
+
+            if job is None:
+                return None
+
+            if job.attempts >= settings.JOB_MAX_ATTEMPTS:
+                job.status = MissingTreesJob.FAILED
+                job.detail = job.detail or 'Worker stopped while running the job'
+                job.save(update_fields=['status', 'detail', 'updated'])
+                continue
+
+            job.status = MissingTreesJob.RUNNING
+            job.attempts = F('attempts') + 1
+            job.leased_until = now + timedelta(seconds=settings.JOB_LEASE)
+            job.save(update_fields=['status', 'attempts', 'leased_until', 'updated'])
+
+        job.refresh_from_db()
+
+        return job
+
+
+class Lease:
+    '''
+    Renews the lease of a running job every JOB_HEARTBEAT seconds from a thread of its own, for as long
+    as the job holds the lease it was claimed with. Another worker may claim the job once it is lost
+    '''
+
+    def __init__(self, job):
+
+        self.job = job
+        self.leased_until = job.leased_until
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.renew_until_stopped, name=f'missing-trees-lease-{job.id}', daemon=True)
+
+    def __enter__(self):
+
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.stop.set()
+        self.thread.join()
+
+    def renew(self):
+        '''
+        Returns:
+          bool: true when the lease was renewed, false when the job was claimed by another worker
+        '''
+        leased_until = timezone.now() + timedelta(seconds=settings.JOB_LEASE)
+
+        renewed = MissingTreesJob.objects.filter(
+            pk=self.job.pk, status=MissingTreesJob.RUNNING, leased_until=self.leased_until
+        ).update(leased_until=leased_until, updated=timezone.now())
+
+        if renewed:
+            self.leased_until = leased_until
+
+        return bool(renewed)
+
+    def renew_until_stopped(self):
+
+        try:
+            while not self.stop.wait(settings.JOB_HEARTBEAT):
+                if not self.renew():
+                    logger.warning('Missing trees job %s lost its lease', self.job.id)
+                    return
+        finally:
+            connections.close_all()
+
+
+def run_job(job):
+    '''
+    Computes a claimed job. Results already stored for the survey are reused, otherwise the
+    detection runs on the batch process pool. A failing job is queued again with exponential
+    backoff until it has been attempted JOB_MAX_ATTEMPTS times.
+
+    The lease of the job is renewed while it runs, see Lease. The outcome is only written while
+    the worker still holds the lease, a job claimed by another worker in the meantime is left to it
+
+    Parameters:
+      - job: MissingTreesJob - job returned by claim_job
+
+    Returns:
+      bool: true when the outcome was written
+    '''
+    with Lease(job) as lease:
+        _compute(job)
+
+    return bool(MissingTreesJob.objects.filter(
+        pk=job.pk, status=MissingTreesJob.RUNNING, leased_until=lease.leased_until
+    ).update(
+        result=job.result, status=job.status, detail=job.detail, available_at=job.available_at,
+        leased_until=None, updated=timezone.now()
+    ))
+
+
+def _compute(job):
+    '''
+    Computes a claimed job and sets its result, status and detail, without saving them, see run_job
+    '''
+    try:
+        trees = fetch_trees(job.orchard_id)
+        digest = survey_hash(trees)
+
+        missing_trees = get_stored_result(job.orchard_id, digest, job.engine)
+
+        if missing_trees is None and use_tiles(trees, job.engine):
+            # spreads its tiles over the process pool itself
+            missing_trees = compute_missing_trees(job.orchard_id, trees, job.engine)
+
+        if missing_trees is None:
+            try:
+                missing_trees = get_process_pool().submit(
+                    compute_missing_trees, job.orchard_id, trees, job.engine
+                ).result()
+            except BrokenProcessPool:
+                _reset_process_pool()
+                raise
+
+        job.result = store_result(job.orchard_id, digest, len(trees), missing_trees, job.engine)
+        job.status = MissingTreesJob.DONE
+        job.detail = ''
+
+    except Exception as e:
+        logger.warning('Missing trees job %s failed: %s', job.id, e)
+
+        job.detail = str(e) or e.__class__.__name__
+
+        if job.attempts < settings.JOB_MAX_ATTEMPTS:
+            job.status = MissingTreesJob.QUEUED
+            job.available_at = timezone.now() + timedelta(
+                seconds=settings.JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            )
+        else:
+            job.status = MissingTreesJob.FAILED
+
+
+def work(stop=None, once=False):
+    '''
+    Runs queued jobs until stop is set. Waits JOB_POLL_INTERVAL seconds whenever the queue is empty.
+    Meant to run in its own thread, the database connections of the thread are closed on return
+
+    Parameters:
+      - stop: threading.Event - set to stop the worker, default=None runs forever
+      - once: bool - return as soon as the queue is empty
+
+    Returns:
+      int: number of jobs run
+    '''
+    stop = stop or threading.Event()
+    count = 0
+
+    while not stop.is_set():
+        close_old_connections()
+
+        job = claim_job()
+
+        if job is None:
+            if once:
+                break
+
+            stop.wait(settings.JOB_POLL_INTERVAL)
+            continue
+
+        run_job(job)
+        count += 1
+
+    connections.close_all()
+
+    return count
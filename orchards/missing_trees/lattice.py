@@ -0,0 +1,202 @@
+import numpy as np
+
+from missing_trees.merge import as_missing_trees, merge_points
+from missing_trees.setup import NEIGHBOURS
+from utils.helper import from_local_plane, points_inside_polygon, to_local_plane
+
+
+def _axis_spacing(along, across):
+    '''
+    Median distance to the nearest neighbour lying on an axis
+
+    Parameters:
+      - along: array - neighbour offsets along the axis, one row per tree
+      - across: array - neighbour offsets across the axis, one row per tree
+
+    Returns:
+      float: spacing along the axis, or None if no neighbour lies on it
+    '''
+    along = np.abs(along)
+    on_axis = (np.abs(across) < 0.25 * along) & (along > 0)
+
+    nearest = np.where(on_axis, along, np.inf).min(axis=1)
+    nearest = nearest[np.isfinite(nearest)]
+
+    if len(nearest) == 0:
+        return None
+
+    # the nearest of the two neighbours on an axis is biased short,
+    # so use every neighbour around the first estimate instead
+    spacing = np.median(nearest)
+    around = along[on_axis & (along > 0.5 * spacing) & (along < 1.5 * spacing)]
+
+    return float(np.median(around)) if len(around) else float(spacing)
+
+
+def _row_gap(v, tree_spacing):
+    '''
+    Median gap between consecutive rows, used when no tree has a neighbour in the next row
+    among its nearest neighbours
+
+    Returns:
+      float: row spacing, or None for a single row
+    '''
+    gaps = np.diff(np.sort(v))
+    gaps = gaps[gaps > 0.5 * tree_spacing]
+
+    return float(np.median(gaps)) if len(gaps) else None
+
+
+def _phase(values, spacing, groups):
+    '''
+    Circular mean of values modulo spacing, i.e the offset of a regular grid through the values
+
+    Parameters:
+      - values: array - positions along an axis
+      - spacing: float - grid spacing
+      - groups: array - group of each value, one offset is returned per group
+
+    Returns:
+      array: offset between 0 and spacing
+    '''
+    angles = 2 * np.pi * values / spacing
+    phase = np.arctan2(np.bincount(groups, np.sin(angles)), np.bincount(groups, np.cos(angles)))
+
+    return np.mod(phase, 2 * np.pi) * spacing / (2 * np.pi)
+
+
+def fit_lattice(x, y):
+    '''
+    Fits the row orientation and spacing of an orchard.
+
+    The grid axes are found from the directions to each tree's nearest neighbours (modulo 90 degrees),
+    the spacing along each axis is the median distance to the nearest neighbour on that axis,
+    and the axis with the shorter spacing is taken as the row direction
+
+    Parameters:
+      - x: array - x values in meters, see to_local_plane
+      - y: array - y values in meters, see to_local_plane
+
+    Returns:
+      float: angle of the rows from the x axis, in radians - angle
+      float: space between trees in a row, in meters - tree_spacing
+      float: space between rows, in meters - row_spacing
+    '''
+    from sklearn.neighbors import KDTree
+
+    points = np.column_stack((x, y))
+
+    distances, neighbours = KDTree(points).query(points, k=min(NEIGHBOURS, len(points)))
+
+    dx = x[neighbours[:, 1:]] - x[:, None]
+    dy = y[neighbours[:, 1:]] - y[:, None]
+
+    # the 2 nearest neighbours of a tree in a grid sit on a grid axis, even when rows are staggered.
+    # multiplying their angles by 4 folds both axes onto the same direction
+    theta = np.arctan2(dy[:, :2], dx[:, :2])
+    angle = np.arctan2(np.sin(4 * theta).sum(), np.cos(4 * theta).sum()) / 4
+
+    along = dx * np.cos(angle) + dy * np.sin(angle)
+    across = -dx * np.sin(angle) + dy * np.cos(angle)
+
+    tree_spacing = _axis_spacing(along, across)
+    row_spacing = _axis_spacing(across, along)
+
+    if tree_spacing is None or (row_spacing is not None and row_spacing < tree_spacing):
+        angle += np.pi / 2
+        tree_spacing, row_spacing = row_spacing, tree_spacing
+
+    if row_spacing is None:
+        row_spacing = _row_gap(-x * np.sin(angle) + y * np.cos(angle), tree_spacing)
+
+    return float(angle), tree_spacing, row_spacing
+
+
+def find_missing_trees_lattice(trees, trees_polygon):
+    '''
+    Finds potentially missing trees by comparing the trees against the planting lattice of the orchard.
+
+    - projects the trees once onto a plane in meters
+    - fits the row orientation and spacing
+    - lays out the expected positions along every row, rows may be staggered or unevenly spaced
+    - keeps the positions inside the orchard (convex hull of the trees)
+    - one nearest neighbour query marks the positions with no tree within half a tree spacing as missing
+    - missing positions are merged like find_missing_trees, each supported by its nearest tree
+
+    Parameters:
+      - trees: Trees - ids and coordinates of the trees
+      - trees_polygon: Polygon - bounds of the trees
+
+    Returns:
+      list: potentially missing trees - [{'lat': lat1, 'lng': lat22, 'support': 1}]
+    '''
+    if len(trees) < 3:
+        return []
+
+    x, y, origin = to_local_plane(trees.lat, trees.lng)
+
+    angle, tree_spacing, row_spacing = fit_lattice(x, y)
+
+    if not tree_spacing:
+        return []
+
+    # rotate so rows run along u
+    u = x * np.cos(angle) + y * np.sin(angle)
+    v = -x * np.sin(angle) + y * np.cos(angle)
+
+    # trees of a row share (almost) the same v, a new row starts wherever v jumps by more than
+    # half a tree spacing. Rows are never closer than trees in a row, see fit_lattice
+    order = np.argsort(v)
+    row_index = np.empty(len(v), dtype=np.int64)
+    row_index[order] = np.concatenate(([0], np.cumsum(np.diff(v[order]) > 0.5 * tree_spacing)))
+
+    row_size = np.bincount(row_index)
+    rows = np.arange(len(row_size))
+
+    # position of every row and the offset of its trees
+    row_v = np.bincount(row_index, v) / row_size
+    row_u = _phase(u, tree_spacing, row_index)
+
+    # small errors in the spacing add up along a row, refit it to the position of every tree in its row
+    for _ in range(2):
+        step = np.rint((u - row_u[row_index]) / tree_spacing)
+        step = step - (np.bincount(row_index, step) / row_size)[row_index]
+        offset = u - (np.bincount(row_index, u) / row_size)[row_index]
+
+        if np.dot(step, step) > 0:
+            tree_spacing = float(np.dot(step, offset) / np.dot(step, step))
+            row_u = _phase(u, tree_spacing, row_index)
+
+    # expected positions along every row, across the full width of the orchard
+    first = np.ceil((u.min() - row_u) / tree_spacing).astype(np.int64)
+    count = np.floor((u.max() - row_u) / tree_spacing).astype(np.int64) - first + 1
+    count = np.maximum(count, 0)
+
+    lattice_row = np.repeat(np.arange(len(rows)), count)
+    step = np.arange(len(lattice_row)) - np.repeat(np.cumsum(count) - count, count) + np.repeat(first, count)
+
+    lattice_u = row_u[lattice_row] + step * tree_spacing
+    lattice_v = row_v[lattice_row]
+
+    lattice_x = lattice_u * np.cos(angle) - lattice_v * np.sin(angle)
+    lattice_y = lattice_u * np.sin(angle) + lattice_v * np.cos(angle)
+
+    lat, lon = from_local_plane(lattice_x, lattice_y, origin)
+
+    # positions on the edge of the orchard are kept, 1 degree is roughly 111km
+    inside = points_inside_polygon(
+        trees_polygon.convex_hull, lon, lat, tolerance=0.25 * tree_spacing / 111320
+    )
+
+    lat, lon = lat[inside], lon[inside]
+    lattice = np.column_stack((lattice_x[inside], lattice_y[inside]))
+
+    if len(lattice) == 0:
+        return []
+
+    from sklearn.neighbors import KDTree
+
+    distances, nearest = KDTree(np.column_stack((x, y))).query(lattice, k=1)
+    missing = distances[:, 0] > 0.5 * tree_spacing
+
+    return as_missing_trees(*merge_points(nearest[missing, 0], lat[missing], lon[missing], origin=origin))
@@ -0,0 +1,228 @@
+import gc
+import json
+import tempfile
+import time
+import tracemalloc
+
+from math import ceil
+
+import numpy as np
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from sklearn.neighbors import BallTree
+
+from missing_trees.actions import ENGINES, estimate_spacing, generate_candidates
+from missing_trees.conditions import ToleranceIndex
+from missing_trees.merge import merge_points
+from missing_trees.pipeline import get_process_pool
+from missing_trees.setup import (
+    NEIGHBOURS, TIE_NEIGHBOURS, initialise_data, initialise_stream, setup_dataframe, survey_hash
+)
+from missing_trees.store import load_trees, save_trees
+from missing_trees.synthetic import KINDS, generate_orchard, score
+from missing_trees.tiles import find_missing_trees_tiled
+from utils.helper import points_inside_polygon
+
+
+def measure(function, memory=True):
+    '''
+    Runs function once timed and, when memory is true, once more while tracing allocations,
+    so tracing does not slow down the timed run
+
+    Returns:
+      value returned by function
+      float: seconds
+      int: peak bytes allocated while it ran, None when memory is false
+    '''
+    gc.collect()
+
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        del value
+        gc.collect()
+
+        tracemalloc.start()
+        try:
+            value = function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return value, seconds, peak
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks every stage of the missing trees detection on synthetic orchards, '
+        'and scores each engine against the trees removed from them'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kinds', nargs='+', choices=KINDS, default=list(KINDS))
+        parser.add_argument(
+            '--sizes', nargs='+', type=int, default=[100, 1000, 10000, 100000],
+            help='planting positions per orchard, up to 1000000'
+        )
+        parser.add_argument('--removed', type=float, default=0.05, help='fraction of the trees removed')
+        parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES))
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--tiles', type=int, default=4,
+            help='tiles of the tiled offset detection, run on BATCH_WORKERS processes, 0 skips it'
+        )
+        parser.add_argument('--no-memory', action='store_true', help='skip allocation tracing')
+        parser.add_argument('--json', help='also write the results to this file')
+
+    def handle(self, *args, **options):
+        memory = not options['no_memory']
+        records = []
+
+        self.stdout.write(f'{"orchard":<10} {"trees":>8}  {"stage":<28} {"seconds":>9} {"peak MB":>9}  score')
+
+        for size in options['sizes']:
+            for kind in options['kinds']:
+                orchard = generate_orchard(kind, size, options['removed'], options['seed'])
+
+                records_of_orchard = self.benchmark(
+                    orchard, options['engines'], options['tiles'], memory
+                )
+
+                for record in records_of_orchard:
+                    record.update({'orchard': kind, 'size': size, 'trees': len(orchard)})
+                    records.append(record)
+
+                    self.stdout.write(self.format(record))
+
+        if options['json']:
+            with open(options['json'], 'w') as file:
+                json.dump(records, file, indent=2)
+
+    def format(self, record):
+        peak = '' if record.get('peak_bytes') is None else f'{record["peak_bytes"] / 1e6:.1f}'
+
+        if 'error' in record:
+            result = f'error: {record["error"]}'
+        elif 'recall' in record:
+            result = f'recall {record["recall"]:.3f} precision {record["precision"]:.3f} found {record["found"]}'
+            if 'matches_single_tile' in record:
+                result += f' matches single tile {record["matches_single_tile"]}'
+        else:
+            result = ''
+
+        return f'{record["orchard"]:<10} {record["trees"]:>8}  {record["stage"]:<28} {record["seconds"]:>9.4f} {peak:>9}  {result}'
+
+    def benchmark(self, orchard, engines, tiles, memory):
+        '''
+        Yields:
+          dict: stage, seconds and peak_bytes of every stage, with recall and precision for the engines
+        '''
+        def stage(name, function):
+            value, seconds, peak = measure(function, memory)
+            return value, {'stage': name, 'seconds': seconds, 'peak_bytes': peak}
+
+        trees, record = stage('initialise_data', lambda: initialise_data(orchard.payload))
+        yield record
+
+        body = json.dumps(orchard.payload).encode('utf-8')
+        chunk_size = settings.API_STREAM_CHUNK_SIZE
+        chunks = lambda: (body[start:start + chunk_size] for start in range(0, len(body), chunk_size))
+
+        _, record = stage('initialise_stream', lambda: initialise_stream(chunks()))
+        yield record
+        del body
+
+        # the nearest neighbour search of setup_dataframe, split into its two steps, with the neighbours it
+        # queries to break ties, see query_neighbours
+        lat_lng_rad = np.deg2rad(np.column_stack((trees.lat, trees.lng)))
+
+        ball_tree, record = stage('balltree_build', lambda: BallTree(lat_lng_rad, metric='haversine'))
+        yield record
+
+        _, record = stage('balltree_query', lambda: ball_tree.query(
+            lat_lng_rad, k=min(NEIGHBOURS + TIE_NEIGHBOURS, len(trees)), return_distance=True, sort_results=True
+        ))
+        yield record
+        del ball_tree
+
+        # the orchard store is timed on its own, setup_dataframe always computes the neighbours
+        with override_settings(ORCHARD_STORE_DIR=None):
+            (trees, trees_polygon), record = stage('setup_dataframe', lambda: setup_dataframe('', trees))
+        yield record
+
+        digest = survey_hash(trees)
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(ORCHARD_STORE_DIR=directory):
+            _, record = stage('store_save', lambda: save_trees(digest, trees))
+            yield record
+
+            # mapping is lazy, reading the neighbours pages them in
+            _, record = stage('store_load', lambda: float(load_trees(digest).distances.sum()))
+            yield record
+
+        # stages of the offset engine, named like the metrics of detect_missing_points and find_missing_trees
+        try:
+            mean = estimate_spacing(trees.distances[0][0])
+        except ValidationError:
+            mean = None
+
+        if mean is not None:
+            tolerance_index, record = stage('tolerance_index', lambda: ToleranceIndex(trees))
+            yield record
+
+            (parents, lat, lon), record = stage('candidates', lambda: generate_candidates(trees, mean))
+            record['candidates'] = len(parents)
+            yield record
+
+            missing, record = stage('verify', lambda: ~tolerance_index.exists(parents, lat, lon))
+            yield record
+
+            parents, lat, lon = parents[missing], lat[missing], lon[missing]
+
+            inside, record = stage('containment', lambda: points_inside_polygon(
+                trees_polygon, lon, lat, tolerance=0.00002
+            ))
+            yield record
+
+            _, record = stage('merge_points', lambda: merge_points(parents[inside], lat[inside], lon[inside]))
+            yield record
+            del tolerance_index
+
+        results = {}
+
+        for engine in engines:
+            name = f'find_missing_trees[{engine}]'
+
+            try:
+                missing_trees, record = stage(name, lambda: ENGINES[engine](trees, trees_polygon))
+            except Exception as e:
+                yield {'stage': name, 'seconds': 0.0, 'peak_bytes': None, 'error': str(e)}
+                continue
+
+            results[engine] = missing_trees
+
+            record['recall'], record['precision'] = score(orchard, missing_trees)
+            record['found'] = len(missing_trees)
+            yield record
+
+        # neighbour search and detection of the offset engine split into tiles, from the trees alone
+        if tiles and 'offset' in results:
+            name = 'find_missing_trees[tiled]'
+            tile_trees = ceil(len(trees) / tiles)
+
+            # neighbours already found are ignored, allocations of the worker processes are not traced
+            missing_trees, record = stage(name, lambda: find_missing_trees_tiled(
+                trees, trees_polygon, get_process_pool(), tile_trees
+            ))
+            record['tiles'] = tiles
+
+            record['recall'], record['precision'] = score(orchard, missing_trees)
+            record['found'] = len(missing_trees)
+            record['matches_single_tile'] = missing_trees == results['offset']
+            yield record
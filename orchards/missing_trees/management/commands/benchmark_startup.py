@@ -0,0 +1,156 @@
+import json
+import os
+import subprocess
+import sys
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from missing_trees.actions import DEFAULT_ENGINE, ENGINES
+
+
+# packages reported as loaded or not after each phase, they are imported on first use
+HEAVY_PACKAGES = ('plotly', 'pandas', 'sklearn', 'scipy')
+
+# runs in a fresh interpreter started with -X importtime, phases are marked on stderr between the import times
+WORKER = '''
+import json, os, sys, time
+
+def rss_bytes():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+phases = []
+
+def phase(name, start):
+    phases.append({
+        'phase': name, 'seconds': time.perf_counter() - start, 'rss_bytes': rss_bytes(),
+        'loaded': [package for package in HEAVY_PACKAGES if package in sys.modules],
+    })
+    print(f'#phase {name}', file=sys.stderr, flush=True)
+
+start = time.perf_counter()
+
+# what a uwsgi worker holds before its first request, the url patterns load the views
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+
+from django.urls import get_resolver
+get_resolver().url_patterns
+
+phase('boot', start)
+
+if SIZE:
+    from django.test.utils import override_settings
+    from missing_trees.actions import ENGINES, NEIGHBOUR_ENGINES
+    from missing_trees.setup import initialise_data, setup_dataframe
+    from missing_trees.synthetic import generate_orchard
+
+    trees = initialise_data(generate_orchard('grid', SIZE).payload)
+
+    start = time.perf_counter()
+    with override_settings(ORCHARD_STORE_DIR=None):
+        ENGINES[ENGINE](*setup_dataframe('', trees, ENGINE in NEIGHBOUR_ENGINES))
+
+    phase('first_request', start)
+
+print(json.dumps(phases))
+'''
+
+
+def package_import_times(stderr):
+    '''
+    Parses the -X importtime report of the worker
+
+    Returns:
+      list: per phase, seconds spent importing each top level package - {'django': 0.1}
+    '''
+    phases = [defaultdict(float)]
+
+    for line in stderr.splitlines():
+        if line.startswith('#phase'):
+            phases.append(defaultdict(float))
+            continue
+
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        own, _, name = line[len('import time:'):].split('|')
+        phases[-1][name.strip().split('.')[0]] += int(own) / 1e6
+
+    return phases
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks the startup of a web worker in fresh interpreters: import time and resident memory '
+        'after boot and after the first missing trees request'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=3, help='fresh interpreters started, the median is reported')
+        parser.add_argument(
+            '--size', type=int, default=1000, help='trees of the synthetic orchard of the first request, 0 skips it'
+        )
+        parser.add_argument('--engine', choices=list(ENGINES), default=DEFAULT_ENGINE)
+        parser.add_argument('--imports', type=int, default=8, help='slowest packages listed per phase')
+        parser.add_argument('--json', help='also write the results to this file')
+
+    def run_worker(self, size, engine):
+        '''
+        Returns:
+          list: seconds, rss_bytes, loaded heavy packages and package import times of every phase
+        '''
+        # overridden settings, e.g. in tests, do not know their module
+        environment = dict(os.environ)
+        environment['DJANGO_SETTINGS_MODULE'] = settings.SETTINGS_MODULE or os.environ['DJANGO_SETTINGS_MODULE']
+        environment['PYTHONPATH'] = os.pathsep.join(filter(None, (str(settings.BASE_DIR), environment.get('PYTHONPATH'))))
+
+        source = f'HEAVY_PACKAGES = {HEAVY_PACKAGES!r}\nSIZE = {size!r}\nENGINE = {engine!r}\n' + WORKER
+
+        worker = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', source],
+            cwd=settings.BASE_DIR, env=environment, capture_output=True, text=True
+        )
+
+        if worker.returncode != 0:
+            raise RuntimeError(worker.stderr.strip().splitlines()[-1])
+
+        phases = json.loads(worker.stdout.strip().splitlines()[-1])
+
+        for record, imports in zip(phases, package_import_times(worker.stderr)):
+            record['imports'] = dict(imports)
+
+        return phases
+
+    def handle(self, *args, **options):
+        runs = [self.run_worker(options['size'], options['engine']) for _ in range(max(options['runs'], 1))]
+
+        records = []
+
+        for index, record in enumerate(runs[0]):
+            phases = sorted((run[index] for run in runs), key=lambda run: run['seconds'])
+            median = phases[len(phases) // 2]
+
+            records.append(median)
+
+            self.stdout.write(
+                f'{median["phase"]:<14} {median["seconds"]:>8.3f}s {median["rss_bytes"] / 1e6:>8.1f} MB rss  '
+                f'loaded: {", ".join(median["loaded"]) or "-"}'
+            )
+
+            slowest = sorted(median['imports'].items(), key=lambda item: item[1], reverse=True)
+            for package, seconds in slowest[:options['imports']]:
+                self.stdout.write(f'    {package:<24} {seconds:>8.3f}s')
+
+        if options['json']:
+            with open(options['json'], 'w') as file:
+                json.dump(records, file, indent=2)
@@ -0,0 +1,44 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from missing_trees.jobs import work
+
+
+class Command(BaseCommand):
+    help = 'Runs queued missing trees jobs, see missing_trees.jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.JOB_WORKERS, help='jobs run at the same time')
+        parser.add_argument('--once', action='store_true', help='stop once the queue is empty')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+
+        def shutdown(signum, frame):
+            stop.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        counts = []
+
+        def worker():
+            counts.append(work(stop, options['once']))
+
+        threads = [
+            threading.Thread(target=worker, name=f'missing-trees-job-{index}')
+            for index in range(max(options['workers'], 1))
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        # join with a timeout so signals are handled while waiting
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=0.5)
+
+        self.stdout.write(f'Ran {sum(counts)} jobs')
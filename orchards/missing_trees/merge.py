@@ -0,0 +1,118 @@
+import numpy as np
+
+from django.conf import settings
+
+from utils import metrics
+from utils.helper import CellGrid, to_local_plane
+
+
+def close_pairs(x, y, radius):
+    '''
+    Finds every pair of points within radius of each other with a spatial hash: points are put in grid
+    cells radius wide, and only the points of the same and the neighbouring cells are compared
+
+    Parameters:
+      - x: array - x values in meters, see to_local_plane
+      - y: array - y values in meters, see to_local_plane
+      - radius: float - in meters
+
+    Returns:
+      array: first point of every pair
+      array: second point of every pair
+    '''
+    grid = CellGrid(np.floor(x / radius).astype(np.int64), np.floor(y / radius).astype(np.int64))
+
+    first, second = [], []
+
+    # the cell itself and half of the cells around it, the other half is found from the other side
+    for offset in grid.around(half=True):
+        # searched in the order of the keys, so the search walks the sorted keys once
+        others, counts = grid.points_in(grid.sorted_keys + offset)
+        points = np.repeat(grid.order, counts)
+
+        keep = (x[points] - x[others]) ** 2 + (y[points] - y[others]) ** 2 <= radius ** 2
+        if offset == 0:
+            keep &= points < others
+
+        first.append(points[keep])
+        second.append(others[keep])
+
+    return np.concatenate(first), np.concatenate(second)
+
+
+def clusters(size, first, second):
+    '''
+    Joins points linked by a pair into clusters
+
+    Returns:
+      array: cluster of every point, the first point of the cluster
+    '''
+    labels = np.arange(size)
+
+    while True:
+        low = np.minimum(labels[first], labels[second])
+
+        joined = labels.copy()
+        np.minimum.at(joined, first, low)
+        np.minimum.at(joined, second, low)
+
+        # every point follows its cluster to the cluster of that point
+        joined = joined[joined]
+
+        if (joined == labels).all():
+            return labels
+
+        labels = joined
+
+
+def merge_points(parents, lat, lon, radius=None, origin=None):
+    '''
+    Merges missing points closer than radius to each other, directly or through other points, into one
+    point at their centre. Neighbouring trees often find the same gap, each of them supports the point
+
+    Parameters:
+      - parents: array - row of the tree each point was found next to
+      - lat: array - latitude values
+      - lon: array - longitude values
+      - radius: float - in meters, default=None uses MERGE_RADIUS
+      - origin: tuple - (lat, lon) of the plane the distances are measured on, default=None the centre of the points
+
+    Returns:
+      array: latitude values of the merged points, in the order they were first found
+      array: longitude values of the merged points
+      array: number of trees that found every merged point - support
+    '''
+    radius = settings.MERGE_RADIUS if radius is None else radius
+
+    if len(lat) == 0:
+        return lat, lon, np.zeros(0, dtype=np.int64)
+
+    with metrics.stage('merge'):
+        x, y, _ = to_local_plane(lat, lon, origin)
+
+        labels = clusters(len(lat), *close_pairs(x, y, radius))
+
+        # clusters numbered in the order of their first point
+        first_points, cluster = np.unique(labels, return_inverse=True)
+        size = np.bincount(cluster)
+
+        merged_lat = np.bincount(cluster, lat) / size
+        merged_lon = np.bincount(cluster, lon) / size
+
+        # a tree finding the same point twice supports it once
+        trees = int(parents.max()) + 1
+        support = np.bincount(np.unique(cluster * trees + parents) // trees, minlength=len(first_points))
+
+    metrics.count('merged', len(lat) - len(first_points))
+
+    return merged_lat, merged_lon, support
+
+
+def as_missing_trees(lat, lon, support):
+    '''
+    Returns:
+      list: potentially missing trees - [{'lat': lat1, 'lng': lat22, 'support': 1}]
+    '''
+    return [
+        {'lat': lat, 'lng': lon, 'support': support} for lat, lon, support in zip(lat.tolist(), lon.tolist(), support.tolist())
+    ]
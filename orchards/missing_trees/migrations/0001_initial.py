@@ -0,0 +1,29 @@
+# Generated by Django 3.2 on 2026-10-18 14:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MissingTreesResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orchard_id', models.BigIntegerField()),
+                ('survey_hash', models.CharField(max_length=64)),
+                ('tree_count', models.PositiveIntegerField(default=0)),
+                ('missing_trees', models.JSONField(default=list)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='missingtreesresult',
+            constraint=models.UniqueConstraint(fields=('orchard_id', 'survey_hash'), name='unique_orchard_survey_hash'),
+        ),
+    ]
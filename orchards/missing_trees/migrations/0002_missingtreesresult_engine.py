@@ -0,0 +1,26 @@
+# Generated by Django 3.2 on 2026-10-18 14:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('missing_trees', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='missingtreesresult',
+            name='unique_orchard_survey_hash',
+        ),
+        migrations.AddField(
+            model_name='missingtreesresult',
+            name='engine',
+            field=models.CharField(default='offset', max_length=32),
+        ),
+        migrations.AddConstraint(
+            model_name='missingtreesresult',
+            constraint=models.UniqueConstraint(fields=('orchard_id', 'survey_hash', 'engine'), name='unique_orchard_survey_hash_engine'),
+        ),
+    ]
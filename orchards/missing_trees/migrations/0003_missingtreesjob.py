@@ -0,0 +1,39 @@
+# Generated by Django 3.2 on 2026-10-18 14:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('missing_trees', '0002_missingtreesresult_engine'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MissingTreesJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('orchard_id', models.BigIntegerField()),
+                ('engine', models.CharField(default='offset', max_length=32)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('detail', models.TextField(blank=True, default='')),
+                ('available_at', models.DateTimeField()),
+                ('leased_until', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('result', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='missing_trees.missingtreesresult')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='missingtreesjob',
+            index=models.Index(fields=['status', 'available_at'], name='missing_trees_job_queue'),
+        ),
+        migrations.AddConstraint(
+            model_name='missingtreesjob',
+            constraint=models.UniqueConstraint(condition=models.Q(status__in=['queued', 'running']), fields=('orchard_id', 'engine'), name='unique_active_orchard_engine_job'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('missing_trees', '0003_missingtreesjob'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='missingtreesresult',
+            name='unique_orchard_survey_hash_engine',
+        ),
+        # results stored before have points without support
+        migrations.AddField(
+            model_name='missingtreesresult',
+            name='version',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AlterField(
+            model_name='missingtreesresult',
+            name='version',
+            field=models.PositiveSmallIntegerField(default=2),
+        ),
+        migrations.AddConstraint(
+            model_name='missingtreesresult',
+            constraint=models.UniqueConstraint(fields=('orchard_id', 'survey_hash', 'engine', 'version'), name='unique_orchard_survey_hash_engine_version'),
+        ),
+    ]
@@ -1,3 +1,80 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+# bump when the points of missing_trees change shape, results stored before are then computed again
+RESULT_VERSION = 2
+
+
+class MissingTreesResult(models.Model):
+    '''
+    Missing trees found for an orchard survey. 
+    
+    Results are keyed by a hash of the surveyed tree coordinates (see setup.survey_hash), 
+    the engine that found them and the version of their format, so they are only reused while 
+    the survey stays the same
+    '''
+
+    orchard_id = models.BigIntegerField()
+    survey_hash = models.CharField(max_length=64)
+    engine = models.CharField(max_length=32, default='offset')
+    version = models.PositiveSmallIntegerField(default=RESULT_VERSION)
+    tree_count = models.PositiveIntegerField(default=0)
+    missing_trees = models.JSONField(default=list)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['orchard_id', 'survey_hash', 'engine', 'version'], name='unique_orchard_survey_hash_engine_version'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.orchard_id} - {self.survey_hash[:12]} ({self.engine} v{self.version})'
+
+
+class MissingTreesJob(models.Model):
+    '''
+    Missing trees computation queued for the job workers, see jobs.py.
+
+    Only one job per orchard and engine can be queued or running at a time, submitting 
+    the same orchard again returns that job
+    '''
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUSES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    orchard_id = models.BigIntegerField()
+    engine = models.CharField(max_length=32, default='offset')
+    status = models.CharField(max_length=16, choices=STATUSES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    detail = models.TextField(blank=True, default='')
+    result = models.ForeignKey(MissingTreesResult, null=True, blank=True, on_delete=models.SET_NULL)
+
+    # a queued job runs once available, a running job is taken over by another worker once its lease ends
+    available_at = models.DateTimeField()
+    leased_until = models.DateTimeField(null=True, blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['orchard_id', 'engine'], condition=models.Q(status__in=['queued', 'running']),
+                name='unique_active_orchard_engine_job'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='missing_trees_job_queue'),
+        ]
+
+    def __str__(self):
+        return f'{self.orchard_id} ({self.engine}) - {self.status}'
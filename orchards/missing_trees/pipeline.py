@@ -0,0 +1,242 @@
+import multiprocessing
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from shapely.geometry import Polygon
+
+from missing_trees.actions import DEFAULT_ENGINE, NEIGHBOUR_ENGINES, get_engine
+from missing_trees.delta import find_missing_trees_delta
+from missing_trees.models import RESULT_VERSION, MissingTreesResult
+from missing_trees.setup import fetch_trees, setup_dataframe, survey_hash
+from missing_trees.tiles import find_missing_trees_tiled
+from orchards import worker
+from utils import metrics
+from utils.helper import get_value
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+# settings read by the detection, the pool processes take them from the process that created the pool
+WORKER_SETTINGS = (
+    'DELTA_MAX_CHANGES', 'MERGE_RADIUS', 'ORCHARD_STORE_DIR', 'ORCHARD_STORE_MAX_ENTRIES',
+    'TILE_HALO', 'TILE_MIN_TREES', 'TILE_TREES',
+)
+
+
+def get_stored_result(orchard_id, digest, engine=DEFAULT_ENGINE):
+    '''
+    Returns:
+      list: missing trees already computed for the survey by engine in the current format, or None
+    '''
+    result = MissingTreesResult.objects.filter(
+        orchard_id=orchard_id, survey_hash=digest, engine=engine, version=RESULT_VERSION
+    ).only('missing_trees').first()
+
+    return None if result is None else result.missing_trees
+
+
+def store_result(orchard_id, digest, tree_count, missing_trees, engine=DEFAULT_ENGINE):
+    '''
+    Stores missing trees computed for a survey. Workers computing the same survey at the same time keep the first result
+
+    Returns:
+      MissingTreesResult: stored result
+    '''
+    result, _ = MissingTreesResult.objects.get_or_create(
+        orchard_id=orchard_id, survey_hash=digest, engine=engine, version=RESULT_VERSION,
+        defaults={'tree_count': tree_count, 'missing_trees': missing_trees}
+    )
+
+    return result
+
+
+def use_tiles(trees, engine=DEFAULT_ENGINE):
+    '''
+    Returns:
+      bool: true when the offset detection of the trees is split into tiles, see tiles
+    '''
+    return engine == 'offset' and settings.TILE_MIN_TREES is not None and len(trees) >= settings.TILE_MIN_TREES
+
+
+def use_delta(orchard_id, engine=DEFAULT_ENGINE):
+    '''
+    Returns:
+      bool: true when the offset detection of the orchard reuses its last survey, see delta
+    '''
+    return (
+        engine == 'offset' and settings.DELTA_MAX_CHANGES is not None and bool(settings.ORCHARD_STORE_DIR)
+        and str(orchard_id).isdigit()
+    )
+
+
+def compute_missing_trees(orchard_id, trees, engine=DEFAULT_ENGINE, save=True):
+    '''
+    Runs the detection on a fetched survey. Does not touch the database.
+
+    Large orchards are split into tiles run on the process pool, see use_tiles. Inside a pool 
+    worker the tiles run one after the other, a worker cannot use the pool of its parent.
+    A survey close to the last survey of the orchard only detects the trees that changed, see use_delta
+
+    Parameters:
+      - orchard_id: int - orchard the survey belongs to
+      - trees: Trees - trees returned by fetch_trees
+      - engine: str - detection engine, see actions.ENGINES
+      - save: bool - record the survey as the last one of the orchard, see use_delta, default=true
+
+    Returns:
+      list: potentially missing trees - [{'lat': lat1, 'lng': lat22, 'support': 1}]
+    '''
+    find_missing_trees = get_engine(engine)
+
+    delta = use_delta(orchard_id, engine)
+
+    if delta or use_tiles(trees, engine):
+        with metrics.stage('polygon'):
+            trees_polygon = Polygon(trees.lng_lat())
+
+        executor = get_process_pool() if multiprocessing.parent_process() is None else None
+
+        with metrics.stage('detect'):
+            try:
+                if delta:
+                    return find_missing_trees_delta(orchard_id, trees, trees_polygon, executor, save)
+
+                return find_missing_trees_tiled(trees, trees_polygon, executor)
+            except BrokenProcessPool:
+                _reset_process_pool()
+                raise
+
+    with metrics.stage('setup'):
+        trees, trees_polygon = setup_dataframe(orchard_id, trees, engine in NEIGHBOUR_ENGINES)
+
+    with metrics.stage('detect'):
+        return find_missing_trees(trees, trees_polygon)
+
+
+def get_process_pool():
+    '''
+    Returns the pool of worker processes used to compute many orchards at once, created on first use.
+
+    Workers are started from a fork server, or spawned where there is none, never forked from the 
+    calling process: its api, cache and database threads could hold locks a forked copy never releases.
+    Every worker sets up django once, see orchards.worker
+
+    Returns:
+      ProcessPoolExecutor: pool with BATCH_WORKERS processes
+    '''
+    global _process_pool
+
+    with _process_pool_lock:
+        if _process_pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+            _process_pool = ProcessPoolExecutor(
+                max_workers=settings.BATCH_WORKERS, mp_context=context,
+                initializer=worker.setup, initargs=({name: getattr(settings, name) for name in WORKER_SETTINGS},)
+            )
+
+        return _process_pool
+
+
+def _reset_process_pool():
+    global _process_pool
+
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False)
+        _process_pool = None
+
+
+def _settings_changed(setting, **kwargs):
+    # the pool processes keep the settings they started with, see override_settings
+    if setting in WORKER_SETTINGS or setting == 'BATCH_WORKERS':
+        _reset_process_pool()
+
+
+setting_changed.connect(_settings_changed, dispatch_uid='missing_trees.pipeline.process_pool')
+
+
+def compute_batch(orchard_ids, engine=DEFAULT_ENGINE):
+    '''
+    Finds missing trees for many orchards. Surveys are fetched concurrently, stored results are reused
+    and the remaining orchards are computed in parallel on the process pool. 
+    
+    A failing orchard is reported in errors and does not stop the others
+
+    Parameters:
+      - orchard_ids: list - orchard ids
+      - engine: str - detection engine, see actions.ENGINES
+
+    Returns:
+      dict: missing trees per orchard id - {orchard_id: [{'lat': lat1, 'lng': lat22, 'support': 1}]}
+      dict: error message per orchard id - {orchard_id: detail}
+    '''
+    get_engine(engine)
+
+    results = {}
+    errors = {}
+
+    base_endpoint = get_value('BASE_ENDPOINT')
+    api_token = get_value('API_TOKEN')
+
+    def fetch(orchard_id):
+        trees = fetch_trees(orchard_id, base_endpoint=base_endpoint, api_token=api_token)
+        metrics.count('trees', len(trees))
+        return trees
+
+    surveys = {}
+    with metrics.stage('fetch'):
+        with ThreadPoolExecutor(max_workers=min(settings.API_PAGE_WORKERS, len(orchard_ids)) or 1) as executor:
+            futures = {orchard_id: executor.submit(metrics.propagate(fetch), orchard_id) for orchard_id in orchard_ids}
+
+            for orchard_id, future in futures.items():
+                try:
+                    surveys[orchard_id] = future.result()
+                except Exception as e:
+                    errors[orchard_id] = str(e)
+
+    pending = {}
+    for orchard_id, trees in surveys.items():
+        digest = survey_hash(trees)
+
+        with metrics.stage('lookup'):
+            missing_trees = get_stored_result(orchard_id, digest, engine)
+
+        if missing_trees is None:
+            pending[orchard_id] = (digest, trees)
+        else:
+            results[orchard_id] = missing_trees
+
+    # stages inside the worker processes are not timed, only the time waiting on them
+    if pending:
+        pool = get_process_pool()
+        futures = {
+            orchard_id: pool.submit(compute_missing_trees, orchard_id, trees, engine)
+            for orchard_id, (digest, trees) in pending.items()
+        }
+
+        for orchard_id, future in futures.items():
+            digest, trees = pending[orchard_id]
+
+            try:
+                with metrics.stage('compute'):
+                    missing_trees = future.result()
+            except BrokenProcessPool as e:
+                # a worker died, start with a fresh pool on the next batch
+                _reset_process_pool()
+                errors[orchard_id] = str(e) or 'Worker process stopped unexpectedly'
+                continue
+            except Exception as e:
+                errors[orchard_id] = str(e)
+                continue
+
+            store_result(orchard_id, digest, len(trees), missing_trees, engine)
+            results[orchard_id] = missing_trees
+
+    return results, errors
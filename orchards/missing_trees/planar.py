@@ -0,0 +1,118 @@
+import numpy as np
+
+from missing_trees.lattice import fit_lattice
+from missing_trees.merge import as_missing_trees, merge_points
+from utils import metrics
+from utils.helper import from_local_plane, to_local_plane
+
+
+# parent + 24 neighbours, a 5 x 5 square rather than the 3 x 3 of setup.NEIGHBOURS, so the next tree
+# of a row is found across a gap of two trees
+ROW_NEIGHBOURS = 25
+
+# a neighbour is on the row of a tree when it lies within about 14 degrees of the row, like lattice._axis_spacing
+ROW_SLOPE = 0.25
+
+
+def row_gaps(x, y, angle, tree_spacing, neighbours):
+    '''
+    Finds the gaps between every tree and the next tree of its row, along the row direction.
+    Only the next tree on one side is used, so every gap is found once
+
+    Parameters:
+      - x: array - x values in meters, see to_local_plane
+      - y: array - y values in meters, see to_local_plane
+      - angle: float - angle of the rows from the x axis, in radians, see fit_lattice
+      - tree_spacing: float - space between trees in a row, in meters
+      - neighbours: array - (trees, k) rows of the nearest neighbours of every tree, itself excluded
+
+    Returns:
+      array: row of the tree before every gap
+      array: row of the tree after every gap
+      array: number of trees missing in every gap
+    '''
+    dx = x[neighbours] - x[:, None]
+    dy = y[neighbours] - y[:, None]
+
+    along = dx * np.cos(angle) + dy * np.sin(angle)
+    across = -dx * np.sin(angle) + dy * np.cos(angle)
+
+    # bearing of every neighbour relative to the row, only the ones ahead on the row count
+    ahead = np.where((along > 0) & (np.abs(across) < ROW_SLOPE * along), along, np.inf)
+    nearest = ahead.argmin(axis=1)
+    gap = ahead[np.arange(len(x)), nearest]
+
+    missing = np.zeros(len(x), dtype=np.int64)
+    finite = np.isfinite(gap)
+    missing[finite] = np.maximum(np.rint(gap[finite] / tree_spacing).astype(np.int64) - 1, 0)
+
+    before = np.flatnonzero(missing)
+
+    return before, neighbours[before, nearest[before]], missing[before]
+
+
+def find_missing_trees_planar(trees, trees_polygon):
+    '''
+    Finds potentially missing trees in the gaps between consecutive trees of a row.
+
+    - projects the trees once onto a plane in meters, see to_local_plane
+    - fits the row orientation and spacing, see fit_lattice
+    - one KD-tree query finds the nearest neighbours of every tree
+    - the next tree of its row is the nearest neighbour ahead along the row, a gap of more than
+      one and a half tree spacings is missing trees, spread evenly between the two trees
+    - points with a tree within half a tree spacing are dropped, the others are merged like
+      find_missing_trees, each supported by the tree before its gap
+
+    Everything runs as vectorized planar arithmetic in meters, coordinates are only converted back
+    for the response. Points between two trees lie inside the orchard, so the polygon is not needed
+
+    Parameters:
+      - trees: Trees - ids and coordinates of the trees, neighbours are not needed
+      - trees_polygon: Polygon - bounds of the trees
+
+    Returns:
+      list: potentially missing trees - [{'lat': lat1, 'lng': lat22, 'support': 1}]
+    '''
+    if len(trees) < 3:
+        return []
+
+    with metrics.stage('projection'):
+        x, y, origin = to_local_plane(trees.lat, trees.lng)
+
+    with metrics.stage('lattice_fit'):
+        angle, tree_spacing, _ = fit_lattice(x, y)
+
+    if not tree_spacing:
+        return []
+
+    from sklearn.neighbors import KDTree
+
+    points = np.column_stack((x, y))
+
+    with metrics.stage('kdtree_query'):
+        kd_tree = KDTree(points)
+        _, neighbours = kd_tree.query(points, k=min(ROW_NEIGHBOURS, len(points)))
+
+    with metrics.stage('candidates'):
+        before, after, missing = row_gaps(x, y, angle, tree_spacing, neighbours[:, 1:])
+
+        # step of every missing tree within its gap, 1 to missing
+        gaps = np.repeat(np.arange(len(before)), missing)
+        steps = np.arange(len(gaps)) - np.repeat(np.cumsum(missing) - missing, missing) + 1
+        fraction = steps / (missing[gaps] + 1)
+
+        candidate_x = x[before[gaps]] + fraction * (x[after[gaps]] - x[before[gaps]])
+        candidate_y = y[before[gaps]] + fraction * (y[after[gaps]] - y[before[gaps]])
+
+    metrics.count('candidates', len(gaps))
+
+    if len(gaps) == 0:
+        return []
+
+    with metrics.stage('verify'):
+        distances, _ = kd_tree.query(np.column_stack((candidate_x, candidate_y)), k=1)
+        keep = distances[:, 0] > 0.5 * tree_spacing
+
+    lat, lon = from_local_plane(candidate_x[keep], candidate_y[keep], origin)
+
+    return as_missing_trees(*merge_points(before[gaps][keep], lat, lon, origin=origin))
@@ -1,18 +1,33 @@
 
 
-import pandas as pd
 import numpy as np
-import requests, json
+import hashlib
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from collections import defaultdict
 
 from shapely.geometry import Polygon
 
-from sklearn.neighbors import BallTree
+from missing_trees.store import load_trees, save_trees
+from missing_trees.trees import GrowableArray, Trees
+from utils import client, jsonstream, metrics
+from utils.cache import TTLCache
+from utils.helper import EARTH_RADIUS_IN_KM, get_value
 
-from missing_trees.actions import draw
-from utils.helper import get_value
+
+# parent + 8 neighbours searched for every tree, by the offset engine and the lattice fit
+NEIGHBOURS = 9
+
+# extra neighbours queried to break ties at the last neighbour, see _break_ties
+TIE_NEIGHBOURS = 3
+
+# parsed tree surveys per orchard
+survey_cache = TTLCache(
+    ttl=settings.SURVEY_CACHE_TTL,
+    max_entries=settings.SURVEY_CACHE_MAX_ENTRIES,
+    alias=settings.SURVEY_CACHE_ALIAS,
+    prefix='treesurvey:',
+)
 
 
 def initialise_data(data):
@@ -23,57 +38,102 @@ def initialise_data(data):
       - data: json data with coordinate information
 
     Returns:
-      list: list of tree ids - trees
-      list: list of latitude values - lat_trees
-      list: list of longitude values - lon_trees
-      list: list of tuples latlng values (longitude, latitude) - lat_lng_trees
-      dict: dictionary of points with their id as the key, i.e {id: {'lat': val1, 'lng': val2}} - trees_dictionary
+      Trees: ids and coordinates of the trees as contiguous arrays
     '''
-    
-    trees_dictionary = defaultdict(dict)
-
-    trees = []
-    lat_trees = []
-    lon_trees = []
-    lat_lng_trees = []
 
     try:
-        for tree in data['results']:
-            trees.append(tree['id'])
-            lat_trees.append(tree['latitude'])
-            lon_trees.append(tree['longitude'])
-            lat_lng_trees.append((tree['longitude'], tree['latitude']))
-
-            trees_dictionary[tree['id']].update({"lat": tree['latitude'], "lng": tree['longitude']})
-        
-        return json.dumps(trees_dictionary), trees, lat_trees, lon_trees, lat_lng_trees
+        results = data['results']
+
+        return Trees(
+            ids=np.fromiter((tree['id'] for tree in results), dtype=np.int64, count=len(results)),
+            lat=np.fromiter((tree['latitude'] for tree in results), dtype=np.float64, count=len(results)),
+            lng=np.fromiter((tree['longitude'] for tree in results), dtype=np.float64, count=len(results)),
+        )
     except Exception as e:
         raise ValidationError(e)
 
 
-def setup_dataframe(orchard_id='', draw_tree=False):
+# trees decoded before they are copied to the numeric arrays, see initialise_stream
+STREAM_BLOCK_SIZE = 4096
+
+
+def initialise_stream(chunks):
     '''
-    Setup dataframe using tree data. The dataframe sets 
-    
-    - gets nearest trees nearest_distances with their distance for each tree
-    - latitude and longitude coordinates
-    - creates a longitude list ranging between (lon-0.00005, lon+0.00005) 
-    - search for lat and lon through created ranges
+    Initialise data from one page of the api response while it is downloaded.
+
+    The results array is decoded one tree at a time and the ids and coordinates are appended 
+    straight to numeric arrays, so memory stays proportional to the coordinates rather than
+    to the json text and its python objects
+
+    Parameters:
+      - chunks: iterable - bytes of a treesurveys page, see client.get_stream
+
+    Returns:
+      Trees: ids and coordinates of the trees of the page
+      dict: other fields of the page, i.e count and next
+    '''
+    ids = GrowableArray(np.int64)
+    lat = GrowableArray(np.float64)
+    lng = GrowableArray(np.float64)
+
+    fields = {}
+
+    # trees are moved to the arrays in blocks, copying one value at a time into numpy is slow
+    block = []
+
+    def flush():
+        ids.extend([tree['id'] for tree in block])
+        lat.extend([tree['latitude'] for tree in block])
+        lng.extend([tree['longitude'] for tree in block])
+        block.clear()
+
+    for key, value in jsonstream.iter_object(chunks, 'results'):
+        if key != 'results':
+            fields[key] = value
+            continue
+
+        if len(ids) == 0 and len(block) == 0 and not fields.get('next') and isinstance(fields.get('count'), int):
+            # a single page holds every tree, count is usually sent before the results
+            for values in (ids, lat, lng):
+                values.reserve(fields['count'])
+
+        block.append(value)
+
+        if len(block) == STREAM_BLOCK_SIZE:
+            flush()
+
+    flush()
+
+    return Trees(ids=ids.array(), lat=lat.array(), lng=lng.array()), fields
+
+
+def fetch_trees(orchard_id='', base_endpoint=None, api_token=None):
+    '''
+    Fetches the tree survey of an orchard and initialises its data.
+
+    Results are cached per orchard for SURVEY_CACHE_TTL seconds so repeat requests 
+    do not call the api again
 
     Parameters:
-      - orchard_id: int - draw tree, default=false 
-      - draw_tree: bool - draw tree, default=false 
+      - orchard_id: int - orchard to fetch
+      - base_endpoint: str - api url, default=None reads BASE_ENDPOINT from settings
+      - api_token: str - api token, default=None reads API_TOKEN from settings
 
     Returns:
-      dict: trees_dictionary - dictionary of points
-      list: trees_polygon
-      dataframe: pandas dataframe
+      Trees: see initialise_data
     '''
 
+    cached = survey_cache.get(orchard_id)
+    if cached is not None:
+        return cached
+
     try:
         # call api
-        URL = f'{get_value("BASE_ENDPOINT")}treesurveys/?survey__orchard_id={orchard_id}'
-        API_TOKEN = get_value("API_TOKEN")
+        if base_endpoint is None:
+            base_endpoint = get_value("BASE_ENDPOINT")
+
+        URL = f'{base_endpoint}treesurveys/?survey__orchard_id={orchard_id}'
+        API_TOKEN = get_value("API_TOKEN") if api_token is None else api_token
 
         if len(URL) == 0:
             raise ValidationError('BASE_ENDPOINT URL is empty')
@@ -81,33 +141,138 @@ def setup_dataframe(orchard_id='', draw_tree=False):
         if len(API_TOKEN) == 0:
             raise ValidationError('API_TOKEN is empty')
 
-        headers = {'Content-Type':'application/json', 'Authorization': f'{API_TOKEN}'}
-        response = requests.get(URL, timeout=5, headers=headers)
-
-        if response.status_code != 200:
-            raise ValidationError(str(response.text))
-
-        data = json.loads(response.content)
+        # large orchards are paginated, pages are fetched concurrently over pooled connections
+        # and parsed while they are downloaded
+        pages = client.get_paginated_stream(URL, initialise_stream, headers=client.api_headers(API_TOKEN))
 
-        trees_dictionary, trees, lat_trees, lon_trees, lat_lng_trees = initialise_data(data)
+        trees = Trees.concatenate(pages)
 
     except Exception as e:
         if 'Expecting value: line' in str(e):
             e = 'Probaly your API Token or BASE_ENDPOINT url is incorrect - {}'.format(e)
             
         raise ValidationError(e)
+
+    survey_cache.set(orchard_id, trees)
+
+    return trees
+
+
+def survey_hash(trees):
+    '''
+    Hashes the ids and coordinates of a tree survey. The hash only changes when a tree is 
+    added, removed or moved, so it identifies results computed from the same survey
+
+    Parameters:
+      - trees: Trees - see initialise_data
+
+    Returns:
+      str: sha256 hex digest
+    '''
+    digest = hashlib.sha256()
+    digest.update(trees.ids.tobytes())
+    digest.update(trees.lat.tobytes())
+    digest.update(trees.lng.tobytes())
+
+    return digest.hexdigest()
+
+
+def setup_dataframe(orchard_id='', trees=None, neighbours=True):
+    '''
+    Setup the nearest neighbours of every tree. 
     
-    trees_polygon = Polygon(lat_lng_trees)
+    - gets nearest trees with their distance for each tree
+    - builds the polygon bounding the trees
+
+    The neighbours of a survey are kept in the orchard store, so workers that already
+    computed them, or any other worker on the same host, map them from disk instead
+
+    Parameters:
+      - orchard_id: int - orchard id
+      - trees: Trees - trees already returned by fetch_trees, default=None fetches them
+      - neighbours: bool - find the nearest neighbours, false for engines that search their own, default=true
+
+    Returns:
+      Trees: trees with their neighbours and distances
+      Polygon: trees_polygon
+    '''
+
+    if trees is None:
+        trees = fetch_trees(orchard_id)
+
+    with metrics.stage('polygon'):
+        trees_polygon = Polygon(trees.lng_lat())
+
+    digest = survey_hash(trees)
+
+    if not neighbours:
+        return trees, trees_polygon
+
+    with metrics.stage('store_load'):
+        stored = load_trees(digest)
+
+    if stored is not None:
+        return stored, trees_polygon
+
+    trees = nearest_neighbours(trees)
+
+    with metrics.stage('store_save'):
+        save_trees(digest, trees)
+
+    return trees, trees_polygon
+
+
+def _break_ties(ball_tree, lat_lng_rad, distances, neighbours, k):
+    '''
+    Keeps the k nearest of the neighbours returned by the BallTree, trees at the same distance
+    ordered by row. Which of several trees as far as the last neighbour is kept then does not depend 
+    on how the BallTree was built, so a tile of the orchard finds the same neighbours, see tiles
+
+    Returns:
+      array: distances of the k nearest neighbours
+      array: rows of the k nearest neighbours
+    '''
+    order = np.lexsort((neighbours, distances), axis=1)
+    distances = np.take_along_axis(distances, order, axis=1)
+    neighbours = np.take_along_axis(neighbours, order, axis=1)
+
+    # trees as far as the last neighbour may be left out when all the extra neighbours tie with it as well
+    incomplete = np.flatnonzero(distances[:, -1] == distances[:, k - 1]) if distances.shape[1] > k else []
+
+    for row in incomplete:
+        tied, tied_distances = ball_tree.query_radius(
+            lat_lng_rad[row:row + 1], r=distances[row, k - 1], return_distance=True
+        )
+        order = np.lexsort((tied[0], tied_distances[0]))[:k]
 
-    dataframe = pd.DataFrame()
-    dataframe['lat'] = lat_trees
-    dataframe['lon'] = lon_trees
-    dataframe['id'] = trees
+        distances[row, :k] = tied_distances[0][order]
+        neighbours[row, :k] = tied[0][order]
 
+    return distances[:, :k], neighbours[:, :k]
+
+
+def query_neighbours(trees, k=NEIGHBOURS, rows=None):
+    '''
+    Finds the nearest neighbours of some or all of the trees and their distance in kilometers
+
+    Parameters:
+      - trees: Trees - see initialise_data
+      - k: int - number of trees returned per tree, itself included, default=9
+      - rows: array - rows of the trees to find the neighbours of, default=None all the trees
+
+    Returns:
+      array: rows of the nearest neighbours of every tree, nearest first - neighbours
+      array: distances to those neighbours in kilometers - distances
+    '''
     # the formula requires rad instead of degree
-    dataframe[["lat_rad", "lon_rad"]] = np.deg2rad(dataframe[["lat", "lon"]])
+    lat_lng_rad = np.deg2rad(np.column_stack((trees.lat, trees.lng)))
+    query_rad = lat_lng_rad if rows is None else lat_lng_rad[rows]
 
-    ball_tree = BallTree(dataframe[["lat_rad", "lon_rad"]], metric="haversine")
+    # sklearn is loaded by the first survey missing from the orchard store, not when the worker starts
+    from sklearn.neighbors import BallTree
+
+    with metrics.stage('balltree_build'):
+        ball_tree = BallTree(lat_lng_rad, metric="haversine")
 
     '''
     because we assuming the data is in a grid, we using 9 as a square number 
@@ -120,36 +285,39 @@ def setup_dataframe(orchard_id='', draw_tree=False):
     neighbours_to_return = number of neighbours to return.
     '''
     neighbours_to_return = len(trees)
-    if neighbours_to_return >= 9:
-        neighbours_to_return = 9
+    if neighbours_to_return >= k:
+        neighbours_to_return = k
 
     # returns nearest neighbours and their distances
-    distances, neighbours = ball_tree.query(
-        dataframe[["lat_rad", "lon_rad"]],
-        k=neighbours_to_return,  # number of neighbours to return
-        return_distance=True,  # choose whether you also want to return the distance
-        sort_results=True,
-    )
+    with metrics.stage('balltree_query'):
+        distances, neighbours = ball_tree.query(
+            query_rad,
+            k=min(neighbours_to_return + TIE_NEIGHBOURS, len(trees)),  # number of neighbours to return
+            return_distance=True,  # choose whether you also want to return the distance
+            sort_results=True,
+        )
+
+        distances, neighbours = _break_ties(ball_tree, query_rad, distances, neighbours, neighbours_to_return)
 
     # remove the address/point itself from the arrays because it itself is its nearest neighbour and distance
-    neighbours = neighbours[:, 1:]
-    distances = distances[:, 1:]
+    neighbours = np.ascontiguousarray(neighbours[:, 1:], dtype=np.int64)
+    distances = np.ascontiguousarray(distances[:, 1:])
 
-    # factor in earth_radius_in_km to distances
-    earth_radius_in_km = 6371
-    dataframe["nearest_distances"] = [
-        d*earth_radius_in_km for d in distances
-    ]
+    # factor in the earth radius to get distances in kilometers
+    distances *= EARTH_RADIUS_IN_KM
 
-    # select the nearest addresses by position index
-    dataframe["nearest_neighbours"] = [
-        dataframe["id"].iloc[n].to_list() for n in neighbours
-    ]
+    return neighbours, distances
 
-    # pd.set_option('display.max_colwidth', None)
-    # print(dataframe)
 
-    if draw_tree:
-        draw(orchard_id, trees, lat_trees, lon_trees)
+def nearest_neighbours(trees, k=NEIGHBOURS):
+    '''
+    Finds the nearest neighbours of every tree and their distance in kilometers
+
+    Parameters:
+      - trees: Trees - see initialise_data
+      - k: int - number of trees returned per tree, itself included, default=9
 
-    return trees_dictionary, trees_polygon, dataframe
\ No newline at end of file
+    Returns:
+      Trees: trees with their neighbours and distances
+    '''
+    return trees.with_neighbours(*query_neighbours(trees, k))
@@ -0,0 +1,226 @@
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from django.conf import settings
+
+from missing_trees.trees import Trees
+
+
+# bump when the arrays or how they are computed change, older entries are then ignored
+VERSION = 2
+
+ARRAYS = ('ids', 'lat', 'lng', 'neighbours', 'distances')
+
+
+# verified missing points of a survey before containment, by parent row, see delta
+CANDIDATES = ('parents', 'lat', 'lng')
+
+
+def _directory():
+    directory = settings.ORCHARD_STORE_DIR
+    return os.path.join(directory, f'v{VERSION}') if directory else None
+
+
+def _latest_directory():
+    directory = settings.ORCHARD_STORE_DIR
+    return os.path.join(directory, f'v{VERSION}-latest') if directory else None
+
+
+def _write(path, write):
+    '''
+    Writes a file next to path and renames it into place, so readers never see a partial file
+
+    Returns:
+      bool: true when the file was written
+    '''
+    temporary = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.{uuid.uuid4().hex}')
+
+    try:
+        with open(temporary, 'wb') as file:
+            write(file)
+
+        os.replace(temporary, path)
+
+    except OSError:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        return False
+
+    return True
+
+
+def load_trees(digest):
+    '''
+    Opens the trees of a survey with their nearest neighbours from the orchard store.
+
+    The arrays are memory mapped read-only, so every worker reading the same survey shares one copy
+    in the page cache
+
+    Parameters:
+      - digest: str - survey hash, see setup.survey_hash
+
+    Returns:
+      Trees: trees with neighbours and distances, None when the survey is not stored or the store is disabled
+    '''
+    directory = _directory()
+    if directory is None:
+        return None
+
+    path = os.path.join(directory, digest)
+
+    try:
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in ARRAYS}
+    except (OSError, ValueError):
+        return None
+
+    size = len(arrays['ids'])
+    if any(len(values) != size for values in arrays.values()):
+        return None
+
+    return Trees(**arrays)
+
+
+def save_trees(digest, trees):
+    '''
+    Writes the trees of a survey with their nearest neighbours to the orchard store.
+
+    Arrays are written to a temporary directory that is renamed into place, so readers never see
+    a partial entry and the first of several workers storing the same survey wins
+
+    Parameters:
+      - digest: str - survey hash, see setup.survey_hash
+      - trees: Trees - trees with neighbours and distances, see setup_dataframe
+    '''
+    directory = _directory()
+    if directory is None:
+        return
+
+    path = os.path.join(directory, digest)
+    if os.path.isdir(path):
+        return
+
+    temporary = os.path.join(directory, f'.{digest}.{uuid.uuid4().hex}')
+
+    try:
+        os.makedirs(temporary)
+
+        for name in ARRAYS:
+            np.save(os.path.join(temporary, f'{name}.npy'), np.ascontiguousarray(getattr(trees, name)))
+
+        os.rename(temporary, path)
+
+    except OSError:
+        # stored by another worker in the meantime, or the store is not writable
+        shutil.rmtree(temporary, ignore_errors=True)
+        return
+
+    prune(directory)
+
+
+def load_candidates(digest):
+    '''
+    Returns:
+      tuple: (parents, lat, lng) verified missing points of a survey, None when they are not stored
+    '''
+    directory = _directory()
+    if directory is None:
+        return None
+
+    try:
+        with np.load(os.path.join(directory, digest, 'candidates.npz')) as arrays:
+            return tuple(arrays[name] for name in CANDIDATES)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_candidates(digest, parents, lat, lng):
+    '''
+    Adds the verified missing points of a survey to its entry, see delta. Nothing is written when 
+    the trees of the survey are not stored
+
+    Parameters:
+      - digest: str - survey hash, see setup.survey_hash
+      - parents: array - row of the tree each point was found next to, in the order they were found
+      - lat: array - latitude values of the points
+      - lng: array - longitude values of the points
+    '''
+    directory = _directory()
+    if directory is None or not os.path.isdir(os.path.join(directory, digest)):
+        return
+
+    _write(
+        os.path.join(directory, digest, 'candidates.npz'),
+        lambda file: np.savez(file, **dict(zip(CANDIDATES, (parents, lat, lng))))
+    )
+
+
+def load_latest(orchard_id):
+    '''
+    Returns:
+      str: survey hash of the survey of the orchard processed last on this host, or None
+    '''
+    directory = _latest_directory()
+    if directory is None:
+        return None
+
+    try:
+        with open(os.path.join(directory, str(int(orchard_id)))) as file:
+            return file.read().strip() or None
+    except (OSError, ValueError):
+        return None
+
+
+def save_latest(orchard_id, digest):
+    '''
+    Records the survey of the orchard processed last on this host, see load_latest
+    '''
+    directory = _latest_directory()
+    if directory is None:
+        return
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return
+
+    if _write(os.path.join(directory, str(int(orchard_id))), lambda file: file.write(digest.encode())):
+        prune(directory)
+
+
+def prune(directory=None, max_entries=None):
+    '''
+    Removes the least recently stored entries beyond max_entries, default ORCHARD_STORE_MAX_ENTRIES.
+    Entries being written start with a dot and are left alone. Workers that still map a removed 
+    survey keep reading it until they let go of it
+    '''
+    directory = directory or _directory()
+    if directory is None:
+        return
+
+    max_entries = settings.ORCHARD_STORE_MAX_ENTRIES if max_entries is None else max_entries
+
+    try:
+        entries = [entry for entry in os.scandir(directory) if not entry.name.startswith('.')]
+    except OSError:
+        return
+
+    def stored(entry):
+        try:
+            return entry.stat().st_mtime
+        except OSError:
+            return 0
+
+    entries.sort(key=stored, reverse=True)
+
+    for entry in entries[max_entries:]:
+        if entry.is_dir():
+            shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
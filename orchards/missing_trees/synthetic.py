@@ -0,0 +1,173 @@
+import numpy as np
+import shapely
+
+from shapely.geometry import Polygon
+
+from utils.helper import from_local_plane, to_local_plane
+
+
+KINDS = ('grid', 'jitter', 'rotated', 'irregular')
+
+# centre of the generated orchards, close to the orchards of the api
+ORIGIN = (-32.328, 18.826)
+
+
+class SyntheticOrchard:
+    '''
+    Generated orchard with the planting positions that were left empty
+
+    - kind: str - one of KINDS
+    - payload: dict - treesurveys payload, i.e {'count': n, 'next': None, 'previous': None, 'results': [...]}
+    - removed_lat: array - latitude values of the removed trees
+    - removed_lng: array - longitude values of the removed trees
+    - tree_spacing: float - space between trees in a row, in meters
+    - row_spacing: float - space between rows, in meters
+    - origin: tuple - (lat, lon) of the centre of the orchard, the tangent point of its local plane
+    '''
+
+    def __init__(self, kind, payload, removed_lat, removed_lng, tree_spacing, row_spacing, origin=ORIGIN):
+        self.kind = kind
+        self.payload = payload
+        self.removed_lat = removed_lat
+        self.removed_lng = removed_lng
+        self.tree_spacing = tree_spacing
+        self.row_spacing = row_spacing
+        self.origin = origin
+
+    def __len__(self):
+        return len(self.payload['results'])
+
+
+def _boundary(rng, area):
+    '''
+    Irregular star shaped boundary around (0, 0) with roughly the given area, in square meters
+
+    Returns:
+      Polygon: boundary
+    '''
+    theta = np.linspace(0, 2 * np.pi, 90, endpoint=False)
+
+    radius = np.ones_like(theta)
+    for harmonic in range(2, 6):
+        radius += rng.uniform(0, 0.12) * np.cos(harmonic * theta + rng.uniform(0, 2 * np.pi))
+
+    boundary = Polygon(np.column_stack((radius * np.cos(theta), radius * np.sin(theta))))
+    scale = np.sqrt(area / boundary.area)
+
+    return Polygon(np.column_stack((scale * radius * np.cos(theta), scale * radius * np.sin(theta))))
+
+
+def generate_orchard(
+    kind='grid', size=1000, removed=0.05, seed=0, tree_spacing=4.0, row_spacing=6.0,
+    angle=30.0, jitter=0.3, origin=ORIGIN
+):
+    '''
+    Generates an orchard planted on a regular grid with a fraction of its trees removed.
+
+    - grid: rows run east to west
+    - jitter: grid with every tree moved by gaussian noise
+    - rotated: grid rotated by angle
+    - irregular: grid clipped by an irregular boundary
+
+    Parameters:
+      - kind: str - one of KINDS
+      - size: int - number of planting positions, roughly for irregular orchards
+      - removed: float - fraction of the positions left empty
+      - seed: int - seed of the random generator
+      - tree_spacing: float - space between trees in a row, in meters
+      - row_spacing: float - space between rows, in meters
+      - angle: float - rotation of the rows of rotated orchards, in degrees
+      - jitter: float - standard deviation of the noise of jitter orchards, in meters
+      - origin: tuple - (lat, lon) of the centre of the orchard
+
+    Returns:
+      SyntheticOrchard: payload and removed trees
+    '''
+    if kind not in KINDS:
+        raise ValueError(f'Unknown orchard kind {kind}, expected one of {", ".join(KINDS)}')
+
+    rng = np.random.default_rng(seed)
+
+    # rows and columns of a roughly square orchard
+    cols = max(int(round(np.sqrt(size * row_spacing / tree_spacing))), 1)
+    rows = max(int(np.ceil(size / cols)), 1)
+
+    if kind == 'irregular':
+        boundary = _boundary(rng, size * tree_spacing * row_spacing)
+        min_x, min_y, max_x, max_y = boundary.bounds
+
+        cols = int(np.ceil((max_x - min_x) / tree_spacing)) + 1
+        rows = int(np.ceil((max_y - min_y) / row_spacing)) + 1
+
+    col, row = np.meshgrid(np.arange(cols), np.arange(rows))
+    x = (col.ravel() - (cols - 1) / 2) * tree_spacing
+    y = (row.ravel() - (rows - 1) / 2) * row_spacing
+
+    if kind == 'irregular':
+        inside = shapely.contains_xy(boundary, x, y)
+        x, y = x[inside], y[inside]
+    else:
+        x, y = x[:size], y[:size]
+
+    if kind == 'rotated':
+        theta = np.deg2rad(angle)
+        x, y = x * np.cos(theta) - y * np.sin(theta), x * np.sin(theta) + y * np.cos(theta)
+
+    if kind == 'jitter':
+        x = x + rng.normal(0, jitter, len(x))
+        y = y + rng.normal(0, jitter, len(y))
+
+    lat, lng = from_local_plane(x, y, origin)
+
+    is_removed = np.zeros(len(lat), dtype=bool)
+    is_removed[rng.choice(len(lat), size=int(round(removed * len(lat))), replace=False)] = True
+
+    ids = np.flatnonzero(~is_removed) + 1
+    results = [
+        {'id': tree_id, 'latitude': tree_lat, 'longitude': tree_lng}
+        for tree_id, tree_lat, tree_lng in zip(ids.tolist(), lat[~is_removed].tolist(), lng[~is_removed].tolist())
+    ]
+
+    return SyntheticOrchard(
+        kind,
+        {'count': len(results), 'next': None, 'previous': None, 'results': results},
+        lat[is_removed], lng[is_removed], tree_spacing, row_spacing, origin
+    )
+
+
+def score(orchard, missing_trees, tolerance=None):
+    '''
+    Compares detected missing trees to the trees removed from a synthetic orchard
+
+    Parameters:
+      - orchard: SyntheticOrchard - generated orchard
+      - missing_trees: list - detected missing trees - [{'lat': lat1, 'lng': lng1}]
+      - tolerance: float - distance in meters within which a detected point matches a removed tree,
+        default=None uses half the tree spacing
+
+    Returns:
+      float: fraction of the removed trees that were detected - recall
+      float: fraction of the detected points that are removed trees - precision
+    '''
+    tolerance = 0.5 * orchard.tree_spacing if tolerance is None else tolerance
+
+    # measured on the plane the orchard was generated on, see generate_orchard
+    removed_x, removed_y, _ = to_local_plane(orchard.removed_lat, orchard.removed_lng, orchard.origin)
+    found_x, found_y, _ = to_local_plane(
+        [point['lat'] for point in missing_trees], [point['lng'] for point in missing_trees], orchard.origin
+    )
+
+    if len(removed_x) == 0 or len(found_x) == 0:
+        recall = 1.0 if len(removed_x) == 0 else 0.0
+        precision = 1.0 if len(found_x) == 0 else 0.0
+        return recall, precision
+
+    from sklearn.neighbors import KDTree
+
+    removed = np.column_stack((removed_x, removed_y))
+    found = np.column_stack((found_x, found_y))
+
+    recall = (KDTree(found).query(removed, k=1)[0][:, 0] <= tolerance).mean()
+    precision = (KDTree(removed).query(found, k=1)[0][:, 0] <= tolerance).mean()
+
+    return float(recall), float(precision)
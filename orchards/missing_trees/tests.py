@@ -1,11 +1,57 @@
+import importlib.util
 import json
+import shutil
+import tempfile
+import threading
+import time
+import uuid
 
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+from itertools import count, takewhile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from asgiref.sync import sync_to_async
+
+from constance import config as constance_config
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
 from http import HTTPStatus
 
-from utils.helper import set_value
+from missing_trees.actions import ENGINES, detect_missing_points, find_missing_trees, generate_candidates
+from missing_trees.conditions import ToleranceIndex
+from missing_trees.delta import detect_survey
+from missing_trees.drawing import downsample, polygon_cache
+from missing_trees.lattice import find_missing_trees_lattice
+from missing_trees.merge import close_pairs, merge_points
+from missing_trees.jobs import claim_job, run_job, submit_job
+from missing_trees.models import RESULT_VERSION, MissingTreesJob, MissingTreesResult
+from missing_trees.planar import find_missing_trees_planar
+from missing_trees.pipeline import _reset_process_pool, compute_missing_trees, get_process_pool
+from missing_trees.synthetic import KINDS, generate_orchard, score
+from missing_trees.setup import fetch_trees, initialise_data, initialise_stream, setup_dataframe, survey_cache, survey_hash
+from missing_trees.store import VERSION, load_latest, load_trees, save_candidates, save_latest
+from missing_trees.tiles import find_missing_trees_tiled
+from missing_trees.trees import GrowableArray, Trees
+from shapely.geometry import Point, Polygon
+
+from utils import client, jsonstream, metrics, profiling
+from utils.cache import TTLCache
+from utils.helper import (
+    add_distance, config_cache, from_local_plane, get_direction, get_value, points_inside_polygon, set_value,
+    to_local_plane
+)
 
 from pathlib import Path
 
@@ -13,6 +59,51 @@ from decouple import config
 
 # Do tests with sample data, 
 
+def sample_survey(rows=6, cols=8, missing=((2, 3), (4, 5))):
+    '''
+    Tree survey payload for a grid of trees roughly 4m apart, without the trees at the (row, col) positions in missing
+    '''
+    results = []
+
+    for row in range(rows):
+        for col in range(cols):
+            if (row, col) not in missing:
+                results.append({
+                    'id': 1000 + row*cols + col, 'latitude': -32.328 + row*0.000054, 'longitude': 18.826 + col*0.000043
+                })
+
+    return {'count': len(results), 'next': None, 'previous': None, 'results': results}
+
+
+# the orchard store outlives the tests, a survey stored by one test or run would be reused by the next.
+# Tests of the store get a directory of their own, see Temporary_Store
+_no_store = override_settings(ORCHARD_STORE_DIR=None)
+
+
+def setUpModule():
+    _no_store.enable()
+
+
+def tearDownModule():
+    _no_store.disable()
+
+
+class Temporary_Store:
+    '''
+    Points the orchard store at an empty directory for every test
+    '''
+    def setUp(self):
+
+        super().setUp()
+
+        directory = tempfile.TemporaryDirectory()
+        store = override_settings(ORCHARD_STORE_DIR=directory.name)
+        store.enable()
+
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(store.disable)
+
+
 class API_App_Test(TestCase):
 
     def setUp(self):
@@ -52,4 +143,1251 @@ class API_App_Test(TestCase):
             response = self.client.get(reverse('missing-trees', args=[0]))
 
             self.assertIn('Access to orchard not permitted', json.loads(response.content)['detail'])
-            self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
\ No newline at end of file
+            self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+
+class Find_Missing_Trees_Test(SimpleTestCase):
+
+    def setUp(self):
+
+        # the first and last trees have a neighbour three spaces (of 4m) away, the middle tree does not
+        self.trees = Trees(
+            ids=[1, 2, 3],
+            lat=[-32.328, -32.328, -32.328],
+            lng=[18.826, 18.82608, 18.82612],
+            neighbours=np.array([[1, 2], [0, 2], [1, 0]]),
+            distances=np.array([[0.004, 0.0121], [0.004, 0.0041], [0.004, 0.0121]])
+        )
+
+    def test_generate_candidates(self):
+
+        parents, lat_candidates, lon_candidates = generate_candidates(self.trees, 0.004)
+
+        # 0.0121//0.004 == 3 spaces, i.e 2 steps to the left and right of the first and last tree
+        self.assertEqual(parents.tolist(), [0, 0, 0, 0, 2, 2, 2, 2])
+        self.assertEqual(len(lat_candidates), len(parents))
+        self.assertEqual(len(lon_candidates), len(parents))
+
+        # candidates are interleaved left/right of parent, step by step
+        for idx, (parent, step, direction) in enumerate([(0, 1, 2), (0, 1, 4), (0, 2, 2), (0, 2, 4)]):
+            lat, lon = add_distance(
+                direction=direction, dist_in_km=0.004*step,
+                lat=self.trees.lat[parent], lon=self.trees.lng[parent]
+            )
+            self.assertAlmostEqual(lat_candidates[idx], lat)
+            self.assertAlmostEqual(lon_candidates[idx], lon)
+
+
+# the original search ToleranceIndex replaced, one point at a time, kept to check it gives the same answers
+def verify_if_point_exists(trees_dictionary: dict, parent_id: int, point: list, nearest_neighbours: list):
+    '''
+    Verifies whether point exists within a list of neighbours before declaring it as missing. 
+    
+    Because we are working with latitude and longitude values, 
+    a special case is used with an offset tolerance of 5 decimal places, i.e 0.00005
+    - rounds off the value to 5 decimal places
+    - creates a latitude list ranging between (lat-0.00005, lat+0.00005) 
+    - creates a longitude list ranging between (lon-0.00005, lon+0.00005) 
+    - search for lat and lon through created ranges
+
+    Parameters:
+      - trees_dictionary: dict - dictionary of points
+      - parent_id: int - id of the original point (parent)
+      - point: list - potentially missing (lat, lon)
+      - search_list: list of neighbour ids belonging to the original point
+
+    Returns:
+      bool: true if point is found else false meaning its missing
+    '''
+
+    parent_id = str(parent_id)
+    
+    assume_left_and_right_exists_count = 0
+    result = True
+
+    for neighbour in nearest_neighbours:
+
+        neighbour = str(neighbour)
+
+        # Because we are assuming the points are in a grid, 
+        # check if neighbour is to the left or right of parent
+        direction = get_direction(
+            trees_dictionary[parent_id]['lat'], trees_dictionary[parent_id]['lng'],
+            trees_dictionary[neighbour]['lat'], trees_dictionary[neighbour]['lng']
+        )
+        
+        # Special case - to left of parent point - direction == 270
+        # Special case - to right of parent point - direction == 90
+        
+        if (direction//1 == 270) or (direction//1 == 90):
+
+            assume_left_and_right_exists_count += 1
+
+            # add/subtract tolerance value to neighbour latitude value to get min and max 
+            lat_min_range = round(trees_dictionary[neighbour]['lat'], 5) - 0.00005
+            lat_max_range = round(trees_dictionary[neighbour]['lat'], 5) + 0.00005
+
+            # create neighbour latitude range list
+            # this range helps check for trees that are not equally spaced
+            lat_list = all_range(start=lat_min_range, stop=lat_max_range+0.00001, step=0.00001, round_by=5)
+
+            # search for potentially missing latitude in range list
+            approx_lat = binary_search(round(point[0], 5) , lat_list)
+
+            if approx_lat:
+                # add/subtract toletance value to neighbour longitude to get min and max 
+                lon_min_range = round(trees_dictionary[neighbour]['lng'], 5) - 0.00005
+                lon_max_range = round(trees_dictionary[neighbour]['lng'], 5) + 0.00005
+
+                # create neighbour longitude range list
+                # this range helps check for trees that are not equally spaced
+                lon_list = all_range(start=lon_min_range, stop=lon_max_range+0.00001, step=0.00001, round_by=5)
+
+                # search for potentially missing longitude in range list
+                approx_lng = binary_search(round(point[1], 5), lon_list)
+
+                if approx_lng: 
+                    # point already exists == not missing
+                    return True
+
+            # point does not exist == (potentially) missing
+            result = False
+    
+    if assume_left_and_right_exists_count > 1 and assume_left_and_right_exists_count < 2:
+        result = False
+
+    return result
+
+
+def all_range(start=0, stop=None, step=1, round_by=0):
+    '''
+    Creates a sequence of integers/decimals from start (inclusive) to stop (exclusive) by step. range(i, j) 
+    
+    produces i, i+1, i+2, ..., j-1. start defaults to 0, and stop is omitted! 
+    
+    all_range(4) produces 0, 1, 2, 3. These are exactly the valid indices for a list of 4 elements. When step is given, it specifies the increment (or decrement)
+
+    Parameters:
+      - start: int or float - indicates the beginning value
+      - stop:  int or float - indicates where the list should end. 
+                note - this value will not be returned in the list.
+      - step: int or float - indicates the beginning value
+      - round_by: int or float - indicates rounded val
+
+    Returns:
+      list: sequence of integers/floats
+    '''
+    if step == 0:
+        raise ValueError("Step cannot be NULL")
+
+    if stop is None:
+        start, stop = 0, start
+
+    return list(takewhile(lambda x: x < stop, (round(start + i * step, round_by) for i in count())))
+
+
+def binary_search(item_to_search, search_list: list):
+    '''
+    Search through a list for a value recurively
+
+    Parameters:
+      - item_to_search: item to search
+      - search_list: sorted list which will be traversed
+
+    Returns:
+      bool: true if item is found else false
+    '''
+    max_length = len(search_list) - 1
+    mid = max_length//2
+    
+    if max_length+1 == 0:
+        return False
+    elif item_to_search == search_list[mid]:
+        return True
+    else:
+        if item_to_search > search_list[mid]:
+            return binary_search(item_to_search, search_list[mid+1:max_length+1])
+        else:
+            return binary_search(item_to_search, search_list[0:mid])
+
+
+class Tolerance_Index_Test(SimpleTestCase):
+
+    def test_matches_verify_if_point_exists(self):
+
+        rng = np.random.default_rng(7)
+
+        # 4 x 4 grid of trees, roughly 4m apart, with every other tree as a neighbour
+        lat, lon = np.meshgrid(-32.328 + np.arange(4) * 0.000036, 18.826 + np.arange(4) * 0.000043)
+        trees = Trees(
+            ids=np.arange(100, 116),
+            lat=lat.ravel() + rng.normal(0, 0.000002, 16),
+            lng=lon.ravel() + rng.normal(0, 0.000002, 16),
+            neighbours=np.array([[i for i in range(16) if i != row] for row in range(16)])
+        )
+
+        trees_dictionary = {
+            str(tree_id): {'lat': lat, 'lng': lng} for tree_id, lat, lng in zip(trees.ids.tolist(), trees.lat, trees.lng)
+        }
+
+        # points on and around every tree
+        parents = np.repeat(np.arange(16), 50)
+        lat_points = trees.lat[parents] + rng.uniform(-0.0001, 0.0001, len(parents))
+        lon_points = trees.lng[parents] + rng.uniform(-0.0001, 0.0001, len(parents))
+
+        found = ToleranceIndex(trees).exists(parents, lat_points, lon_points)
+
+        expected = [
+            verify_if_point_exists(
+                trees_dictionary, trees.ids[parent].item(), [lat, lng], trees.ids[trees.neighbours[parent]].tolist()
+            )
+            for parent, lat, lng in zip(parents, lat_points, lon_points)
+        ]
+
+        self.assertEqual(found.tolist(), expected)
+        self.assertTrue(0 < found.sum() < len(found))
+
+
+class Trees_Test(SimpleTestCase):
+
+    def test_initialise_data(self):
+
+        trees = initialise_data(sample_survey(rows=2, cols=2, missing=()))
+
+        self.assertEqual(len(trees), 4)
+        self.assertEqual(trees.ids.dtype, np.int64)
+        self.assertEqual(trees.lat.dtype, np.float64)
+        self.assertEqual(trees.lng_lat().shape, (4, 2))
+
+    def test_rows(self):
+
+        # a repeated id resolves to its last tree, like a dictionary keyed by id
+        trees = Trees(ids=[7, 3, 7, 5], lat=[0, 1, 2, 3], lng=[0, 1, 2, 3])
+
+        self.assertEqual(trees.rows([3, 5, 7]).tolist(), [1, 3, 2])
+
+        with self.assertRaises(KeyError):
+            trees.rows([4])
+
+
+class Stream_Parser_Test(SimpleTestCase):
+
+    def chunks(self, data, size):
+        return [data[i:i+size] for i in range(0, len(data), size)]
+
+    def test_matches_initialise_data(self):
+
+        survey = sample_survey()
+        survey['note'] = {'text': 'caf\u00e9 \u2013 r\u00e9sum\u00e9', 'values': [1.5e-3, None, True]}
+        data = json.dumps(survey, indent=1).encode('utf-8')
+
+        expected = initialise_data(survey)
+
+        # chunks split numbers, strings and multi byte characters
+        for size in (1, 7, 64, len(data)):
+            trees, fields = initialise_stream(self.chunks(data, size))
+
+            self.assertEqual(trees.ids.tolist(), expected.ids.tolist())
+            self.assertEqual(trees.lat.tolist(), expected.lat.tolist())
+            self.assertEqual(trees.lng.tolist(), expected.lng.tolist())
+            self.assertEqual(fields, {'count': survey['count'], 'next': None, 'previous': None, 'note': survey['note']})
+
+    def test_invalid_json(self):
+
+        data = json.dumps(sample_survey()).encode('utf-8')
+
+        with self.assertRaises(json.JSONDecodeError):
+            initialise_stream(self.chunks(data[:-20], 16))
+
+        with self.assertRaisesRegex(json.JSONDecodeError, 'Expecting value: line 1'):
+            list(jsonstream.iter_object([b'<html>Unauthorized</html>'], 'results'))
+
+        with self.assertRaisesRegex(json.JSONDecodeError, 'Extra data'):
+            list(jsonstream.iter_object([b'{"results": []} {}'], 'results'))
+
+    def test_growable_array(self):
+
+        values = GrowableArray(np.float64, capacity=2)
+        for block in ([0, 1], [2], [3, 4, 5, 6, 7]):
+            values.extend(block)
+
+        self.assertEqual(values.array().tolist(), [0, 1, 2, 3, 4, 5, 6, 7])
+
+
+@override_settings(ORCHARD_STORE_MAX_ENTRIES=1)
+class Orchard_Store_Test(Temporary_Store, SimpleTestCase):
+
+    def test_neighbours_are_mapped_from_the_store(self):
+
+        trees = initialise_data(sample_survey())
+        computed, _ = setup_dataframe(1, trees)
+
+        with mock.patch('sklearn.neighbors.BallTree') as ball_tree:
+            stored, _ = setup_dataframe(1, trees)
+
+        ball_tree.assert_not_called()
+        self.assertIsInstance(stored.neighbours, np.memmap)
+        self.assertFalse(stored.distances.flags.writeable)
+
+        for name in ('ids', 'lat', 'lng', 'neighbours', 'distances'):
+            self.assertEqual(getattr(stored, name).tolist(), getattr(computed, name).tolist())
+
+    def test_least_recent_surveys_are_pruned(self):
+
+        first, _ = setup_dataframe(1, initialise_data(sample_survey()))
+        second, _ = setup_dataframe(1, initialise_data(sample_survey(missing=((1, 1),))))
+
+        self.assertIsNone(load_trees(survey_hash(first)))
+        self.assertIsNotNone(load_trees(survey_hash(second)))
+
+
+@override_settings(DELTA_MAX_CHANGES=0.1)
+class Delta_Test(Temporary_Store, SimpleTestCase):
+
+    def changed_survey(self, trees, seed):
+        '''
+        trees with about 1% of them removed, one moved and the first removed one added back under a new id
+        '''
+        rng = np.random.default_rng(seed)
+
+        removed = rng.choice(np.arange(1, len(trees)), len(trees) // 100, replace=False)
+        keep = np.ones(len(trees), dtype=bool)
+        keep[removed] = False
+
+        lat = trees.lat[keep]
+        lat[len(lat) // 2] += 0.00002
+
+        return Trees(
+            np.append(trees.ids[keep], trees.ids.max() + 1),
+            np.append(lat, trees.lat[removed[0]]),
+            np.append(trees.lng[keep], trees.lng[removed[0]]),
+        )
+
+    def test_same_points_as_a_full_detection(self):
+
+        for seed, kind in enumerate(KINDS):
+            trees = initialise_data(generate_orchard(kind, size=800, removed=0.05, seed=seed).payload)
+            compute_missing_trees(seed + 1, trees)
+
+            changed = self.changed_survey(trees, seed)
+
+            with mock.patch('missing_trees.delta.detect_survey') as detect_survey:
+                missing_trees = compute_missing_trees(seed + 1, changed)
+
+            detect_survey.assert_not_called()
+
+            with override_settings(ORCHARD_STORE_DIR=None):
+                self.assertEqual(missing_trees, find_missing_trees(*setup_dataframe('', changed)))
+
+    def test_reordered_surveys_are_detected_in_full(self):
+
+        trees = initialise_data(sample_survey())
+        compute_missing_trees(1, trees)
+
+        reordered = trees.take(np.arange(len(trees))[::-1])
+
+        with mock.patch('missing_trees.delta.detect_survey', wraps=detect_survey) as detect_survey_mock:
+            missing_trees = compute_missing_trees(1, reordered)
+
+        with override_settings(ORCHARD_STORE_DIR=None):
+            self.assertEqual(missing_trees, find_missing_trees(*setup_dataframe('', reordered)))
+
+        detect_survey_mock.assert_called_once()
+
+    def test_stale_or_corrupt_latest_surveys_are_detected_in_full(self):
+
+        trees = initialise_data(sample_survey())
+        changed = initialise_data(sample_survey(missing=((2, 3), (4, 5), (1, 1))))
+
+        with override_settings(ORCHARD_STORE_DIR=None):
+            expected = find_missing_trees(*setup_dataframe('', changed))
+
+        def stale():
+            save_latest(1, 'unknown')
+
+        def foreign():
+            compute_missing_trees(2, initialise_data(sample_survey(rows=4, cols=4, missing=())))
+            save_latest(1, load_latest(2))
+
+        def corrupt():
+            compute_missing_trees(1, trees)
+            save_candidates(survey_hash(trees), np.array([len(trees) + 5]), np.zeros(1), np.zeros(1))
+
+        def unreadable():
+            compute_missing_trees(1, trees)
+            Path(settings.ORCHARD_STORE_DIR, f'v{VERSION}', survey_hash(trees), 'candidates.npz').write_bytes(b'damaged')
+
+        for case in (stale, foreign, corrupt, unreadable):
+            with self.subTest(case.__name__):
+                case()
+
+                with mock.patch('missing_trees.delta.detect_survey', wraps=detect_survey) as detect_survey_mock:
+                    self.assertEqual(compute_missing_trees(1, changed), expected)
+
+                detect_survey_mock.assert_called_once()
+
+                # the next case starts from an empty store
+                for directory in Path(settings.ORCHARD_STORE_DIR).iterdir():
+                    shutil.rmtree(directory)
+
+
+class Merge_Test(SimpleTestCase):
+
+    def test_points_within_the_radius_are_merged(self):
+
+        # 0.000004 degrees of latitude is about 0.45m, the first two points round to different 5th decimals
+        lat = np.array([-32.327995, -32.327999, -32.328003, -32.3281])
+        lon = np.array([18.826, 18.826, 18.826, 18.826])
+
+        merged_lat, merged_lon, support = merge_points(np.array([3, 4, 4, 5]), lat, lon, radius=1.0)
+
+        # the first three are linked through the second one, found by two trees
+        self.assertEqual(support.tolist(), [2, 1])
+        self.assertAlmostEqual(merged_lat[0], -32.327999)
+        self.assertEqual(merged_lat[1], -32.3281)
+        self.assertEqual(merged_lon.tolist(), [18.826, 18.826])
+
+    def test_matches_every_pair(self):
+
+        rng = np.random.default_rng(5)
+        lat = -32.328 + rng.uniform(0, 0.0002, 300)
+        lon = 18.826 + rng.uniform(0, 0.0002, 300)
+
+        x, y, _ = to_local_plane(lat, lon)
+        first, second = close_pairs(x, y, 1.5)
+
+        within = np.hypot(x[:, None] - x, y[:, None] - y) <= 1.5
+        expected = set(zip(*np.nonzero(np.triu(within, 1))))
+
+        self.assertEqual(set(zip(np.minimum(first, second), np.maximum(first, second))), expected)
+
+    def test_offset_points_report_their_support(self):
+
+        trees, trees_polygon = setup_dataframe('', initialise_data(sample_survey()))
+
+        with override_settings(MERGE_RADIUS=0.01):
+            missing_trees = find_missing_trees(trees, trees_polygon)
+
+        self.assertTrue(all(point['support'] >= 1 for point in missing_trees))
+
+        with override_settings(MERGE_RADIUS=50):
+            merged = find_missing_trees(trees, trees_polygon)
+
+        # the sample orchard is about 40m across, every point is merged into one found by all their trees
+        parents, _, _ = next(detect_missing_points(trees, trees_polygon))
+
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged[0]['support'], len(np.unique(parents)))
+
+
+class Points_Inside_Polygon_Test(SimpleTestCase):
+
+    def test_matches_point_by_point(self):
+
+        polygon = Polygon([(18.826, -32.328), (18.827, -32.328), (18.8275, -32.3275), (18.826, -32.327)])
+
+        rng = np.random.default_rng(3)
+        lon = rng.uniform(18.8259, 18.8276, 500)
+        lat = rng.uniform(-32.3281, -32.3269, 500)
+
+        inside = points_inside_polygon(polygon, lon, lat, tolerance=0.00002)
+
+        expected = [
+            Point(x, y).within(polygon) or Point(x, y).distance(polygon) <= 0.00002 for x, y in zip(lon, lat)
+        ]
+
+        self.assertEqual(inside.tolist(), expected)
+
+
+class TTL_Cache_Test(SimpleTestCase):
+
+    def setUp(self):
+
+        self.now = 0
+        self.cache = TTLCache(ttl=10, max_entries=2, timer=lambda: self.now)
+
+    def test_expires_after_ttl(self):
+
+        self.cache.set(1, 'survey')
+        self.assertEqual(self.cache.get(1), 'survey')
+
+        self.now = 11
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 0})
+
+    def test_evicts_least_recently_used(self):
+
+        self.cache.set(1, 'first')
+        self.cache.set(2, 'second')
+        self.cache.get(1)
+        self.cache.set(3, 'third')
+
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), 'first')
+        self.assertEqual(self.cache.get(3), 'third')
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+
+class Settings_Cache_Test(TestCase):
+
+    def setUp(self):
+
+        config_cache.clear()
+        set_value('BASE_ENDPOINT', 'http://first/')
+
+    def tearDown(self):
+
+        config_cache.clear()
+
+    def test_cached_after_first_read(self):
+
+        self.assertEqual(get_value('BASE_ENDPOINT'), 'http://first/')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_value('BASE_ENDPOINT'), 'http://first/')
+
+    def test_invalidated_on_update(self):
+
+        get_value('BASE_ENDPOINT')
+
+        set_value('BASE_ENDPOINT', 'http://second/')
+        self.assertEqual(get_value('BASE_ENDPOINT'), 'http://second/')
+
+        # updates made without set_value, e.g the admin, send config_updated
+        setattr(constance_config, 'BASE_ENDPOINT', 'http://third/')
+        self.assertEqual(get_value('BASE_ENDPOINT'), 'http://third/')
+
+
+class Stored_Results_Test(Temporary_Store, TestCase):
+
+    def setUp(self):
+
+        super().setUp()
+
+        self.orchard_id = 216269
+        survey_cache.set(self.orchard_id, initialise_data(sample_survey()))
+
+    def tearDown(self):
+
+        survey_cache.clear()
+
+    def test_result_is_stored_and_reused(self):
+
+        response = self.client.get(reverse('missing-trees', args=[self.orchard_id]))
+        missing_trees = json.loads(response.content)['missing_trees']
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(MissingTreesResult.objects.filter(orchard_id=self.orchard_id).count(), 1)
+
+        with mock.patch('missing_trees.pipeline.setup_dataframe') as setup_dataframe:
+            response = self.client.get(reverse('missing-trees', args=[self.orchard_id]))
+
+        setup_dataframe.assert_not_called()
+        self.assertEqual(json.loads(response.content)['missing_trees'], missing_trees)
+
+    def test_results_of_an_older_format_are_computed_again(self):
+
+        MissingTreesResult.objects.create(
+            orchard_id=self.orchard_id, survey_hash=survey_hash(survey_cache.get(self.orchard_id)), version=1,
+            missing_trees=[{'lat': -32.328, 'lng': 18.826}]
+        )
+
+        for engine in ENGINES:
+            response = self.client.get(reverse('missing-trees', args=[self.orchard_id]), {'engine': engine})
+            missing_trees = json.loads(response.content)['missing_trees']
+
+            # every engine reports the same shape
+            self.assertTrue(missing_trees, engine)
+            self.assertTrue(all(set(point) == {'lat', 'lng', 'support'} for point in missing_trees), engine)
+
+        self.assertEqual(MissingTreesResult.objects.filter(version=RESULT_VERSION).count(), len(ENGINES))
+
+    async def test_async_view(self):
+
+        with mock.patch('missing_trees.views.close_old_connections') as close_old_connections:
+            response = await self.async_client.get(reverse('missing-trees-async', args=[self.orchard_id]))
+
+        # by the fetch and the detection, in their pool threads
+        self.assertEqual(close_old_connections.call_count, 2)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIn('detect;dur=', response['Server-Timing'])
+        self.assertEqual(
+            json.loads(response.content)['missing_trees'],
+            compute_missing_trees(self.orchard_id, initialise_data(sample_survey()))
+        )
+        self.assertEqual(await sync_to_async(MissingTreesResult.objects.filter(orchard_id=self.orchard_id).count)(), 1)
+
+    def test_ndjson_stream(self):
+
+        response = self.client.get(reverse('missing-trees', args=[self.orchard_id]), {'format': 'ndjson'})
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+        points = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+        # the same points as json, stored for both
+        self.assertEqual(points, compute_missing_trees(self.orchard_id, initialise_data(sample_survey())))
+        self.assertEqual(MissingTreesResult.objects.filter(orchard_id=self.orchard_id).count(), 1)
+
+        response = self.client.get(reverse('missing-trees', args=[self.orchard_id]))
+
+        self.assertEqual(json.loads(response.content)['missing_trees'], points)
+
+    def test_engine(self):
+
+        response = self.client.get(reverse('missing-trees', args=[self.orchard_id]), {'engine': 'lattice'})
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(len(json.loads(response.content)['missing_trees']), 2)
+        self.assertTrue(MissingTreesResult.objects.filter(orchard_id=self.orchard_id, engine='lattice').exists())
+
+        response = self.client.get(reverse('missing-trees', args=[self.orchard_id]), {'engine': 'unknown'})
+
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_changed_survey_is_recomputed(self):
+
+        self.client.get(reverse('missing-trees', args=[self.orchard_id]))
+
+        survey_cache.set(self.orchard_id, initialise_data(sample_survey(missing=((1, 1),))))
+        response = self.client.get(reverse('missing-trees', args=[self.orchard_id]))
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(MissingTreesResult.objects.filter(orchard_id=self.orchard_id).count(), 2)
+
+    def test_conditional_get(self):
+
+        url = reverse('missing-trees', args=[self.orchard_id])
+        response = self.client.get(url)
+        etag = response['ETag']
+
+        self.assertIn('max-age=', response['Cache-Control'])
+
+        # answered before the stored results are looked up
+        with mock.patch('missing_trees.views.get_stored_result') as get_stored_result:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        get_stored_result.assert_not_called()
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+        # other engines, response formats and surveys have their own ETag
+        for params in ({'engine': 'lattice'}, {'format': 'ndjson'}):
+            self.assertNotEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, HTTPStatus.NOT_MODIFIED)
+
+        survey_cache.set(self.orchard_id, initialise_data(sample_survey(missing=((1, 1),))))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(ORCHARD_STORE_DIR=None)
+class Drawing_Test(TestCase):
+
+    def setUp(self):
+
+        self.orchard_id = 216269
+        survey_cache.set(self.orchard_id, initialise_data(sample_survey()))
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = override_settings(DRAW_DIR=self.directory.name, ORCHARD_STORE_DIR=None)
+        self.settings.enable()
+
+        polygon = '18.8259,-32.3281 18.8264,-32.3281 18.8264,-32.3277 18.8259,-32.3277 18.8259,-32.3281'
+        self.get_json = mock.patch('missing_trees.drawing.client.get_json', return_value={'polygon': polygon})
+        self.polygon = self.get_json.start()
+
+    def tearDown(self):
+
+        self.get_json.stop()
+        self.settings.disable()
+        self.directory.cleanup()
+        survey_cache.clear()
+        polygon_cache.clear()
+
+    def test_drawing_is_rendered_once_and_linked(self):
+
+        response = self.client.get(reverse('missing-trees', args=[self.orchard_id]), {'draw': ''})
+        drawing = json.loads(response.content)['drawing']
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(drawing.endswith('.html'))
+
+        with mock.patch('plotly.graph_objects.Figure') as figure:
+            response = self.client.get(reverse('missing-trees', args=[self.orchard_id]), {'draw': 'html'})
+
+        figure.assert_not_called()
+        self.assertEqual(json.loads(response.content)['drawing'], drawing)
+        self.assertEqual(self.polygon.call_count, 1)
+
+        response = self.client.get(urlsplit(drawing).path)
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response['Content-Type'], 'text/html')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertIn(b'plotly', b''.join(response.streaming_content))
+
+    def test_png_without_kaleido(self):
+
+        find_spec = importlib.util.find_spec
+
+        with mock.patch(
+            'importlib.util.find_spec', side_effect=lambda name, *args: None if name == 'kaleido' else find_spec(name, *args)
+        ):
+            response = self.client.get(reverse('missing-trees', args=[self.orchard_id]), {'draw': 'png'})
+
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertIn('png drawings require the kaleido package', json.loads(response.content)['detail'])
+
+    def test_unknown_drawings(self):
+
+        response = self.client.get(reverse('missing-trees', args=[self.orchard_id]), {'draw': 'svg'})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+        for name in ('1-abc.html', '.1-abc.html', f'1-{"0" * 64}.html'):
+            response = self.client.get(reverse('missing-trees-drawing', args=[name]))
+            self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+    def test_downsample(self):
+
+        trees = initialise_data(sample_survey(rows=20, cols=20, missing=()))
+
+        rows = downsample(trees, 50)
+
+        self.assertEqual(len(rows), 50)
+        self.assertEqual((rows[0], rows[-1]), (0, len(trees) - 1))
+        self.assertEqual(len(downsample(trees, 1000)), len(trees))
+
+
+@override_settings(ORCHARD_STORE_DIR=None)
+class Metrics_Test(TestCase):
+
+    def setUp(self):
+
+        self.orchard_id = 216269
+        survey_cache.set(self.orchard_id, initialise_data(sample_survey()))
+
+        for histogram in metrics.HISTOGRAMS:
+            histogram.clear()
+
+    def tearDown(self):
+
+        survey_cache.clear()
+
+    def test_server_timing(self):
+
+        response = self.client.get(reverse('missing-trees', args=[self.orchard_id]))
+        stages = dict(entry.split(';dur=') for entry in response['Server-Timing'].split(', '))
+
+        for stage in ('fetch', 'lookup', 'balltree_build', 'balltree_query', 'verify', 'detect', 'store', 'total'):
+            self.assertGreaterEqual(float(stages[stage]), 0)
+
+        response = self.client.get(reverse('metrics'))
+        content = response.content.decode()
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIn('missing_trees_stage_seconds_count{stage="balltree_query"} 1', content)
+        self.assertIn('missing_trees_request_size_sum{count="trees"} 46', content)
+        self.assertIn('missing_trees_request_size_count{count="candidates"} 1', content)
+
+    def test_stages_outside_a_request(self):
+
+        with metrics.stage('fetch'):
+            metrics.count('trees', 1)
+
+        self.assertIsNone(metrics.current())
+        self.assertNotIn('stage="fetch"', metrics.render())
+
+
+@override_settings(DELTA_MAX_CHANGES=0.1)
+class Profile_Test(Temporary_Store, TestCase):
+
+    def setUp(self):
+
+        super().setUp()
+
+        self.orchard_id = 216269
+        survey_cache.set(self.orchard_id, initialise_data(sample_survey()))
+
+        self.url = reverse('missing-trees', args=[self.orchard_id])
+
+    def tearDown(self):
+
+        survey_cache.clear()
+
+    def test_staff_only(self):
+
+        response = self.client.get(self.url, {'profile': 'stats'})
+
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+    def test_profile(self):
+
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+
+        response = self.client.get(self.url, {'profile': 'stats', 'sort': 'tottime'})
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIn('find_missing_trees', response.content.decode())
+        self.assertFalse(MissingTreesResult.objects.exists())
+        self.assertIsNone(load_latest(self.orchard_id))
+
+        response = self.client.get(self.url, {'profile': 'collapsed'})
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIn('.collapsed', response['Content-Disposition'])
+
+        response = self.client.get(self.url, {'profile': 'calls'})
+
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_collapsed_stacks(self):
+
+        def busy():
+            deadline = time.perf_counter() + 0.05
+            while time.perf_counter() < deadline:
+                pass
+            return 'done'
+
+        value, report = profiling.profile_collapsed(busy, interval=0.001)
+        stack, samples = report.splitlines()[0].rsplit(' ', 1)
+
+        self.assertEqual(value, 'done')
+        self.assertTrue(stack.startswith('busy (tests.py:'))
+        self.assertGreater(int(samples), 0)
+
+
+class Stub_Api_Handler(BaseHTTPRequestHandler):
+    '''
+    Serves sample_survey in pages of 10 using limit/offset pagination. The first request for every page fails
+    '''
+
+    survey = sample_survey(rows=6, cols=8)
+    page_size = 10
+
+    def do_GET(self):
+
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        offset = int(params.get('offset', ['0'])[0])
+
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            first_attempt = offset not in self.server.failed
+            self.server.failed.add(offset)
+
+        if first_attempt:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        results = self.survey['results'][offset:offset + self.page_size]
+        next_url = None
+        if offset + self.page_size < len(self.survey['results']):
+            next_url = f'http://{self.headers["Host"]}{url.path}?{url.query.split("&offset")[0]}&limit={self.page_size}&offset={offset + self.page_size}'
+
+        body = json.dumps({'count': len(self.survey['results']), 'next': next_url, 'previous': None, 'results': results}).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(API_BACKOFF=0)
+class Api_Client_Test(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        super().setUpClass()
+
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Stub_Api_Handler)
+        cls.server.lock = threading.Lock()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+
+        self.server.requests = []
+        self.server.failed = set()
+
+        client._reset_session()
+        survey_cache.clear()
+
+        set_value('BASE_ENDPOINT', f'http://127.0.0.1:{self.server.server_port}/')
+        set_value('API_TOKEN', 'XXXXXXXXXXXX')
+
+    def tearDown(self):
+
+        client._reset_session()
+        survey_cache.clear()
+
+    def test_fetches_all_pages_with_retries(self):
+
+        trees = fetch_trees(216269).ids.tolist()
+
+        self.assertEqual(trees, [tree['id'] for tree in Stub_Api_Handler.survey['results']])
+
+        # 5 pages, each one failed once before succeeding
+        self.assertEqual(len(self.server.requests), 10)
+
+    def test_page_urls(self):
+
+        self.assertEqual(
+            client.page_urls('http://api/treesurveys/?survey__orchard_id=1&limit=10&offset=10', 25, 10),
+            ['http://api/treesurveys/?survey__orchard_id=1&limit=10&offset=10', 'http://api/treesurveys/?survey__orchard_id=1&limit=10&offset=20']
+        )
+        self.assertEqual(
+            client.page_urls('http://api/treesurveys/?page=2', 25, 10),
+            ['http://api/treesurveys/?page=2', 'http://api/treesurveys/?page=3']
+        )
+        self.assertIsNone(client.page_urls('http://api/treesurveys/?cursor=abc', 25, 10))
+
+
+class Batch_Test(Temporary_Store, TestCase):
+
+    def setUp(self):
+
+        super().setUp()
+
+        survey_cache.set(1, initialise_data(sample_survey()))
+        survey_cache.set(2, initialise_data(sample_survey(missing=((1, 1),))))
+
+        # a single tree has no neighbours to measure the space between trees
+        survey_cache.set(3, initialise_data(sample_survey(rows=1, cols=1)))
+
+    def tearDown(self):
+
+        survey_cache.clear()
+
+    def test_batch(self):
+
+        response = self.client.get(reverse('missing-trees-batch'), {'orchard_ids': '1,2,3,1'})
+        content = json.loads(response.content)
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(sorted(content['missing_trees']), ['1', '2'])
+        self.assertEqual(list(content['errors']), ['3'])
+
+        self.assertEqual(content['missing_trees']['1'], compute_missing_trees(1, survey_cache.get(1)))
+        self.assertEqual(MissingTreesResult.objects.count(), 2)
+
+    def test_invalid_orchard_ids(self):
+
+        response = self.client.get(reverse('missing-trees-batch'), {'orchard_ids': '1,a'})
+
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+
+def worker_setting(name):
+    return getattr(settings, name)
+
+
+class Process_Pool_Test(SimpleTestCase):
+
+    def tearDown(self):
+
+        _reset_process_pool()
+
+    def test_workers_start_afresh_with_the_settings_of_the_pool(self):
+
+        with override_settings(MERGE_RADIUS=2.5):
+            pool = get_process_pool()
+
+            self.assertIn(pool._mp_context.get_start_method(), ('forkserver', 'spawn'))
+            self.assertEqual(pool.submit(worker_setting, 'MERGE_RADIUS').result(), 2.5)
+
+        self.assertIsNot(get_process_pool(), pool)
+        self.assertEqual(get_process_pool().submit(worker_setting, 'MERGE_RADIUS').result(), settings.MERGE_RADIUS)
+
+
+class Lattice_Engine_Test(SimpleTestCase):
+
+    def assertFinds(self, survey, expected):
+
+        trees, trees_polygon = setup_dataframe(1, initialise_data(survey))
+
+        missing_trees = find_missing_trees_lattice(trees, trees_polygon)
+
+        self.assertEqual(len(missing_trees), len(expected))
+        for point, (lat, lng) in zip(sorted(missing_trees, key=lambda point: (point['lat'], point['lng'])), sorted(expected)):
+            self.assertAlmostEqual(point['lat'], lat, places=5)
+            self.assertAlmostEqual(point['lng'], lng, places=5)
+
+    def test_grid(self):
+
+        self.assertFinds(
+            sample_survey(rows=8, cols=10, missing=((2, 3), (4, 5), (5, 5))),
+            [(-32.328 + row*0.000054, 18.826 + col*0.000043) for row, col in ((2, 3), (4, 5), (5, 5))]
+        )
+
+    def test_rotated_rows(self):
+
+        survey = sample_survey(rows=8, cols=10, missing=((3, 6),))
+
+        # rotate the orchard by 30 degrees around its first tree
+        angle = np.deg2rad(30)
+        scale = np.cos(np.deg2rad(-32.328))
+
+        def rotate(lat, lng):
+            x, y = (lng - 18.826) * scale, lat + 32.328
+            return -32.328 + x*np.sin(angle) + y*np.cos(angle), 18.826 + (x*np.cos(angle) - y*np.sin(angle)) / scale
+
+        for tree in survey['results']:
+            tree['latitude'], tree['longitude'] = rotate(tree['latitude'], tree['longitude'])
+
+        self.assertFinds(survey, [rotate(-32.328 + 3*0.000054, 18.826 + 6*0.000043)])
+
+
+@override_settings(ORCHARD_STORE_DIR=None)
+class Planar_Engine_Test(SimpleTestCase):
+
+    def assertFinds(self, survey, expected):
+
+        trees, trees_polygon = setup_dataframe(1, initialise_data(survey), neighbours=False)
+
+        missing_trees = find_missing_trees_planar(trees, trees_polygon)
+
+        self.assertEqual(len(missing_trees), len(expected))
+        for point, (lat, lng) in zip(sorted(missing_trees, key=lambda point: (point['lat'], point['lng'])), sorted(expected)):
+            self.assertAlmostEqual(point['lat'], lat, places=5)
+            self.assertAlmostEqual(point['lng'], lng, places=5)
+
+    def test_gaps_in_rows(self):
+
+        missing = ((2, 3), (4, 5), (4, 6), (5, 5))
+
+        self.assertFinds(
+            sample_survey(rows=8, cols=10, missing=missing),
+            [(-32.328 + row*0.000054, 18.826 + col*0.000043) for row, col in missing]
+        )
+
+    def test_synthetic_orchards(self):
+
+        for kind in ('grid', 'jitter', 'rotated'):
+            orchard = generate_orchard(kind, size=2000, removed=0.05, seed=4)
+            trees = initialise_data(orchard.payload)
+
+            recall, precision = score(orchard, find_missing_trees_planar(trees, Polygon(trees.lng_lat())))
+
+            self.assertGreater(recall, 0.95)
+            self.assertGreater(precision, 0.95)
+
+    def test_skips_the_haversine_neighbours(self):
+
+        trees = initialise_data(sample_survey())
+
+        with mock.patch('missing_trees.setup.query_neighbours') as query_neighbours:
+            missing_trees = compute_missing_trees(1, trees, engine='planar')
+
+        query_neighbours.assert_not_called()
+        self.assertEqual(len(missing_trees), 2)
+
+
+class Tiles_Test(SimpleTestCase):
+
+    def test_same_points_as_one_tile(self):
+
+        for kind in KINDS:
+            trees = initialise_data(generate_orchard(kind, size=1500, removed=0.05, seed=1).payload)
+            expected = find_missing_trees(*setup_dataframe('', trees))
+
+            # small tiles and no halo, most trees near the seams are run again with a wider one
+            for halo in (0, 2):
+                self.assertEqual(
+                    find_missing_trees_tiled(trees, Polygon(trees.lng_lat()), tile_trees=200, halo=halo), expected
+                )
+
+    def test_large_orchards_are_tiled(self):
+
+        trees = initialise_data(generate_orchard('jitter', size=1000, seed=2).payload)
+        expected = compute_missing_trees(1, trees)
+
+        with override_settings(TILE_MIN_TREES=500, TILE_TREES=300):
+            with mock.patch('missing_trees.pipeline.setup_dataframe') as setup_dataframe_mock:
+                self.assertEqual(compute_missing_trees(1, trees), expected)
+
+        setup_dataframe_mock.assert_not_called()
+
+
+class Benchmark_Test(SimpleTestCase):
+
+    def test_generate_orchard(self):
+
+        for kind in ('grid', 'jitter', 'rotated', 'irregular'):
+            orchard = generate_orchard(kind, size=400, removed=0.1, seed=3)
+
+            self.assertAlmostEqual(len(orchard) + len(orchard.removed_lat), 400, delta=40)
+            self.assertAlmostEqual(len(orchard.removed_lat) / (len(orchard) + len(orchard.removed_lat)), 0.1, places=2)
+
+        removed = [{'lat': lat, 'lng': lng} for lat, lng in zip(orchard.removed_lat, orchard.removed_lng)]
+
+        self.assertEqual(score(orchard, removed), (1.0, 1.0))
+        self.assertEqual(score(orchard, removed[:len(removed)//2]), (len(removed)//2 / len(removed), 1.0))
+
+    def test_score_on_the_plane_of_the_orchard(self):
+
+        orchard = generate_orchard('grid', size=400, removed=0.1, seed=3, origin=(60.0, 5.0))
+
+        # 0.4 tree spacings east of every removed tree, further than half a spacing on the plane of ORIGIN
+        x, y, _ = to_local_plane(orchard.removed_lat, orchard.removed_lng, orchard.origin)
+        lat, lng = from_local_plane(x + 0.4 * orchard.tree_spacing, y, orchard.origin)
+
+        self.assertEqual(score(orchard, [{'lat': lat, 'lng': lng} for lat, lng in zip(lat, lng)]), (1.0, 1.0))
+
+    def test_benchmark_command(self):
+
+        output = StringIO()
+        call_command('benchmark', sizes=[100], kinds=['grid'], no_memory=True, stdout=output)
+
+        for stage in (
+            'initialise_data', 'balltree_query', 'tolerance_index', 'containment', 'merge_points', 'find_missing_trees[lattice]'
+        ):
+            self.assertIn(stage, output.getvalue())
+
+        self.assertIn('matches single tile True', output.getvalue())
+
+    def test_worker_boots_without_heavy_packages(self):
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as file:
+            call_command('benchmark_startup', runs=1, size=200, json=file.name, stdout=StringIO())
+            boot, first_request = json.load(open(file.name))
+
+        self.assertEqual(boot['loaded'], [])
+        self.assertIn('sklearn', first_request['loaded'])
+        self.assertNotIn('plotly', first_request['loaded'])
+
+
+class Jobs_Test(Temporary_Store, TestCase):
+
+    def setUp(self):
+
+        super().setUp()
+
+        self.orchard_id = 216269
+        survey_cache.set(self.orchard_id, initialise_data(sample_survey()))
+
+    def tearDown(self):
+
+        survey_cache.clear()
+
+    def test_submit_run_and_poll(self):
+
+        response = self.client.post(reverse('missing-trees-jobs', args=[self.orchard_id]))
+        job = json.loads(response.content)
+
+        self.assertEqual(response.status_code, HTTPStatus.ACCEPTED)
+        self.assertEqual(job['status'], 'queued')
+
+        # the same orchard is not queued twice
+        response = self.client.post(reverse('missing-trees-jobs', args=[self.orchard_id]))
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(json.loads(response.content)['id'], job['id'])
+
+        run_job(claim_job())
+        self.assertIsNone(claim_job())
+
+        response = self.client.get(job['url'])
+        result = json.loads(response.content)
+
+        self.assertEqual(result['status'], 'done')
+        self.assertEqual(result['attempts'], 1)
+        self.assertEqual(
+            result['missing_trees'], compute_missing_trees(self.orchard_id, initialise_data(sample_survey()))
+        )
+
+    @override_settings(JOB_MAX_ATTEMPTS=2)
+    def test_failed_job_is_retried(self):
+
+        job, _ = submit_job(self.orchard_id)
+
+        with mock.patch('missing_trees.jobs.fetch_trees', side_effect=ValidationError('Upstream is down')):
+            run_job(claim_job())
+
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts, job.detail), ('queued', 1, "['Upstream is down']"))
+
+            # retried after a delay
+            self.assertIsNone(claim_job())
+            MissingTreesJob.objects.filter(id=job.id).update(available_at=timezone.now())
+
+            run_job(claim_job())
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+
+        # a failed job does not block a new one
+        self.assertTrue(submit_job(self.orchard_id)[1])
+
+    def test_lost_job_is_claimed_again(self):
+
+        job, _ = submit_job(self.orchard_id)
+        claim_job()
+
+        self.assertIsNone(claim_job())
+
+        MissingTreesJob.objects.filter(id=job.id).update(leased_until=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(claim_job().id, job.id)
+
+    def test_job_claimed_by_another_worker_is_not_overwritten(self):
+
+        job, _ = submit_job(self.orchard_id)
+        job = claim_job()
+
+        def claimed_again(*args):
+            MissingTreesJob.objects.filter(id=job.id).update(leased_until=timezone.now() + timedelta(hours=1))
+
+        with mock.patch('missing_trees.jobs.get_stored_result', side_effect=claimed_again):
+            self.assertFalse(run_job(job))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'running')
+        self.assertIsNone(job.result)
+
+    def test_unknown_job(self):
+
+        response = self.client.get(reverse('missing-trees-job', args=[uuid.uuid4()]))
+
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+
+
+@override_settings(JOB_LEASE=1, JOB_HEARTBEAT=0.2)
+class Job_Lease_Test(Temporary_Store, TransactionTestCase):
+
+    def tearDown(self):
+
+        survey_cache.clear()
+
+    def test_job_running_past_its_lease(self):
+
+        survey_cache.set(1, initialise_data(sample_survey()))
+        job, _ = submit_job(1)
+
+        def slow(*args):
+            time.sleep(2.5)
+
+            # the lease was renewed, no other worker takes the job
+            self.assertIsNone(claim_job())
+            return [{'lat': -32.328, 'lng': 18.826, 'support': 1}]
+
+        with mock.patch('missing_trees.jobs.get_stored_result', side_effect=slow):
+            self.assertTrue(run_job(claim_job()))
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.leased_until), ('done', 1, None))
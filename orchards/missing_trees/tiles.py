@@ -0,0 +1,278 @@
+from math import ceil, cos, radians, sqrt
+
+import numpy as np
+
+from django.conf import settings
+
+from missing_trees.actions import estimate_spacing, find_missing_trees, generate_candidates, unique_missing_points
+from missing_trees.conditions import ToleranceIndex
+from missing_trees.setup import NEIGHBOURS, nearest_neighbours
+from utils import metrics
+from utils.helper import EARTH_RADIUS_IN_KM
+
+
+def tree_spacing(trees):
+    '''
+    Space between trees assumed by the offset engine, see estimate_spacing. The nearest neighbour of the
+    first tree is found without a neighbour search over the whole orchard, with the same haversine distance
+    as the BallTree
+
+    Returns:
+      float: space between trees in kilometers - mean
+
+    Raises:
+      ValidationError: when the trees are too close to each other to estimate it
+    '''
+    from sklearn.metrics import DistanceMetric
+
+    lat_lng_rad = np.deg2rad(np.column_stack((trees.lat, trees.lng)))
+    distances = DistanceMetric.get_metric('haversine').pairwise(lat_lng_rad[:1], lat_lng_rad)[0]
+
+    # the first tree is its own nearest neighbour
+    nearest = np.partition(distances, 1)[1] * EARTH_RADIUS_IN_KM
+
+    return estimate_spacing(nearest)
+
+
+def partition(trees, tile_trees):
+    '''
+    Splits the trees into roughly square tiles of about tile_trees trees: bands of latitude,
+    each cut into the same number of tiles along the longitude
+
+    Returns:
+      list: rows of the trees of every tile, in ascending order
+    '''
+    tiles = max(ceil(len(trees) / tile_trees), 1)
+
+    height = np.ptp(trees.lat)
+    width = np.ptp(trees.lng) * cos(radians(float(np.mean(trees.lat))))
+
+    bands = min(max(round(sqrt(tiles * height / max(width, 1e-12))), 1), tiles)
+    columns = ceil(tiles / bands)
+
+    rows = []
+    for band in np.array_split(np.argsort(trees.lat, kind='stable'), bands):
+        band = band[np.argsort(trees.lng[band], kind='stable')]
+        rows.extend(np.sort(tile) for tile in np.array_split(band, columns) if len(tile))
+
+    return rows
+
+
+def _bounds(lat, lng):
+    '''
+    Returns:
+      tuple: (lat_min, lat_max, lng_min, lng_max) in degrees
+    '''
+    return float(lat.min()), float(lat.max()), float(lng.min()), float(lng.max())
+
+
+def _region(lat, lng, halo, extent):
+    '''
+    Bounds of the trees grown by halo kilometers on every side, within the extent of the orchard
+
+    Returns:
+      tuple: (lat_min, lat_max, lng_min, lng_max) in degrees
+    '''
+    lat_min, lat_max, lng_min, lng_max = _bounds(lat, lng)
+
+    pad_lat = np.rad2deg(halo / EARTH_RADIUS_IN_KM)
+    lat_min, lat_max = lat_min - pad_lat, lat_max + pad_lat
+
+    # longitude degrees are shortest on the edge of the region furthest from the equator
+    widest = min(max(abs(lat_min), abs(lat_max)), 89.0)
+    pad_lng = pad_lat / cos(radians(widest))
+
+    return (
+        max(lat_min, extent[0]), min(lat_max, extent[1]), max(lng_min - pad_lng, extent[2]), min(lng_max + pad_lng, extent[3])
+    )
+
+
+def _distance_outside(lat, lng, region, extent):
+    '''
+    Lower bound of the distance from each point to any tree outside region, in kilometers.
+    There are no trees beyond the sides of the region on the extent of the orchard
+    '''
+    lat_min, lat_max, lng_min, lng_max = np.deg2rad(region)
+    lat, lng = np.deg2rad(lat), np.deg2rad(lng)
+
+    gaps = [lat - lat_min, lat_max - lat, lng - lng_min, lng_max - lng]
+    for side, (bound, limit) in enumerate(zip(region, extent)):
+        if bound == limit:
+            gaps[side] = np.full(len(lat), np.inf)
+
+    # a point above or below the region is at least the latitude gap away
+    across_lat = np.minimum(gaps[0], gaps[1])
+
+    # a point beside the region has a latitude within it, so its cosine is at least that of the edges
+    gap_lng = np.minimum(np.minimum(gaps[2], gaps[3]), np.pi)
+    cos_edges = min(cos(lat_min), cos(lat_max))
+    across_lng = 2 * np.arcsin(np.clip(np.sqrt(np.cos(lat) * cos_edges) * np.sin(gap_lng / 2), 0, 1))
+
+    return EARTH_RADIUS_IN_KM * np.minimum(across_lat, across_lng)
+
+
+def detect_tile(tile, core, mean, region, extent, k):
+    '''
+    Runs the neighbour search and the offset detection on one tile. Runs in the process pool
+
+    The neighbours of a core tree are only final when they are all closer than any tree outside
+    the region the tile was taken from, other core trees are returned to be run again with a wider halo.
+    Tile trees keep the order of the orchard, so ties between neighbours are broken the same way
+
+    Parameters:
+      - tile: Trees - core trees and the halo trees around them, in the order of the orchard
+      - core: array - true for the core trees
+      - mean: float - space between trees in kilometers, see tree_spacing
+      - region: tuple - (lat_min, lat_max, lng_min, lng_max) the tile trees were taken from
+      - extent: tuple - (lat_min, lat_max, lng_min, lng_max) of the whole orchard
+      - k: int - number of nearest neighbours of the orchard, itself included
+
+    Returns:
+      array: tile rows of the core trees to run again - unsafe
+      array: tile rows of the core trees that are done - safe
+      array: tile rows of the neighbours of the safe trees
+      array: distances to the neighbours of the safe trees
+      array: tile rows of the parents of the missing points
+      array: latitude values of the missing points
+      array: longitude values of the missing points
+    '''
+    empty = np.empty(0)
+
+    if len(tile) < k:
+        # only when the region misses trees of the orchard
+        rows = empty.astype(np.int64)
+        return np.flatnonzero(core), rows, rows.reshape(0, k - 1), empty.reshape(0, k - 1), rows, empty, empty
+
+    tile = nearest_neighbours(tile, k)
+
+    # strictly closer, a tree outside at the same distance could be a neighbour as well
+    safe = core.copy()
+    safe[core] = tile.distances[core, -1] < _distance_outside(tile.lat[core], tile.lng[core], region, extent) * (1 - 1e-9)
+
+    parents, lat, lon = generate_candidates(tile, mean)
+
+    keep = safe[parents]
+    parents, lat, lon = parents[keep], lat[keep], lon[keep]
+
+    missing = ~ToleranceIndex(tile).exists(parents, lat, lon)
+
+    return (
+        np.flatnonzero(core & ~safe), np.flatnonzero(safe), tile.neighbours[safe], tile.distances[safe],
+        parents[missing], lat[missing], lon[missing]
+    )
+
+
+def detect_tiled(trees, executor=None, tile_trees=None, halo=None):
+    '''
+    Runs the neighbour search and the offset detection in tiles, see find_missing_trees_tiled. 
+    The trees need unique ids, they are looked up by id in every tile
+
+    Parameters:
+      - trees: Trees - trees returned by fetch_trees, neighbours are not needed
+      - executor: Executor - pool running the tiles, default=None runs them one after the other
+      - tile_trees: int - trees per tile, default=None uses TILE_TREES
+      - halo: float - halo around every tile in tree spacings, default=None uses TILE_HALO
+
+    Returns:
+      Trees: trees with their neighbours and distances
+      array: rows of the parents of the verified missing points, in the order of find_missing_trees
+      array: latitude values of the verified missing points
+      array: longitude values of the verified missing points
+    '''
+    tile_trees = tile_trees or settings.TILE_TREES
+    halo = settings.TILE_HALO if halo is None else halo
+
+    mean = tree_spacing(trees)
+
+    k = min(NEIGHBOURS, len(trees))
+    extent = _bounds(trees.lat, trees.lng)
+    run = map if executor is None else executor.map
+
+    with metrics.stage('tile_partition'):
+        pending = [(rows, halo * mean) for rows in partition(trees, tile_trees)]
+
+    neighbours = np.empty((len(trees), k - 1), dtype=np.int64)
+    distances = np.empty((len(trees), k - 1))
+
+    parents, lat_missing, lon_missing = [], [], []
+
+    while pending:
+        tasks = []
+
+        with metrics.stage('tile_partition'):
+            for rows, halo_km in pending:
+                region = _region(trees.lat[rows], trees.lng[rows], halo_km, extent)
+
+                inside = (
+                    (trees.lat >= region[0]) & (trees.lat <= region[1]) &
+                    (trees.lng >= region[2]) & (trees.lng <= region[3])
+                )
+                inside[rows] = True
+
+                tile_rows = np.flatnonzero(inside)
+                core = np.isin(tile_rows, rows, assume_unique=True)
+
+                tasks.append((tile_rows, halo_km, trees.take(tile_rows), core, region))
+
+        with metrics.stage('tiles'):
+            results = list(run(
+                detect_tile,
+                [tile for _, _, tile, _, _ in tasks],
+                [core for _, _, _, core, _ in tasks],
+                [mean] * len(tasks),
+                [region for _, _, _, _, region in tasks],
+                [extent] * len(tasks),
+                [k] * len(tasks),
+            ))
+
+        pending = []
+
+        for (tile_rows, halo_km, _, _, _), result in zip(tasks, results):
+            unsafe, safe, safe_neighbours, safe_distances, tile_parents, lat, lon = result
+
+            neighbours[tile_rows[safe]] = tile_rows[safe_neighbours]
+            distances[tile_rows[safe]] = safe_distances
+
+            parents.append(tile_rows[tile_parents])
+            lat_missing.append(lat)
+            lon_missing.append(lon)
+
+            if len(unsafe):
+                pending.append((tile_rows[unsafe], max(2 * halo_km, mean)))
+
+    # every parent belongs to one tile, a stable sort keeps the order of its points
+    parents = np.concatenate(parents)
+    order = np.argsort(parents, kind='stable')
+
+    return (
+        trees.with_neighbours(neighbours, distances),
+        parents[order], np.concatenate(lat_missing)[order], np.concatenate(lon_missing)[order]
+    )
+
+
+def find_missing_trees_tiled(trees, trees_polygon, executor=None, tile_trees=None, halo=None):
+    '''
+    Same points as find_missing_trees, with the neighbour search and the detection split into tiles
+    run in parallel, for orchards too large for one core.
+
+    Every tile is searched with a halo of trees around it, so the neighbours of the trees near its
+    seams are the same as over the whole orchard. Points are merged back in the order of their parent
+    trees and merged like find_missing_trees
+
+    Parameters:
+      - trees: Trees - trees returned by fetch_trees, neighbours are not needed
+      - trees_polygon: Polygon - bounds of the trees
+      - executor: Executor - pool running the tiles, default=None runs them one after the other
+      - tile_trees: int - trees per tile, default=None uses TILE_TREES
+      - halo: float - halo around every tile in tree spacings, default=None uses TILE_HALO
+
+    Returns:
+      list: potentially missing trees - [{'lat': lat1, 'lng': lat22, 'support': 1}]
+    '''
+    # trees are looked up by id in every tile, a repeated id could resolve to a tree of another tile
+    if len(trees) < 2 or len(np.unique(trees.ids)) != len(trees):
+        return find_missing_trees(nearest_neighbours(trees), trees_polygon)
+
+    _, parents, lat_missing, lon_missing = detect_tiled(trees, executor, tile_trees, halo)
+
+    return unique_missing_points(trees_polygon, parents, lat_missing, lon_missing)
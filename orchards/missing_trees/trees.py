@@ -0,0 +1,152 @@
+import numpy as np
+
+
+class Trees:
+    '''
+    Columnar representation of the trees of a survey, built once from the api payload and used by every stage.
+
+    - ids: int64 array of tree ids
+    - lat: float64 array of latitude values
+    - lng: float64 array of longitude values
+    - neighbours: int64 array (trees, k) of the rows of the nearest neighbours of every tree, nearest first
+    - distances: float64 array (trees, k) of the distances to those neighbours, in kilometers
+
+    neighbours and distances are filled in by setup_dataframe. Rows are looked up by id through a sorted
+    copy of the ids, so there is no per-tree python object
+    '''
+
+    __slots__ = ('ids', 'lat', 'lng', 'neighbours', 'distances', '_sorted_ids', '_sorted_rows')
+
+    def __init__(self, ids, lat, lng, neighbours=None, distances=None):
+        self.ids = np.ascontiguousarray(ids, dtype=np.int64)
+        self.lat = np.ascontiguousarray(lat, dtype=np.float64)
+        self.lng = np.ascontiguousarray(lng, dtype=np.float64)
+
+        self.neighbours = neighbours
+        self.distances = distances
+
+        self._sorted_ids = None
+        self._sorted_rows = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        return (self.ids, self.lat, self.lng, self.neighbours, self.distances)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def with_neighbours(self, neighbours, distances):
+        '''
+        Returns:
+          Trees: same trees, sharing the coordinate arrays, with their nearest neighbours
+        '''
+        return Trees(self.ids, self.lat, self.lng, neighbours, distances)
+
+    def rows(self, ids):
+        '''
+        Looks up the rows of tree ids. A repeated id resolves to its last row
+
+        Parameters:
+          - ids: array - tree ids
+
+        Returns:
+          array: row of each id
+
+        Raises:
+          KeyError: when an id is not one of the trees
+        '''
+        if self._sorted_ids is None:
+            order = np.argsort(self.ids, kind='stable')
+            self._sorted_rows = order
+            self._sorted_ids = self.ids[order]
+
+        ids = np.asarray(ids, dtype=np.int64)
+        position = np.searchsorted(self._sorted_ids, ids, side='right') - 1
+
+        if len(self._sorted_ids) == 0 or (position < 0).any() or (self._sorted_ids[position] != ids).any():
+            raise KeyError('Unknown tree id')
+
+        return self._sorted_rows[position]
+
+    @classmethod
+    def concatenate(cls, parts):
+        '''
+        Joins the trees of several pages of a survey, in order
+
+        Parameters:
+          - parts: list - Trees without neighbours
+
+        Returns:
+          Trees: all the trees
+        '''
+        if len(parts) == 1:
+            return parts[0]
+
+        return cls(
+            ids=np.concatenate([part.ids for part in parts]),
+            lat=np.concatenate([part.lat for part in parts]),
+            lng=np.concatenate([part.lng for part in parts]),
+        )
+
+    def take(self, rows):
+        '''
+        Returns:
+          Trees: the trees at rows, in that order, without neighbours
+        '''
+        return Trees(self.ids[rows], self.lat[rows], self.lng[rows])
+
+    def lng_lat(self):
+        '''
+        Returns:
+          array: (trees, 2) coordinates as (longitude, latitude)
+        '''
+        return np.column_stack((self.lng, self.lat))
+
+
+class GrowableArray:
+    '''
+    Numeric array that values are appended to in blocks. Capacity doubles when full,
+    so appending is amortised constant time without keeping a python object per value
+    '''
+
+    __slots__ = ('values', 'size')
+
+    def __init__(self, dtype, capacity=1024):
+        self.values = np.empty(max(capacity, 1), dtype=dtype)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, capacity):
+        '''
+        Grows the array to hold at least capacity values
+        '''
+        if capacity > len(self.values):
+            values = np.empty(capacity, dtype=self.values.dtype)
+            values[:self.size] = self.values[:self.size]
+            self.values = values
+
+    def extend(self, values):
+        '''
+        Appends a sequence of values, growing the array at least twofold when full
+        '''
+        size = self.size + len(values)
+
+        if size > len(self.values):
+            self.reserve(max(size, 2 * len(self.values)))
+
+        self.values[self.size:size] = values
+        self.size = size
+
+    def array(self):
+        '''
+        Returns:
+          array: the appended values, trimmed to size
+        '''
+        if self.size == len(self.values):
+            return self.values
+
+        return self.values[:self.size].copy()
@@ -1,7 +1,16 @@
 from django.urls import path
 
-from missing_trees.views import MissingTreesViewSet
+from missing_trees.views import (
+    BatchMissingTreesViewSet, DrawingViewSet, MetricsViewSet, MissingTreesJobsViewSet, MissingTreesJobViewSet, MissingTreesViewSet,
+    missing_trees_async
+)
 
 urlpatterns = [
-    path('orchards/<int:orchard_id>/missing-trees/', MissingTreesViewSet.as_view(), name="missing-trees")
+    path('orchards/<int:orchard_id>/missing-trees/', MissingTreesViewSet.as_view(), name="missing-trees"),
+    path('orchards/<int:orchard_id>/missing-trees/async/', missing_trees_async, name="missing-trees-async"),
+    path('orchards/missing-trees/batch/', BatchMissingTreesViewSet.as_view(), name="missing-trees-batch"),
+    path('orchards/<int:orchard_id>/missing-trees/jobs/', MissingTreesJobsViewSet.as_view(), name="missing-trees-jobs"),
+    path('orchards/missing-trees/jobs/<uuid:job_id>/', MissingTreesJobViewSet.as_view(), name="missing-trees-job"),
+    path('orchards/drawings/<str:name>', DrawingViewSet.as_view(), name="missing-trees-drawing"),
+    path('metrics/', MetricsViewSet.as_view(), name="metrics"),
 ]
\ No newline at end of file
@@ -1,8 +1,35 @@
+import asyncio
+import hashlib
+import json
+
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections
 from django.views import View
-from django.http import JsonResponse
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+
+from missing_trees.setup import fetch_trees, survey_hash
+from missing_trees.actions import DEFAULT_ENGINE, get_engine
+from missing_trees.drawing import draw as draw_trees, drawing_path
+from missing_trees.jobs import submit_job
+from missing_trees.models import RESULT_VERSION, MissingTreesJob
+from missing_trees.pipeline import (
+    compute_batch, compute_missing_trees, get_stored_result, store_result
+)
+from utils import metrics, profiling
+from utils.helper import get_value
 
-from missing_trees.setup import setup_dataframe
-from missing_trees.actions import find_missing_trees
+
+# upstream requests and NumPy/sklearn work of the async view run in their own bounded pools
+io_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_IO_WORKERS, thread_name_prefix='missing-trees-io')
+cpu_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_CPU_WORKERS, thread_name_prefix='missing-trees-cpu')
 
 
 class MissingTreesViewSet(View):
@@ -14,18 +41,407 @@ class MissingTreesViewSet(View):
         else:
             return JsonResponse({'detail': 'Not allowed'}, status=401)
 
+    @metrics.instrument
     def get(self, request, orchard_id=''):
 
         try:
-            draw = False
+            # ?draw renders an html drawing of the orchard, ?draw=png an image
+            draw = None
             if 'draw' in request.GET:
-                draw = True
-        
-            trees_dictionary, trees_polygon, dataframe = setup_dataframe(orchard_id, draw)
+                draw = request.GET.get('draw') or 'html'
+
+            # opt-in newline delimited json, one point per line, the same points as json
+            stream = request.GET.get('format') == 'ndjson'
+
+            engine = request.GET.get('engine', DEFAULT_ENGINE)
+            get_engine(engine)
+
+            if 'profile' in request.GET:
+                return self.profile(request, orchard_id, engine)
+
+            with metrics.stage('fetch'):
+                trees = fetch_trees(orchard_id)
+
+            metrics.count('trees', len(trees))
+            digest = survey_hash(trees)
+
+            # the client already has the response for this survey
+            etag = missing_trees_etag(digest, engine, stream, draw)
+            not_modified = get_conditional_response(request, etag=etag)
 
-            missing_trees = find_missing_trees(trees_dictionary, trees_polygon, dataframe)
+            if not_modified is not None:
+                return cache_response(not_modified, etag)
 
-            return JsonResponse({'missing_trees': missing_trees}, status=200)
+            drawing = None
+            if draw:
+                with metrics.stage('draw'):
+                    drawing = drawing_url(request, draw_trees(orchard_id, trees, digest, draw))
+
+            # serve results already computed for the same survey
+            with metrics.stage('lookup'):
+                missing_trees = get_stored_result(orchard_id, digest, engine)
+
+            if missing_trees is None:
+                missing_trees = compute_missing_trees(orchard_id, trees, engine)
+
+                with metrics.stage('store'):
+                    store_result(orchard_id, digest, len(trees), missing_trees, engine)
+
+            if stream:
+                return cache_response(ndjson_response(missing_trees, drawing), etag)
+
+            return cache_response(missing_trees_response(missing_trees, drawing), etag)
 
         except Exception as e:
-            return JsonResponse({'detail':str(e)}, status=400)
\ No newline at end of file
+            return JsonResponse({'detail':str(e)}, status=400)
+
+    def profile(self, request, orchard_id, engine):
+        '''
+        Runs the whole pipeline under a profiler and returns the report instead of the missing trees.
+        Stored results are neither used nor updated and the survey is not recorded for resurveys, 
+        so the detection always runs and leaves nothing behind
+
+        - ?profile=stats - functions sorted by ?sort=, default cumulative
+        - ?profile=collapsed - sampled call stacks for flamegraph.pl or speedscope
+
+        Only available to staff
+        '''
+        if not request.user.is_staff:
+            return JsonResponse({'detail': 'Profiling is only available to staff'}, status=403)
+
+        mode = request.GET.get('profile') or 'stats'
+
+        def pipeline():
+            trees = fetch_trees(orchard_id)
+            return compute_missing_trees(orchard_id, trees, engine, save=False)
+
+        if mode == 'stats':
+            _, report = profiling.profile_stats(pipeline, request.GET.get('sort', 'cumulative'))
+            filename = f'orchard-{orchard_id}.txt'
+
+        elif mode == 'collapsed':
+            _, report = profiling.profile_collapsed(pipeline, settings.PROFILE_SAMPLE_INTERVAL)
+            filename = f'orchard-{orchard_id}.collapsed'
+
+        else:
+            return JsonResponse({'detail': 'profile must be stats or collapsed'}, status=400)
+
+        response = HttpResponse(report, content_type='text/plain; charset=utf-8', status=200)
+        response['Content-Disposition'] = f'inline; filename="{filename}"'
+
+        return response
+
+
+def missing_trees_etag(digest, engine, stream=False, draw=None):
+    '''
+    Weak ETag of a missing trees response. It only changes with the survey, the engine and the settings
+    it finds points with, the format of the points (see models.RESULT_VERSION) or the form of the response, 
+    so it is known before the detection runs. Responses with the same tag hold the same points, not always 
+    the same bytes
+
+    Parameters:
+      - digest: str - survey hash, see setup.survey_hash
+      - engine: str - detection engine, see actions.ENGINES
+      - stream: bool - ndjson instead of json
+      - draw: str - format of the drawing linked in the response, default=None no drawing
+
+    Returns:
+      str: quoted ETag
+    '''
+    parameters = json.dumps([digest, engine, settings.MERGE_RADIUS, RESULT_VERSION, 'ndjson' if stream else 'json', draw])
+
+    return 'W/"{}"'.format(hashlib.sha256(parameters.encode()).hexdigest())
+
+
+def cache_response(response, etag):
+    '''
+    Adds the ETag of the response and lets clients and proxies reuse it for MISSING_TREES_MAX_AGE seconds
+
+    Returns:
+      HttpResponse: the response
+    '''
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=settings.MISSING_TREES_MAX_AGE)
+
+    return response
+
+
+def drawing_url(request, name):
+    '''
+    Returns:
+      str: absolute url of a drawing rendered by drawing.draw
+    '''
+    return request.build_absolute_uri(reverse('missing-trees-drawing', args=[name]))
+
+
+def missing_trees_response(missing_trees, drawing=None):
+    '''
+    Returns:
+      JsonResponse: missing trees, with the url of the drawing when the orchard was drawn
+    '''
+    data = {'missing_trees': missing_trees}
+    if drawing is not None:
+        data['drawing'] = drawing
+
+    return JsonResponse(data, status=200)
+
+
+def ndjson_response(missing_trees, drawing=None):
+    '''
+    Streams missing trees as newline delimited json, one point per line, so the response is
+    never held in memory as a whole
+
+    Parameters:
+      - missing_trees: list - potentially missing trees - [{'lat': lat1, 'lng': lat22, 'support': 1}]
+      - drawing: str - url of the drawing of the orchard, sent in a Link header, default=None
+
+    Returns:
+      StreamingHttpResponse: application/x-ndjson response
+    '''
+    lines = (json.dumps(point) + '\n' for point in missing_trees)
+
+    response = StreamingHttpResponse(lines, content_type='application/x-ndjson', status=200)
+
+    if drawing is not None:
+        response['Link'] = f'<{drawing}>; rel="drawing"'
+
+    return response
+
+
+class DrawingViewSet(View):
+    '''
+    Drawings rendered by ?draw, named after the orchard and survey so they can be cached by clients
+    '''
+
+    def dispatch(self, request, *args, **kwargs):
+
+        if request.method == 'GET':
+            return super().dispatch(request, *args, **kwargs)
+        else:
+            return JsonResponse({'detail': 'Not allowed'}, status=401)
+
+    def get(self, request, name):
+
+        path = drawing_path(name)
+
+        try:
+            drawing = open(path, 'rb') if path is not None else None
+        except OSError:
+            drawing = None
+
+        if drawing is None:
+            return JsonResponse({'detail': 'Drawing not found'}, status=404)
+
+        # content type guessed from the extension. A drawing is named after its survey and never changes
+        response = FileResponse(drawing, status=200)
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+
+        return response
+
+
+class BatchMissingTreesViewSet(View):
+    '''
+    Missing trees for many orchards in one request, i.e ?orchard_ids=1,2,3
+    '''
+
+    def dispatch(self, request, *args, **kwargs):
+
+        if request.method == 'GET':
+            return super().dispatch(request, *args, **kwargs)
+        else:
+            return JsonResponse({'detail': 'Not allowed'}, status=401)
+
+    @metrics.instrument
+    def get(self, request):
+
+        try:
+            orchard_ids = []
+            for value in request.GET.getlist('orchard_ids'):
+                orchard_ids.extend(int(orchard_id) for orchard_id in value.split(',') if orchard_id.strip())
+
+            # keep the order, drop repeated ids
+            orchard_ids = list(dict.fromkeys(orchard_ids))
+
+        except ValueError:
+            return JsonResponse({'detail': 'orchard_ids must be a comma separated list of integers'}, status=400)
+
+        if len(orchard_ids) == 0:
+            return JsonResponse({'detail': 'orchard_ids is required'}, status=400)
+
+        if len(orchard_ids) > settings.BATCH_MAX_ORCHARDS:
+            return JsonResponse({'detail': f'At most {settings.BATCH_MAX_ORCHARDS} orchards per batch'}, status=400)
+
+        try:
+            results, errors = compute_batch(orchard_ids, request.GET.get('engine', DEFAULT_ENGINE))
+
+            return JsonResponse({'missing_trees': results, 'errors': errors}, status=200)
+
+        except Exception as e:
+            return JsonResponse({'detail':str(e)}, status=400)
+
+
+def closing_connections(function, *args, **kwargs):
+    '''
+    Runs function in a pool thread of the async view. Django only closes database connections at the
+    end of a request thread, so the connections opened in the pool thread are closed here
+
+    Returns:
+      the value returned by function
+    '''
+    try:
+        return function(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+@metrics.instrument
+async def missing_trees_async(request, orchard_id=''):
+    '''
+    Async variant of MissingTreesViewSet for ASGI servers.
+
+    The event loop is never blocked: the upstream fetch waits in the io pool and the detection
+    runs in the cpu pool, so one process can hold many orchard requests while the api responds
+    '''
+
+    if request.method != 'GET':
+        return JsonResponse({'detail': 'Not allowed'}, status=401)
+
+    try:
+        draw = request.GET.get('draw') or 'html' if 'draw' in request.GET else None
+        loop = asyncio.get_running_loop()
+
+        engine = request.GET.get('engine', DEFAULT_ENGINE)
+        get_engine(engine)
+
+        base_endpoint = await sync_to_async(get_value)('BASE_ENDPOINT')
+        api_token = await sync_to_async(get_value)('API_TOKEN')
+
+        with metrics.stage('fetch'):
+            trees = await loop.run_in_executor(
+                io_executor, metrics.propagate(partial(
+                    closing_connections, fetch_trees, orchard_id, base_endpoint=base_endpoint, api_token=api_token
+                ))
+            )
+
+        metrics.count('trees', len(trees))
+        digest = survey_hash(trees)
+
+        etag = missing_trees_etag(digest, engine, False, draw)
+        not_modified = get_conditional_response(request, etag=etag)
+
+        if not_modified is not None:
+            return cache_response(not_modified, etag)
+
+        drawing = None
+        if draw:
+            with metrics.stage('draw'):
+                # waits on the drawing settings and on writing the drawing more than on the cpu
+                name = await loop.run_in_executor(
+                    io_executor, partial(closing_connections, draw_trees, orchard_id, trees, digest, draw)
+                )
+            drawing = drawing_url(request, name)
+
+        with metrics.stage('lookup'):
+            missing_trees = await sync_to_async(get_stored_result)(orchard_id, digest, engine)
+
+        if missing_trees is None:
+            missing_trees = await loop.run_in_executor(
+                cpu_executor, metrics.propagate(partial(
+                    closing_connections, compute_missing_trees, orchard_id, trees, engine
+                ))
+            )
+
+            with metrics.stage('store'):
+                await sync_to_async(store_result)(orchard_id, digest, len(trees), missing_trees, engine)
+
+        return cache_response(missing_trees_response(missing_trees, drawing), etag)
+
+    except Exception as e:
+        return JsonResponse({'detail':str(e)}, status=400)
+
+
+class MetricsViewSet(View):
+    '''
+    Stage timing histograms and tree and candidate counts of the missing trees requests handled 
+    by this process, in the prometheus text format
+    '''
+
+    def dispatch(self, request, *args, **kwargs):
+
+        if request.method == 'GET':
+            return super().dispatch(request, *args, **kwargs)
+        else:
+            return JsonResponse({'detail': 'Not allowed'}, status=401)
+
+    def get(self, request):
+
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8', status=200)
+
+
+def job_response(request, job, status=200):
+    '''
+    Returns:
+      JsonResponse: state of a job, with the missing trees once it is done
+    '''
+    data = {
+        'id': str(job.id),
+        'orchard_id': job.orchard_id,
+        'engine': job.engine,
+        'status': job.status,
+        'attempts': job.attempts,
+        'created': job.created,
+        'updated': job.updated,
+        'url': request.build_absolute_uri(reverse('missing-trees-job', args=[job.id])),
+    }
+
+    if job.detail:
+        data['detail'] = job.detail
+
+    if job.status == MissingTreesJob.DONE and job.result is not None:
+        data['missing_trees'] = job.result.missing_trees
+
+    return JsonResponse(data, status=status)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class MissingTreesJobsViewSet(View):
+    '''
+    Queues the missing trees of an orchard as a job and answers straight away, for orchards too
+    large to compute within a request. Poll the returned url until the job is done or failed
+    '''
+
+    def dispatch(self, request, *args, **kwargs):
+
+        if request.method == 'POST':
+            return super().dispatch(request, *args, **kwargs)
+        else:
+            return JsonResponse({'detail': 'Not allowed'}, status=401)
+
+    def post(self, request, orchard_id=''):
+
+        try:
+            job, created = submit_job(orchard_id, request.GET.get('engine', DEFAULT_ENGINE))
+
+            return job_response(request, job, status=202 if created else 200)
+
+        except Exception as e:
+            return JsonResponse({'detail':str(e)}, status=400)
+
+
+class MissingTreesJobViewSet(View):
+
+    def dispatch(self, request, *args, **kwargs):
+
+        if request.method == 'GET':
+            return super().dispatch(request, *args, **kwargs)
+        else:
+            return JsonResponse({'detail': 'Not allowed'}, status=401)
+
+    def get(self, request, job_id=None):
+
+        job = MissingTreesJob.objects.select_related('result').filter(id=job_id).first()
+
+        if job is None:
+            return JsonResponse({'detail': 'Job not found'}, status=404)
+
+        return job_response(request, job)
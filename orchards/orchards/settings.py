@@ -10,6 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
+import tempfile
+
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -106,6 +109,97 @@ CONSTANCE_CONFIG_FIELDSETS = {
     )
 }
 
+# Constance values are cached in process for CONSTANCE_VALUE_CACHE_TTL seconds, see utils.helper.get_value.
+# Changes made through the admin or set_value apply at once in the process that made them
+CONSTANCE_VALUE_CACHE_TTL = 30
+
+# Api client
+# Requests to BASE_ENDPOINT share pooled keep-alive connections and failed GETs are retried
+# API_RETRIES times with exponential backoff. Remaining pages of paginated responses are fetched
+# by up to API_PAGE_WORKERS threads. Tree surveys are parsed while they are downloaded,
+# API_STREAM_CHUNK_SIZE bytes at a time
+API_TIMEOUT = 5
+API_RETRIES = 3
+API_BACKOFF = 0.5
+API_PAGE_WORKERS = 4
+API_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Async view
+# Number of threads waiting on the api and running the detection for the async view
+ASYNC_IO_WORKERS = 32
+ASYNC_CPU_WORKERS = os.cpu_count() or 1
+
+# Batch endpoint
+# Orchards of a batch are computed in parallel by BATCH_WORKERS processes. Every uwsgi process and the job runner
+# start their own pool, so the HOST_CPU_BUDGET cores of the host are shared between the UWSGI_PROCESSES of 
+# entrypoint.sh and the job runner
+HOST_CPU_BUDGET = os.cpu_count() or 1
+UWSGI_PROCESSES = int(os.environ.get('UWSGI_PROCESSES', 3))
+BATCH_WORKERS = max(HOST_CPU_BUDGET // (UWSGI_PROCESSES + 1), 1)
+BATCH_MAX_ORCHARDS = 100
+
+# Tree survey cache
+# Parsed tree surveys are kept in process per orchard for SURVEY_CACHE_TTL seconds (0 disables the cache).
+# Set SURVEY_CACHE_ALIAS to one of CACHES to share them between processes as well
+SURVEY_CACHE_TTL = 60
+SURVEY_CACHE_MAX_ENTRIES = 64
+SURVEY_CACHE_ALIAS = None
+
+# Conditional requests
+# Missing trees responses carry an ETag of the survey and the engine, a request with a matching If-None-Match is answered 
+# with 304 before any detection. Clients and proxies may reuse a response for MISSING_TREES_MAX_AGE seconds before checking 
+# it again, the survey of an orchard is not fetched again within SURVEY_CACHE_TTL anyway
+MISSING_TREES_MAX_AGE = SURVEY_CACHE_TTL
+
+# Jobs
+# Orchards submitted as jobs are queued in the database and run by `manage.py run_jobs` with JOB_WORKERS threads,
+# which poll the queue every JOB_POLL_INTERVAL seconds. A failed job is retried JOB_MAX_ATTEMPTS times, JOB_RETRY_DELAY
+# seconds after the first failure and twice as long after each next one. The worker running a job renews its lease
+# every JOB_HEARTBEAT seconds, a job whose lease was not renewed for JOB_LEASE seconds is assumed lost and run again
+JOB_WORKERS = 2
+JOB_POLL_INTERVAL = 1
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 5
+JOB_LEASE = 600
+JOB_HEARTBEAT = 60
+
+# Orchard store
+# Trees with their nearest neighbours are written once per survey under ORCHARD_STORE_DIR and memory mapped 
+# read-only by every worker on the host. The ORCHARD_STORE_MAX_ENTRIES most recent surveys are kept, None disables the store
+ORCHARD_STORE_DIR = os.path.join(tempfile.gettempdir(), 'orchards-store')
+ORCHARD_STORE_MAX_ENTRIES = 256
+
+# Tiles
+# Offset detection of orchards with at least TILE_MIN_TREES trees (None disables tiling) is split into tiles of 
+# about TILE_TREES trees, each searched with a halo of TILE_HALO tree spacings, on the BATCH_WORKERS processes
+TILE_MIN_TREES = 200000
+TILE_TREES = 50000
+TILE_HALO = 2
+
+# Delta
+# A new survey of an orchard is matched by tree id against the last survey of the orchard in the orchard store, only the
+# trees whose nearest neighbours changed are detected again. Surveys with more than DELTA_MAX_CHANGES of their trees added, 
+# removed or moved are detected in full. None disables it, opt in with e.g. 0.1
+DELTA_MAX_CHANGES = None
+
+# Merging
+# Missing points found closer than MERGE_RADIUS meters to each other, directly or through other points, are merged into one
+MERGE_RADIUS = 1.0
+
+# Drawings
+# ?draw renders the trees and boundary of an orchard once per survey to DRAW_DIR (None disables drawing), 
+# with at most DRAW_MAX_POINTS trees. The DRAW_MAX_ENTRIES most recent drawings are kept. Orchard 
+# boundaries are fetched once per POLYGON_CACHE_TTL seconds
+DRAW_DIR = os.path.join(tempfile.gettempdir(), 'orchards-drawings')
+DRAW_MAX_POINTS = 20000
+DRAW_MAX_ENTRIES = 256
+POLYGON_CACHE_TTL = 3600
+
+# Profiling
+# Staff can add ?profile=stats or ?profile=collapsed to a missing trees request, the call stack 
+# is sampled every PROFILE_SAMPLE_INTERVAL seconds for collapsed stacks
+PROFILE_SAMPLE_INTERVAL = 0.001
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -0,0 +1,24 @@
+"""
+Process pool worker config for orchards project.
+
+Pool processes are started afresh instead of forked, see missing_trees.pipeline.get_process_pool. 
+``setup`` is their initializer, it sets up django before any model is imported.
+"""
+
+import os
+
+import django
+
+from django.conf import settings
+
+
+def setup(worker_settings):
+    '''
+    Parameters:
+      - worker_settings: dict - settings of the process that created the pool, see pipeline.WORKER_SETTINGS
+    '''
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'orchards.settings')
+    django.setup()
+
+    for name, value in worker_settings.items():
+        setattr(settings, name, value)
@@ -0,0 +1,137 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+
+class TTLCache:
+    '''
+    Bounded in-process cache where entries expire after ttl seconds.
+
+    Once max_entries is reached the least recently used entry is evicted. When a
+    Django cache alias is given, entries are also written to that cache so other
+    processes can pick them up, and local misses fall back to it.
+    '''
+
+    def __init__(self, ttl=60, max_entries=128, alias=None, prefix='', timer=time.monotonic):
+        '''
+        Parameters:
+          - ttl: int or float - seconds an entry stays valid, 0 disables the cache
+          - max_entries: int - number of entries kept in process
+          - alias: str - optional Django cache alias used as a shared backing cache
+          - prefix: str - prefix for keys in the backing cache
+          - timer: callable - monotonic clock, in seconds
+        '''
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.alias = alias
+        self.prefix = prefix
+        self.timer = timer
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _backend(self):
+        return caches[self.alias] if self.alias else None
+
+    def get(self, key, default=None):
+        '''
+        Returns the cached value for key or default when it is missing or expired
+        '''
+        if self.ttl <= 0:
+            return default
+
+        key = str(key)
+        now = self.timer()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                expires, value = entry
+
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self._entries[key]
+
+        backend = self._backend()
+        if backend is not None:
+            value = backend.get(self.prefix + key)
+
+            if value is not None:
+                self._store(key, value, now)
+                with self._lock:
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+
+        return default
+
+    def set(self, key, value):
+        '''
+        Caches value under key for ttl seconds
+        '''
+        if self.ttl <= 0:
+            return
+
+        key = str(key)
+        self._store(key, value, self.timer())
+
+        backend = self._backend()
+        if backend is not None:
+            backend.set(self.prefix + key, value, timeout=self.ttl)
+
+    def _store(self, key, value, now):
+
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        '''
+        Removes key from the cache
+        '''
+        key = str(key)
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+        backend = self._backend()
+        if backend is not None:
+            backend.delete(self.prefix + key)
+
+    def clear(self):
+        '''
+        Removes every entry kept in process and resets the counters
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        '''
+        Returns:
+          dict: hits, misses, evictions and current size of the cache
+        '''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+            }
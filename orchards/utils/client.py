@@ -0,0 +1,260 @@
+import json
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+
+import requests
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils import metrics
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _reset_session():
+    global _session
+    _session = None
+
+
+# forked workers must not share the parent's sockets
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_session)
+
+
+def get_session():
+    '''
+    Returns the shared session used to call the api. Connections are kept alive and pooled,
+    and failed GET requests are retried with backoff
+
+    Returns:
+      Session: requests session
+    '''
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = Retry(
+                    total=settings.API_RETRIES,
+                    backoff_factor=settings.API_BACKOFF,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=frozenset(['GET']),
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=4,
+                    pool_maxsize=max(settings.API_PAGE_WORKERS, 10),
+                    max_retries=retry,
+                )
+
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+
+                _session = session
+
+    return _session
+
+
+def api_headers(api_token):
+    '''
+    Parameters:
+      - api_token: str - api token, NOT a bearer token
+
+    Returns:
+      dict: headers for api requests
+    '''
+    return {'Content-Type':'application/json', 'Authorization': f'{api_token}'}
+
+
+def get(url, headers=None, timeout=None):
+    '''
+    Sends a GET request through the shared session
+
+    Parameters:
+      - url: str - url to call
+      - headers: dict - request headers
+      - timeout: int or float - seconds to wait for the server, default=API_TIMEOUT
+
+    Returns:
+      Response: requests response
+    '''
+    return get_session().get(url, headers=headers, timeout=timeout or settings.API_TIMEOUT)
+
+
+def get_json(url, headers=None, timeout=None):
+    '''
+    Sends a GET request and decodes the json body
+
+    Returns:
+      dict: decoded json
+
+    Raises:
+      ValidationError: when the api does not return 200
+    '''
+    response = get(url, headers=headers, timeout=timeout)
+
+    if response.status_code != 200:
+        raise ValidationError(str(response.text))
+
+    return json.loads(response.content)
+
+
+def page_urls(next_url, count, page_size):
+    '''
+    Works out the url of every remaining page from the url of the second page,
+    for both limit/offset and page number pagination
+
+    Parameters:
+      - next_url: str - url of the second page
+      - count: int - total number of results
+      - page_size: int - number of results on the first page
+
+    Returns:
+      list: urls of pages 2 to n, or None if the pagination style is unknown
+    '''
+    if not count or not page_size:
+        return None
+
+    pages = ceil(count / page_size)
+
+    scheme, netloc, path, query, fragment = urlsplit(next_url)
+    params = parse_qs(query, keep_blank_values=True)
+
+    if 'offset' in params:
+        key, values = 'offset', [page * page_size for page in range(1, pages)]
+    elif 'page' in params:
+        key, values = 'page', list(range(2, pages + 1))
+    else:
+        return None
+
+    urls = []
+    for value in values:
+        params[key] = [str(value)]
+        urls.append(urlunsplit((scheme, netloc, path, urlencode(params, doseq=True), fragment)))
+
+    return urls
+
+
+def get_stream(url, parse, headers=None, timeout=None):
+    '''
+    Sends a GET request and decodes the body while it is downloaded, without holding it in memory
+
+    Parameters:
+      - url: str - url to call
+      - parse: callable - takes an iterable of bytes chunks of the body and returns the decoded value
+      - headers: dict - request headers
+      - timeout: int or float - seconds to wait for the server, default=API_TIMEOUT
+
+    Returns:
+      value returned by parse
+
+    Raises:
+      ValidationError: when the api does not return 200
+    '''
+    with metrics.stage('api'):
+        response = get_session().get(url, headers=headers, timeout=timeout or settings.API_TIMEOUT, stream=True)
+
+    with response:
+        if response.status_code != 200:
+            raise ValidationError(str(response.text))
+
+        # time waiting on the body is reported apart from the time parsing it
+        waited = 0.0
+
+        def timed(iterator):
+            nonlocal waited
+
+            iterator = iter(iterator)
+            while True:
+                start = time.perf_counter()
+                chunk = next(iterator, None)
+                waited += time.perf_counter() - start
+
+                if chunk is None:
+                    return
+                yield chunk
+
+        start = time.perf_counter()
+        value = parse(timed(response.iter_content(chunk_size=settings.API_STREAM_CHUNK_SIZE)))
+
+        timings = metrics.current()
+        if timings is not None:
+            timings.add('download', waited)
+            timings.add('parse', time.perf_counter() - start - waited)
+
+        return value
+
+
+def _remaining_pages(next_url, count, page_size, fetch, max_workers=None):
+    '''
+    Fetches pages 2 to n of a paginated api response
+
+    Parameters:
+      - next_url: str - url of the second page
+      - count: int - total number of results
+      - page_size: int - number of results on the first page
+      - fetch: callable - takes the url of a page and returns (page, url of the next page)
+      - max_workers: int - pages fetched at the same time, default=API_PAGE_WORKERS
+
+    Returns:
+      list: pages, in order
+    '''
+    pages = []
+    urls = page_urls(next_url, count, page_size)
+
+    if urls is None:
+        # unknown pagination, follow the next links one after the other
+        while next_url:
+            page, next_url = fetch(next_url)
+            pages.append(page)
+    else:
+        workers = min(max_workers or settings.API_PAGE_WORKERS, len(urls)) or 1
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(metrics.propagate(fetch), page_url) for page_url in urls]
+            pages.extend(future.result()[0] for future in futures)
+
+    return pages
+
+
+def get_paginated_stream(url, parse, headers=None, timeout=None, max_workers=None):
+    '''
+    Fetches every page of a paginated api response. Once the first page tells how many results
+    there are, the remaining pages are fetched concurrently by at most max_workers threads.
+
+    Each page is decoded by parse while it is downloaded, see get_stream. Neither the json text
+    nor the decoded results of a page are held in memory
+
+    Parameters:
+      - url: str - url of the first page
+      - parse: callable - takes the bytes chunks of a page and returns (results, fields), 
+        where results supports len() and fields holds the other fields of the page, i.e count and next
+      - headers: dict - request headers
+      - timeout: int or float - seconds to wait for each page, default=API_TIMEOUT
+      - max_workers: int - pages fetched at the same time, default=API_PAGE_WORKERS
+
+    Returns:
+      list: results of every page, in the order of the pages whatever order they arrive in
+    '''
+    results, fields = get_stream(url, parse, headers=headers, timeout=timeout)
+
+    next_url = fields.get('next')
+    if not next_url:
+        return [results]
+
+    def fetch(page_url):
+        page, page_fields = get_stream(page_url, parse, headers=headers, timeout=timeout)
+        return page, page_fields.get('next')
+
+    return [results] + _remaining_pages(next_url, fields.get('count'), len(results), fetch, max_workers)
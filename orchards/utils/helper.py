@@ -1,9 +1,30 @@
-from itertools import count, takewhile
-from math import sin, cos, pi, atan2
+from math import sin, cos, pi
 
 from constance import config
+from constance.signals import config_updated
+from django.conf import settings
 
 import numpy as np
+import shapely
+
+from utils.cache import TTLCache
+
+
+# mean radius of the earth, haversine distances in radians times this radius are in kilometers
+EARTH_RADIUS_IN_KM = 6371
+
+# constance values read on every request are kept in process. Updates made in this process invalidate them 
+# straight away through config_updated, updates made by other processes are picked up after the ttl
+config_cache = TTLCache(ttl=settings.CONSTANCE_VALUE_CACHE_TTL, max_entries=64)
+
+_missing = object()
+
+
+def _invalidate(sender, key, **kwargs):
+    config_cache.delete(key)
+
+
+config_updated.connect(_invalidate, dispatch_uid='utils.helper.config_cache')
 
 
 def set_value(key, value):
@@ -14,65 +35,60 @@ def set_value(key, value):
     :return: None
     """
     setattr(config, key, value)
+    config_cache.delete(key)
 
 
 def get_value(key):
     """
-    get constance settings
+    get constance settings, cached in process for CONSTANCE_VALUE_CACHE_TTL seconds
     :param key
     :return: value
     """
-    return getattr(config, key)
+    value = config_cache.get(key, _missing)
 
+    if value is _missing:
+        value = getattr(config, key)
+        config_cache.set(key, value)
 
-def is_inside_polygon(polygon, point):
-    '''
-    Checks whether a geometric point is bounded by a polygon
+    return value
 
-    Parameters:
-      - polygon: Polygon - geometric feature. imported from shapely library
-      - point: Point - geometric feature. imported from shapely library
 
-    Returns:
-      bool: Either true if found else false
+def points_inside_polygon(polygon, lon, lat, tolerance=0):
     '''
-    try:
-        return point.within(polygon)
-    except:
-        return False
-
+    Checks which geometric points are bounded by a polygon, or lie within a tolerance of it, in one pass
 
-def all_range(start=0, stop=None, step=1, round_by=0):
-    '''
-    Creates a sequence of integers/decimals from start (inclusive) to stop (exclusive) by step. range(i, j) 
-    
-    produces i, i+1, i+2, ..., j-1. start defaults to 0, and stop is omitted! 
-    
-    all_range(4) produces 0, 1, 2, 3. These are exactly the valid indices for a list of 4 elements. When step is given, it specifies the increment (or decrement)
+    The polygon is prepared once so its boundary is indexed instead of rescanned for every point
 
     Parameters:
-      - start: int or float - indicates the beginning value
-      - stop:  int or float - indicates where the list should end. 
-                note - this value will not be returned in the list.
-      - step: int or float - indicates the beginning value
-      - round_by: int or float - indicates rounded val
+      - polygon: Polygon - geometric feature. imported from shapely library
+      - lon: array - longitude values
+      - lat: array - latitude values
+      - tolerance: float - maximum distance from the polygon, in degrees
 
     Returns:
-      list: sequence of integers/floats
+      array: true for every point found inside else false
     '''
-    if step == 0:
-        raise ValueError("Step cannot be NULL")
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+
+    try:
+        shapely.prepare(polygon)
+        inside = shapely.contains_xy(polygon, lon, lat)
+    except Exception:
+        inside = np.zeros(len(lon), dtype=bool)
 
-    if stop is None:
-        start, stop = 0, start
+    if tolerance > 0 and not inside.all():
+        outside = ~inside
+        inside[outside] = shapely.dwithin(polygon, shapely.points(lon[outside], lat[outside]), tolerance)
 
-    return list(takewhile(lambda x: x < stop, (round(start + i * step, round_by) for i in count())))
+    return inside
 
 
 def get_direction(lat1: float, lon1: float, lat2: float, lon2: float):
     '''
     Calculates the azimuth/bearing/direction between two points.
-    Latitude and longitude values must be in decimal degrees
+    Latitude and longitude values must be in decimal degrees.
+    Numpy arrays of equal length can be passed to get every bearing in one pass
 
     Parameters:
       - lat1: int or float - latitude for the first point
@@ -81,15 +97,15 @@ def get_direction(lat1: float, lon1: float, lat2: float, lon2: float):
       - lon2: int or float - longitude for the second point
 
     Returns:
-      float: the bearing value in degrees 
+      float or array: the bearing value in degrees 
     '''
     lat1 = np.deg2rad(lat1)
     lat2 = np.deg2rad(lat2)
     dLon = lon2 - lon1
     # dLon = np.deg2rad(lon2) - np.deg2rad(lon1)
-    y = sin(dLon) * cos(lat2)
-    x = cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(dLon)
-    bearing = np.rad2deg(atan2(y, x))
+    y = np.sin(dLon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dLon)
+    bearing = np.rad2deg(np.arctan2(y, x))
 
     return (bearing + 360) % 360
 
@@ -97,7 +113,9 @@ def get_direction(lat1: float, lon1: float, lat2: float, lon2: float):
 def add_distance(direction: int, dist_in_km: float, lat: float, lon: float):
     '''
     Adds the azimuth/bearing/direction in kilometers to a coordinate point.
-    Latitude and longitude values must be in decimal degrees
+    Latitude and longitude values must be in decimal degrees.
+    dist_in_km, lat and lon can also be numpy arrays of equal length, in which 
+    case every point is offset in one pass
 
     toRadians(45 * (2 * n - 1)); | where n = [1, 2, 3, 4] 
     
@@ -105,13 +123,13 @@ def add_distance(direction: int, dist_in_km: float, lat: float, lon: float):
 
     Parameters:
       - direction: int between 1 and 4 (inclusive)
-      - dist_in_km: int or float - distance in kilometers
-      - lat1: int or float - latitude for the first point
-      - lon1: int or float - longitude for the first point
+      - dist_in_km: int, float or array - distance in kilometers
+      - lat1: int, float or array - latitude for the first point
+      - lon1: int, float or array - longitude for the first point
 
     Returns:
-      float: new latitude - new_lat
-      float: new longitude - new_lat
+      float or array: new latitude - new_lat
+      float or array: new longitude - new_lat
     '''
 
     if direction <= 0 or direction > 4:
@@ -120,36 +138,106 @@ def add_distance(direction: int, dist_in_km: float, lat: float, lon: float):
     #  The correct calculation would be 
     a = np.deg2rad(45 * (2 * direction - 1));  # degrees
 
-    r_earth = 6371 # in km
+    lat0 = np.cos(pi / 180.0 * lat)
 
-    lat0 = cos(pi / 180.0 * lat)
-
-    new_lat = lat + (180/pi) * (dist_in_km / r_earth) * sin(a)
-    new_lon = lon + (180/pi) * (dist_in_km / r_earth) / cos(lat0) * cos(a)
+    new_lat = lat + (180/pi) * (dist_in_km / EARTH_RADIUS_IN_KM) * sin(a)
+    new_lon = lon + (180/pi) * (dist_in_km / EARTH_RADIUS_IN_KM) / np.cos(lat0) * cos(a)
     
     return new_lat, new_lon
 
 
-def binary_search(item_to_search, search_list: list):
+def to_local_plane(lat, lon, origin=None):
     '''
-    Search through a list for a value recurively
+    Projects coordinates onto a plane tangent to the earth at origin, in meters. 
+    x points east and y points north. Accurate enough across an orchard, not across countries
 
     Parameters:
-      - item_to_search: item to search
-      - search_list: sorted list which will be traversed
+      - lat: array - latitude values in decimal degrees
+      - lon: array - longitude values in decimal degrees
+      - origin: tuple - (lat, lon) of the tangent point, default=None uses the centre of the points
 
     Returns:
-      bool: true if item is found else false
+      array: x values in meters
+      array: y values in meters
+      tuple: origin (lat, lon), needed to project back with from_local_plane
     '''
-    max_length = len(search_list) - 1
-    mid = max_length//2
-    
-    if max_length+1 == 0:
-        return False
-    elif item_to_search == search_list[mid]:
-        return True
-    else:
-        if item_to_search > search_list[mid]:
-            return binary_search(item_to_search, search_list[mid+1:max_length+1])
-        else:
-            return binary_search(item_to_search, search_list[0:mid])
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+
+    if origin is None:
+        origin = (float(lat.mean()), float(lon.mean()))
+
+    r_earth = EARTH_RADIUS_IN_KM * 1000 # in m
+
+    x = np.deg2rad(lon - origin[1]) * r_earth * cos(np.deg2rad(origin[0]))
+    y = np.deg2rad(lat - origin[0]) * r_earth
+
+    return x, y, origin
+
+
+def from_local_plane(x, y, origin):
+    '''
+    Inverse of to_local_plane
+
+    Parameters:
+      - x: array - x values in meters
+      - y: array - y values in meters
+      - origin: tuple - (lat, lon) returned by to_local_plane
+
+    Returns:
+      array: latitude values in decimal degrees
+      array: longitude values in decimal degrees
+    '''
+    r_earth = EARTH_RADIUS_IN_KM * 1000 # in m
+
+    lat = origin[0] + np.rad2deg(np.asarray(y, dtype=float) / r_earth)
+    lon = origin[1] + np.rad2deg(np.asarray(x, dtype=float) / (r_earth * cos(np.deg2rad(origin[0]))))
+
+    return lat, lon
+
+
+class CellGrid:
+    '''
+    Spatial hash of points in square grid cells, so only the points of a few cells are compared
+    instead of every pair of points
+
+    Parameters:
+      - rows: array - cell of every point along the first axis, integers
+      - columns: array - cell of every point along the second axis, integers
+    '''
+
+    def __init__(self, rows, columns):
+
+        # one key per cell, with an empty cell on every side so the cells around stay apart
+        rows = rows - (rows.min() - 1)
+        columns = columns - (columns.min() - 1)
+        self.width = int(columns.max()) + 2
+
+        self.keys = rows * self.width + columns
+        self.order = np.argsort(self.keys, kind='stable')
+        self.sorted_keys = self.keys[self.order]
+
+    def around(self, half=False):
+        '''
+        Returns:
+          array: key offsets of a cell and the 8 cells around it, or of the cell and 4 of them when half,
+            enough for pairs where every pair of cells is visited from one side
+        '''
+        if half:
+            return np.array([0, 1, self.width - 1, self.width, self.width + 1])
+
+        return (np.arange(-1, 2)[:, None] * self.width + np.arange(-1, 2)).ravel()
+
+    def points_in(self, cells):
+        '''
+        Parameters:
+          - cells: array - keys of cells, the search is fastest when they are sorted
+
+        Returns:
+          array: points in every cell, cell after cell
+          array: number of points in every cell
+        '''
+        start = np.searchsorted(self.sorted_keys, cells, side='left')
+        counts = np.searchsorted(self.sorted_keys, cells, side='right') - start
+
+        return self.order[np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())], counts
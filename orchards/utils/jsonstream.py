@@ -0,0 +1,155 @@
+import codecs
+import json
+
+from json import JSONDecodeError
+
+
+_decoder = json.JSONDecoder()
+
+WHITESPACE = ' \t\n\r'
+
+
+class _Reader:
+    '''
+    Text read from chunks of utf-8 bytes. Only the text that has not been parsed yet is kept
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decode = codecs.getincrementaldecoder('utf-8')().decode
+
+        self.text = ''
+        self.position = 0
+        self.done = False
+
+    def more(self):
+        '''
+        Appends the next chunk to the text, dropping what has been parsed
+
+        Returns:
+          bool: false once every chunk has been read
+        '''
+        if self.done:
+            return False
+
+        try:
+            text = self.decode(next(self.chunks))
+        except StopIteration:
+            text = self.decode(b'', final=True)
+            self.done = True
+
+        self.text = self.text[self.position:] + text
+        self.position = 0
+
+        return True
+
+    def peek(self):
+        '''
+        Returns:
+          str: next character that is not whitespace, '' at the end of the text
+        '''
+        while True:
+            while self.position < len(self.text) and self.text[self.position] in WHITESPACE:
+                self.position += 1
+
+            if self.position < len(self.text):
+                return self.text[self.position]
+
+            if not self.more():
+                return ''
+
+    def expect(self, characters, message):
+        '''
+        Consumes the next character, which must be one of characters
+
+        Returns:
+          str: the consumed character
+        '''
+        character = self.peek()
+
+        if character == '' or character not in characters:
+            raise JSONDecodeError(message, self.text, self.position)
+
+        self.position += 1
+
+        return character
+
+    def value(self):
+        '''
+        Decodes the next json value, reading more chunks until it is complete
+
+        Returns:
+          decoded value
+        '''
+        self.peek()
+
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.position)
+            except JSONDecodeError:
+                if self.more():
+                    continue
+                raise
+
+            # a number ending with the text may carry on in the next chunk
+            if end == len(self.text) and self.more():
+                continue
+
+            self.position = end
+
+            return value
+
+
+def iter_object(chunks, array_key):
+    '''
+    Parses a json object incrementally from chunks of bytes, e.g response.iter_content().
+    The items of one array of the object are decoded one at a time, so memory stays
+    proportional to one item instead of the whole document
+
+    Parameters:
+      - chunks: iterable - bytes of a utf-8 json object
+      - array_key: str - key of the array to stream
+
+    Yields:
+      tuple: (array_key, item) for each item of the array, (key, value) for every other field
+
+    Raises:
+      JSONDecodeError: when the chunks are not a complete json document
+    '''
+    reader = _Reader(chunks)
+
+    if reader.peek() != '{':
+        # same message as json.loads for text that is not json, e.g an html error page
+        raise JSONDecodeError('Expecting value', reader.text, reader.position)
+
+    reader.expect('{', 'Expecting value')
+
+    if reader.peek() == '}':
+        reader.expect('}', 'Expecting \'}\'')
+    else:
+        while True:
+            if reader.peek() != '"':
+                raise JSONDecodeError('Expecting property name enclosed in double quotes', reader.text, reader.position)
+
+            key = reader.value()
+            reader.expect(':', 'Expecting \':\' delimiter')
+
+            if key == array_key and reader.peek() == '[':
+                reader.expect('[', 'Expecting value')
+
+                if reader.peek() == ']':
+                    reader.expect(']', 'Expecting value')
+                else:
+                    while True:
+                        yield key, reader.value()
+
+                        if reader.expect(',]', 'Expecting \',\' delimiter') == ']':
+                            break
+            else:
+                yield key, reader.value()
+
+            if reader.expect(',}', 'Expecting \',\' delimiter') == '}':
+                break
+
+    if reader.peek() != '':
+        raise JSONDecodeError('Extra data', reader.text, reader.position)
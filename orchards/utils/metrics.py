@@ -0,0 +1,225 @@
+import asyncio
+import contextvars
+import threading
+import time
+
+from contextlib import contextmanager
+from functools import partial, wraps
+
+
+# upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (100, 1000, 5000, 10000, 50000, 100000, 500000, 1000000, 5000000)
+
+_timings = contextvars.ContextVar('timings', default=None)
+
+
+class Histogram:
+    '''
+    Cumulative histogram in the prometheus format, one series per label value
+    '''
+
+    def __init__(self, name, documentation, label, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+
+            if series is None:
+                # count per bucket, sum, count
+                series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+
+            series[1] += value
+            series[2] += 1
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        '''
+        Returns:
+          str: histogram in the prometheus text exposition format
+        '''
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+
+        with self._lock:
+            for label_value, (buckets, total, count) in sorted(self._series.items()):
+                label = f'{self.label}="{label_value}"'
+
+                for bound, bucket in zip(self.buckets, buckets):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {bucket}')
+
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{label}}} {total}')
+                lines.append(f'{self.name}_count{{{label}}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+stage_seconds = Histogram(
+    'missing_trees_stage_seconds', 'Time spent in each stage of a missing trees request', 'stage', SECONDS_BUCKETS
+)
+request_counts = Histogram(
+    'missing_trees_request_size', 'Trees and candidate points handled per missing trees request', 'count', COUNT_BUCKETS
+)
+
+HISTOGRAMS = (stage_seconds, request_counts)
+
+
+class Timings:
+    '''
+    Stage durations and counts of one request. A stage timed more than once adds up
+    '''
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, value):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def header(self):
+        '''
+        Returns:
+          str: Server-Timing header value, durations in milliseconds
+        '''
+        with self._lock:
+            return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items())
+
+    def observe(self):
+        '''
+        Adds the request to the histograms
+        '''
+        with self._lock:
+            stages, counts = dict(self.stages), dict(self.counts)
+
+        for name, seconds in stages.items():
+            stage_seconds.observe(name, seconds)
+
+        for name, value in counts.items():
+            request_counts.observe(name, value)
+
+
+def current():
+    '''
+    Returns:
+      Timings: timings of the request being handled, None outside of an instrumented view
+    '''
+    return _timings.get()
+
+
+@contextmanager
+def stage(name):
+    '''
+    Times a stage of the current request. Does nothing outside of an instrumented view
+
+    Parameters:
+      - name: str - name of the stage, reported in the Server-Timing header
+    '''
+    timings = _timings.get()
+
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def count(name, value):
+    '''
+    Adds value to a count of the current request, i.e trees or candidates
+    '''
+    timings = _timings.get()
+
+    if timings is not None:
+        timings.count(name, value)
+
+
+def propagate(function):
+    '''
+    Binds function to a copy of the current context, so stages timed while it runs in another 
+    thread, e.g an executor, are added to the current request
+
+    Returns:
+      callable: function running in the copied context
+    '''
+    return partial(contextvars.copy_context().run, function)
+
+
+def _finish(timings, start, response):
+    timings.add('total', time.perf_counter() - start)
+    timings.observe()
+
+    response['Server-Timing'] = timings.header()
+
+    return response
+
+
+def instrument(view):
+    '''
+    Decorator timing the stages of a view. The response gets a Server-Timing header and the
+    stages and counts are added to the histograms, see render.
+
+    Streamed responses only report the stages done before the first byte is sent
+    '''
+    if asyncio.iscoroutinefunction(view):
+
+        @wraps(view)
+        async def wrapper(*args, **kwargs):
+            timings = Timings()
+            token = _timings.set(timings)
+            start = time.perf_counter()
+
+            try:
+                response = await view(*args, **kwargs)
+            finally:
+                _timings.reset(token)
+
+            return _finish(timings, start, response)
+
+    else:
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            timings = Timings()
+            token = _timings.set(timings)
+            start = time.perf_counter()
+
+            try:
+                response = view(*args, **kwargs)
+            finally:
+                _timings.reset(token)
+
+            return _finish(timings, start, response)
+
+    return wrapper
+
+
+def render():
+    '''
+    Returns:
+      str: every histogram in the prometheus text exposition format
+    '''
+    return ''.join(histogram.render() for histogram in HISTOGRAMS)
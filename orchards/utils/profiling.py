@@ -0,0 +1,94 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+
+from collections import Counter
+
+
+# orders accepted by profile_stats, see pstats.Stats.sort_stats
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls', 'filename', 'name')
+
+# rows of the sorted stats report
+STATS_LIMIT = 100
+
+
+def profile_stats(function, sort='cumulative', limit=STATS_LIMIT):
+    '''
+    Runs function under cProfile
+
+    Parameters:
+      - function: callable - function to profile, called without arguments
+      - sort: str - one of SORT_KEYS
+      - limit: int - number of functions in the report
+
+    Returns:
+      value returned by function
+      str: report of the functions sorted by sort
+    '''
+    if sort not in SORT_KEYS:
+        raise ValueError(f'sort must be one of {", ".join(SORT_KEYS)}')
+
+    profiler = cProfile.Profile()
+    value = profiler.runcall(function)
+
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).strip_dirs().sort_stats(sort).print_stats(limit)
+
+    return value, report.getvalue()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def profile_collapsed(function, interval=0.001):
+    '''
+    Runs function while a thread samples its call stack every interval seconds.
+
+    The report is in the collapsed stack format read by flamegraph.pl and speedscope, one line
+    per distinct stack: frames from the outermost call, separated by ';', then the number of samples
+
+    Parameters:
+      - function: callable - function to profile, called without arguments
+      - interval: float - seconds between samples
+
+    Returns:
+      value returned by function
+      str: collapsed stacks
+    '''
+    thread_id = threading.get_ident()
+
+    # frames of the callers of profile_collapsed are left out of the stacks
+    root = sys._getframe()
+
+    stacks = Counter()
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+
+            stack = []
+            while frame is not None and frame is not root:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+
+            if stack:
+                stacks[';'.join(reversed(stack))] += 1
+
+    sampler = threading.Thread(target=sample, name='profile-sampler', daemon=True)
+    sampler.start()
+
+    try:
+        value = function()
+    finally:
+        done.set()
+        sampler.join()
+
+    report = ''.join(f'{stack} {samples}\n' for stack, samples in stacks.most_common())
+
+    return value, report